@@ -0,0 +1,201 @@
+import asyncio
+import os
+import queue
+import sys
+import time
+from concurrent.futures import Executor
+from typing import Any, Awaitable, Callable, Dict, Iterator
+
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from schemas.schemas import CheckResult
+from executors import get_executor
+
+# Seconds /analyze waits for its checks before returning the partial results
+ANALYZE_TIMEOUT = float(os.environ.get("ANALYZE_TIMEOUT", "60"))
+
+
+async def run_checks(
+        checks: Dict[str, Callable[[], Awaitable[Any]]],
+        timeout: float = ANALYZE_TIMEOUT,
+) -> tuple[Dict[str, Any], Dict[str, CheckResult]]:
+    """
+    Runs independent checks concurrently. A check that fails or is still running after `timeout`
+    seconds is reported without a result; the others are unaffected.
+
+    Checks running on an executor thread cannot be interrupted, so a timed out check keeps running
+    in the background until it finishes, but its result is discarded.
+
+    Args:
+        checks (Dict[str, Callable[[], Awaitable[Any]]]): Coroutine functions keyed by check name.
+        timeout (float, optional): Seconds to wait for all the checks. Defaults to
+            ANALYZE_TIMEOUT or 60.
+
+    Returns:
+        tuple[Dict[str, Any], Dict[str, CheckResult]]: The result of each check that succeeded, and
+            the status and timing of every check, both keyed by check name.
+    """
+    start = time.perf_counter()
+    finished = {}
+
+    async def timed(name, check):
+        try:
+            return await check()
+        finally:
+            finished[name] = (time.perf_counter() - start) * 1000
+
+    tasks = {name: asyncio.create_task(timed(name, check)) for name, check in checks.items()}
+
+    if tasks:
+        await asyncio.wait(tasks.values(), timeout=timeout)
+
+    results, statuses = {}, {}
+
+    for name, task in tasks.items():
+        if not task.done():
+            task.cancel()
+            statuses[name] = CheckResult(status="timeout", elapsed_ms=timeout * 1000)
+        elif task.exception() is not None:
+            statuses[name] = CheckResult(status="error", elapsed_ms=finished[name],
+                                         error=str(task.exception()))
+        else:
+            results[name] = task.result()
+            statuses[name] = CheckResult(status="ok", elapsed_ms=finished[name])
+
+        _log_status(name, statuses[name])
+
+    return results, statuses
+
+
+def _log_status(name: str, status: CheckResult):
+    if status.status == "error":
+        logger.warning(f"Check {name} failed: {status.error}")
+    logger.info(f"Check {name}: {status.status} in {status.elapsed_ms:.0f}ms")
+
+
+def iter_checks(
+        checks: Dict[str, Callable[[], Any]],
+        timeouts: Dict[str, float],
+        executor: Executor = None,
+        queue_timeout: float = ANALYZE_TIMEOUT,
+) -> Iterator[tuple[str, Any, CheckResult]]:
+    """
+    Runs independent blocking checks concurrently on an executor, each with its own timeout, and
+    yields each one as soon as it completes, fails or times out. A check that fails or is still
+    running after its timeout is reported without a result, and the others are unaffected.
+
+    The timeout of a check starts when it begins executing, so time spent waiting for a free worker
+    does not count against it. A check that is still waiting after `queue_timeout` seconds is
+    cancelled and reported as timed out.
+
+    Args:
+        checks (Dict[str, Callable[[], Any]]): Functions keyed by check name.
+        timeouts (Dict[str, float]): Seconds to wait for each check once it has started, keyed by
+            check name. Defaults to ANALYZE_TIMEOUT for a check without one.
+        executor (Executor, optional): The executor to run the checks on. Defaults to the "signal"
+            executor.
+        queue_timeout (float, optional): Seconds a check may wait for a free worker. Defaults to
+            ANALYZE_TIMEOUT or 60.
+
+    Yields:
+        tuple[str, Any, CheckResult]: The name of the check, its result (None unless it succeeded)
+            and its status and running time (or, if it never started, time spent waiting), in order
+            of completion.
+    """
+    executor = executor or get_executor("signal")
+    start = time.perf_counter()
+    # woken whenever a check starts, to arm its deadline, or completes
+    events = queue.SimpleQueue()
+    started, finished = {}, {}
+
+    def timed(name, check):
+        started[name] = time.perf_counter()
+        events.put(name)
+        try:
+            return check()
+        finally:
+            finished[name] = (time.perf_counter() - started[name]) * 1000
+
+    names = {}
+
+    for name, check in checks.items():
+        future = executor.submit(timed, name, check)
+        names[future] = name
+        future.add_done_callback(events.put)
+
+    def deadline(future):
+        name = names[future]
+        if name in started:
+            return started[name] + timeouts.get(name, ANALYZE_TIMEOUT)
+        return start + queue_timeout
+
+    pending = set(names)
+
+    while pending:
+        try:
+            events.get(timeout=max(0.0, min(map(deadline, pending)) - time.perf_counter()))
+        except queue.Empty:
+            pass
+
+        done = {future for future in pending if future.done()}
+
+        for future in done:
+            name = names[future]
+            if future.exception() is not None:
+                result = None
+                status = CheckResult(status="error", elapsed_ms=finished[name],
+                                     error=str(future.exception()))
+            else:
+                result = future.result()
+                status = CheckResult(status="ok", elapsed_ms=finished[name])
+
+            _log_status(name, status)
+            yield name, result, status
+
+        pending -= done
+        now = time.perf_counter()
+
+        for future in [future for future in pending if deadline(future) <= now]:
+            pending.remove(future)
+            name = names[future]
+
+            if future.cancel():
+                status = CheckResult(status="timeout", elapsed_ms=(now - start) * 1000,
+                                     error="No worker became available")
+            else:
+                status = CheckResult(status="timeout",
+                                     elapsed_ms=timeouts.get(name, ANALYZE_TIMEOUT) * 1000)
+
+            _log_status(name, status)
+            yield name, None, status
+
+
+def gather_checks(
+        checks: Dict[str, Callable[[], Any]],
+        timeouts: Dict[str, float],
+        executor: Executor = None,
+) -> tuple[Dict[str, Any], Dict[str, CheckResult]]:
+    """
+    Runs independent blocking checks concurrently and waits for them, see `iter_checks`. The
+    synchronous counterpart of `run_checks`.
+
+    Args:
+        checks (Dict[str, Callable[[], Any]]): Functions keyed by check name.
+        timeouts (Dict[str, float]): Seconds to wait for each check, keyed by check name.
+        executor (Executor, optional): The executor to run the checks on. Defaults to the "signal"
+            executor.
+
+    Returns:
+        tuple[Dict[str, Any], Dict[str, CheckResult]]: The result of each check that succeeded, and
+            the status and timing of every check, both keyed by check name.
+    """
+    results, statuses = {}, {}
+
+    for name, result, status in iter_checks(checks, timeouts, executor):
+        statuses[name] = status
+        if status.status == "ok":
+            results[name] = result
+
+    return results, {name: statuses[name] for name in checks}
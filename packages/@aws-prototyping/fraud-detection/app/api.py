@@ -1,26 +1,39 @@
+import json
 import logging
 import os
 import sys
+import time
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import PIL
 from dotenv import load_dotenv
 from pandas import DataFrame
 import uvicorn
+from contextlib import asynccontextmanager
 from typing import Optional
-from PIL import Image
 from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from mangum import Mangum
-from schemas.schemas import DeductionResult, ExifDataResult, LibraryImageWithScore, ReverseImageSearchResults
-from claim_deduction import perform_deduction
-from image_library import S3ImageLibrary
+from schemas.schemas import (AnalysisResult, DeductionResult, ExifDataResult, GeneratedImageResult,
+                             LibraryImagePage, LibraryImageWithScore, ReverseImageSearchResults)
+from claim_deduction import perform_deduction, stream_deduction
+from image_library import get_image_library
 from websearch import reverse_image_search as internet_reverse_image_search
 from exifdata import get_lat_lon_for_img, extract_exif_gps_timestamp
-import io
-import boto3
+from rekognition import detect_labels_in_image
+from generated_image_detector import detect_generated_image
+from analysis import ANALYZE_TIMEOUT, run_checks
+from image_library import model_name as library_model_name
+import model_registry
+from embedding_cache import get_embedding_cache
+from opensearch_manager import get_connection_metrics
+from claim_image import ClaimImage
+import executors
+from executors import run_cpu, run_io
+from util.s3 import get_s3_client
 
 load_dotenv()
-s3 = boto3.client('s3')
+s3 = get_s3_client()
 
 STORAGE_BUCKET = os.environ.get("STORAGE_BUCKET", "STORAGE_BUCKET")
 
@@ -31,9 +44,30 @@ logger = logging.getLogger(__name__)
 # Add the directory containing the schemas module to the Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Loads and warms up the shared image encoder and creates the shared image library once per
+    worker before any request is served, so that the first search does not pay for the model
+    download and initialisation.
+    """
+    try:
+        model_registry.warm_up(library_model_name)
+    except Exception as e:
+        # Keep serving so that /healthcheck can report the failure
+        logger.exception(f"Failed to warm up model {library_model_name}: {e}")
+    try:
+        await run_io(get_image_library)
+    except Exception as e:
+        # The library is created again on the first request that needs it
+        logger.exception(f"Failed to create the image library: {e}")
+    yield
+    executors.shutdown()
+
 
 # Initialize FastAPI app
 app = FastAPI(
+    lifespan=lifespan,
     title="Fraud Detection API",
     description="An API for providing fraud detection capabilities.",
     summary="",
@@ -59,6 +93,22 @@ def get_origins():
     return origins
 
 
+def fetch_claim_image(image_s3_key: str) -> ClaimImage:
+    """
+    Downloads an image from the storage bucket. Blocking, run it on the I/O executor.
+    """
+    return ClaimImage.from_s3(STORAGE_BUCKET, image_s3_key, s3=s3)
+
+
+async def load_s3_image(image_s3_key: str) -> ClaimImage:
+    """
+    Downloads and decodes an image from the storage bucket without blocking the event loop. The
+    returned image is shared by every step of the request, so it is downloaded and decoded once.
+    """
+    image = await run_io(fetch_claim_image, image_s3_key)
+    return await run_cpu(image.decode)
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -79,37 +129,67 @@ async def default_route():
     return {"message": "Welcome to the Fraud Detection API!"}
 
 @app.post("/searchlibrary")
-async def search_image_library(image_s3_key: str, sim_thresh: float = 0.9) -> list[LibraryImageWithScore]:
+async def search_image_library(image_s3_key: str, sim_thresh: float = 0.9, k: int = 100,
+                               claim_type: Optional[str] = None,
+                               created_after: Optional[str] = None,
+                               created_before: Optional[str] = None
+                               ) -> list[LibraryImageWithScore]:
     """
     Searches for similar images in the image library stored in S3.
     Args:
         image_s3_key (str): The S3 key of the image to search for.
-        sim_thresh (float, optional): The similarity threshold for filtering images. Defaults to 0.9.
+        sim_thresh (float, optional): The similarity threshold for filtering images. Defaults to
+            0.9.
+        k (int, optional): The maximum number of images to return. Defaults to 100.
+        claim_type (str, optional): Only return images submitted with this claim type.
+        created_after (str, optional): Only return images added on or after this ISO date or time.
+        created_before (str, optional): Only return images added on or before this ISO date or
+            time.
+        The filters only match images whose metadata is in the vector index, i.e. those added since
+        it was indexed.
     Returns:
-        list[LibraryImageWithScore]: A list of images from the library that have a similarity score above the threshold.
+        list[LibraryImageWithScore]: A list of images from the library that have a similarity score
+            above the threshold.
     """
    
     
-    # Download the file from S3
-    response = s3.get_object(Bucket=STORAGE_BUCKET, Key=image_s3_key)
-    file_content = response['Body'].read()
-
-    # Create BytesIO object from the file content
-    image_bytes = io.BytesIO(file_content)  
-    image = Image.open(image_bytes)
-    image = image.convert('RGB')
+    image = await load_s3_image(image_s3_key)
     
-    image_library = S3ImageLibrary()
+    image_library = await run_io(get_image_library)
+    query_features = await run_cpu(image_library._extract_image_features, image)
 
-    lst_images = image_library.search_images(image)
+    return await run_io(image_library.search_features, query_features, k=k, min_score=sim_thresh,
+                        claim_type=claim_type, created_after=created_after,
+                        created_before=created_before)
 
-    reverse_matches = [
-        img for img in lst_images if img.score > sim_thresh]
+@app.get("/library")
+async def list_image_library(page_size: int = 50, cursor: Optional[str] = None,
+                             include_thumbnails: bool = True) -> LibraryImagePage:
+    """
+    Lists the image library one page at a time.
+    Args:
+        page_size (int, optional): The maximum number of images per page (1-500). Defaults to 50.
+        cursor (str, optional): The next_cursor of the previous page. Defaults to the first page.
+        include_thumbnails (bool, optional): Whether to include the thumbnails of the page.
+            Defaults to True.
+    Returns:
+        LibraryImagePage: The images on the page, the cursor of the next page and the total number
+            of images.
+    """
+    if not 1 <= page_size <= 500:
+        raise HTTPException(status_code=400, detail="page_size must be between 1 and 500")
+
+    image_library = await run_io(get_image_library)
+
+    try:
+        return await run_io(image_library.get_page, page_size, cursor, include_thumbnails)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    return reverse_matches
 
 @app.post("/search/internet")
-async def reverse_internet_search(image_s3_key:str, filename:str, sim_thresh: float = 0.9) -> ReverseImageSearchResults:
+async def reverse_internet_search(image_s3_key:str, filename:str,
+                                  sim_thresh: float = 0.9) -> ReverseImageSearchResults:
     """
     Performs a reverse image search using an image stored in an S3 bucket.
     Args:
@@ -121,16 +201,10 @@ async def reverse_internet_search(image_s3_key:str, filename:str, sim_thresh: fl
     """
     
     
-    # Download the file from S3
-    response = s3.get_object(Bucket=STORAGE_BUCKET, Key=image_s3_key)
-    file_content = response['Body'].read()
-
-    # Create BytesIO object from the file content
-    image_bytes = io.BytesIO(file_content)  
-    image = Image.open(image_bytes)
-    image = image.convert('RGB')
+    image = await load_s3_image(image_s3_key)
         
-    return internet_reverse_image_search(image, filename, sim_thresh)
+    # dominated by the SerpAPI and thumbnail downloads
+    return await run_io(internet_reverse_image_search, image, filename, sim_thresh)
 
 @app.post("/exifdata")
 async def extract_exif_data(image_s3_key:str) -> ExifDataResult:
@@ -139,30 +213,102 @@ async def extract_exif_data(image_s3_key:str) -> ExifDataResult:
     Args:
         image_s3_key (str): The S3 key of the image file.
     Returns:
-        ExifDataResult: An object containing the latitude, longitude, and timestamp extracted from the image's EXIF data.
+        ExifDataResult: An object containing the latitude, longitude, and timestamp extracted from
+            the image's EXIF data.
     Raises:
         botocore.exceptions.ClientError: If there is an error downloading the file from S3.
         PIL.UnidentifiedImageError: If the image cannot be opened and identified.
         KeyError: If the required EXIF data is not found in the image.
     """
    
-    # Download the file from S3
-    response = s3.get_object(Bucket=STORAGE_BUCKET, Key=image_s3_key)
-    file_content = response['Body'].read()
-
-    # Create BytesIO object from the file content
-    image_bytes = io.BytesIO(file_content)  
-    image = Image.open(image_bytes)
-    image = image.convert('RGB')
+    image = await load_s3_image(image_s3_key)
     
+    return await run_cpu(read_exif_data, image)
+
+def read_exif_data(image: ClaimImage) -> ExifDataResult:
+    """
+    Reads the location and time an image was taken from its EXIF data. CPU-bound, run it on the CPU
+    executor.
+    """
     lat, lon = get_lat_lon_for_img(image)
 
     img_date_time = extract_exif_gps_timestamp(image)
 
     return ExifDataResult(latitude=lat, longitude=lon, timestamp=img_date_time)
 
+@app.post("/analyze")
+async def analyze_image(image_s3_key: str, filename: Optional[str] = None, sim_thresh: float = 0.9,
+                        k: int = 100, internet_sim_thresh: Optional[float] = None,
+                        library_search: bool = True, internet_search: bool = True,
+                        exif: bool = True, labels: bool = True, generated_image: bool = True,
+                        timeout: float = ANALYZE_TIMEOUT) -> AnalysisResult:
+    """
+    Runs the requested checks of an image stored in an S3 bucket concurrently, downloading and
+    decoding the image once for all of them.
+    Args:
+        image_s3_key (str): The S3 key of the image to analyze.
+        filename (str, optional): The filename used in the internet search. Defaults to the
+            basename of the key.
+        sim_thresh (float, optional): The similarity threshold of the library and internet
+            searches. Defaults to 0.9.
+        k (int, optional): The maximum number of library images to return. Defaults to 100.
+        internet_sim_thresh (float, optional): The similarity threshold of the internet search.
+            Defaults to sim_thresh.
+        library_search (bool, optional): Whether to search the image library. Defaults to True.
+        internet_search (bool, optional): Whether to search the internet. Defaults to True.
+        exif (bool, optional): Whether to read the location and time from the EXIF data. Defaults
+            to True.
+        labels (bool, optional): Whether to detect the objects in the image. Defaults to True.
+        generated_image (bool, optional): Whether to detect if the image is AI generated. Defaults
+            to True.
+        timeout (float, optional): Seconds to wait for the checks, the checks still running are
+            reported as timed out. Defaults to ANALYZE_TIMEOUT or 60.
+    Returns:
+        AnalysisResult: The result of each check that succeeded, and the status and timing of every
+            check.
+    """
+    start = time.perf_counter()
+
+    image = await load_s3_image(image_s3_key)
+    filename = filename or os.path.basename(image_s3_key)
+
+    async def search_library():
+        image_library = await run_io(get_image_library)
+        query_features = await run_cpu(image_library._extract_image_features, image)
+        return await run_io(image_library.search_features, query_features, k=k,
+                            min_score=sim_thresh)
+
+    async def search_internet():
+        threshold = sim_thresh if internet_sim_thresh is None else internet_sim_thresh
+        return await run_io(internet_reverse_image_search, image, filename, threshold)
+
+    async def read_exif():
+        return await run_cpu(read_exif_data, image)
+
+    async def detect_labels():
+        response = await run_io(detect_labels_in_image, image)
+        return response["Labels"]
+
+    async def detect_generated():
+        return GeneratedImageResult(**await run_io(detect_generated_image, image))
+
+    checks = {
+        "library_matches": (library_search, search_library),
+        "internet_matches": (internet_search, search_internet),
+        "exif": (exif, read_exif),
+        "labels": (labels, detect_labels),
+        "generated_image": (generated_image, detect_generated),
+    }
+
+    results, statuses = await run_checks(
+        {name: check for name, (requested, check) in checks.items() if requested}, timeout=timeout)
+
+    return AnalysisResult(**results, checks=statuses,
+                          elapsed_ms=(time.perf_counter() - start) * 1000)
+
 @app.post("/predict")
-async def perform_claim_deduction(image_s3_key: str, image_filename: str, claim_report: str, claim_type: str, csim_threshold: float) -> DeductionResult:
+async def perform_claim_deduction(image_s3_key: str, image_filename: str, claim_report: str,
+                                  claim_type: str, csim_threshold: float) -> DeductionResult:
     """
     Perform claim deduction based on the provided image and claim details.
     Args:
@@ -175,17 +321,11 @@ async def perform_claim_deduction(image_s3_key: str, image_filename: str, claim_
         DeductionResult: The result of the deduction process.
     """
        
-    # Download the file from S3
-    response = s3.get_object(Bucket=STORAGE_BUCKET, Key=image_s3_key)
-    file_content = response['Body'].read()
-
-    # Create BytesIO object from the file content
-    image_bytes = io.BytesIO(file_content)  
-    image = Image.open(image_bytes)
-    image = image.convert('RGB')
+    image = await load_s3_image(image_s3_key)
     
     # Call the deduction method
-    deduction = perform_deduction(
+    deduction = await run_io(
+        perform_deduction,
         image, 
         filename=image_filename, 
         claim_report=claim_report, 
@@ -196,15 +336,75 @@ async def perform_claim_deduction(image_s3_key: str, image_filename: str, claim_
     return DeductionResult(deduction=deduction)
 
 
+def sse_event(event: str, data) -> str:
+    """
+    Formats a server-sent event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@app.post("/predict/stream")
+async def stream_claim_deduction(image_s3_key: str, image_filename: str, claim_report: str,
+                                 claim_type: str, csim_threshold: float) -> StreamingResponse:
+    """
+    Perform claim deduction like /predict, streaming its progress as server-sent events:
+        - "signal" {"name", "status", "elapsed_ms", "error"} as each piece of evidence is gathered
+        - "token" {"text"} for each chunk of the markdown-formatted deduction as it is generated
+        - "error" {"detail"} if the deduction fails
+        - "done" {} at the end of the stream
+    The events are only streamed when the API is served by an ASGI server, e.g. uvicorn in a
+    container. Behind Mangum and API Gateway the whole response is buffered until the deduction
+    finishes and the API Gateway integration timeout still applies.
+    Args:
+        image_s3_key (str): The S3 key of the image to be processed.
+        image_filename (str): The filename of the image.
+        claim_report (str): The report associated with the claim.
+        claim_type (str): The type of the claim.
+        csim_threshold (float): The threshold for the claim similarity.
+    Returns:
+        StreamingResponse: The text/event-stream of the deduction.
+    """
+
+    image = await load_s3_image(image_s3_key)
+
+    events = stream_deduction(image, filename=image_filename, claim_report=claim_report,
+                              claim_type=claim_type, csim_threshold=csim_threshold)
+
+    async def event_stream():
+        try:
+            # each step of the deduction blocks, so the events are pulled on the I/O executor
+            while (event := await run_io(next, events, None)) is not None:
+                name, data = event
+                yield sse_event(name, {"text": data} if name == "token" else data)
+        except Exception as e:
+            logger.exception(f"Deduction failed: {e}")
+            yield sse_event("error", {"detail": str(e)})
+        yield sse_event("done", {})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 @app.get("/healthcheck")
 async def healthcheck():
     """
-    Endpoint for healthcheck.
+    Endpoint for healthcheck. Reports whether the shared image encoder has been loaded and
+    warmed up.
 
     Returns:
-        dict: A dictionary with a message indicating the health status.
+        dict: A dictionary with a message indicating the health status, the load status of each
+            model, the embedding cache hit/miss counters and the OpenSearch connection reuse
+            metrics. The response status is 503 until the image encoder is ready.
     """
-    return {"message": "OK"}
+    ready = model_registry.is_ready(library_model_name)
+    content = {
+        "message": "OK" if ready else "LOADING",
+        "ready": ready,
+        "models": model_registry.get_status(),
+        "embedding_cache": get_embedding_cache().stats(),
+        "opensearch": get_connection_metrics(),
+    }
+    return JSONResponse(content=content, status_code=200 if ready else 503)
 
 handler = Mangum(app)
 
@@ -1,7 +1,9 @@
+import json
 import requests
-from typing import Optional, List
+from typing import Iterator, Optional, List
 from PIL import Image
 import io
+import mimetypes
 import os
 from requests_auth_aws_sigv4 import AWSSigV4
 from fd_api_client.models.deduction_result import DeductionResult
@@ -22,6 +24,33 @@ REQUEST_HEADERS = {
     'content-type': 'application/json',
 }
 
+def upload_temp_image(image: Image.Image, image_bytes: Optional[bytes] = None) -> str:
+    """
+    Upload an image to a temp/ key of the storage bucket for the API to read.
+
+    Args:
+        image (Image.Image): The image to upload.
+        image_bytes (bytes, optional): The original image file. It is uploaded instead of a PNG of
+            `image`, so that its EXIF data is kept.
+
+    Returns:
+        str: The S3 key of the uploaded image, to be deleted once the API is done with it.
+    """
+    if image_bytes is None:
+        buf = io.BytesIO()
+        image.save(buf, format='PNG')
+        image_bytes, content_type, extension = buf.getvalue(), 'image/png', '.png'
+    else:
+        filename = getattr(image, "filename", "") or ""
+        content_type = Image.MIME.get(
+            image.format, mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        extension = (os.path.splitext(filename)[1] or mimetypes.guess_extension(content_type)
+                     or '')
+
+    s3_key = f"temp/{uuid.uuid4()}/image{extension}"
+    s3.put_object(Bucket=STORAGE_BUCKET, Key=s3_key, Body=image_bytes, ContentType=content_type)
+    return s3_key
+
 class FraudDetectionAPIClient:
     def __init__(self, base_url: str = "http://localhost:8000"):
         if base_url:
@@ -36,19 +65,28 @@ class FraudDetectionAPIClient:
         Returns:
             dict: A dictionary containing the welcome message.
         """
-        response = requests.get(f"{self.base_url}",headers=REQUEST_HEADERS,auth=AWSSigV4('execute-api'))
+        response = requests.get(f"{self.base_url}", headers=REQUEST_HEADERS,
+                                auth=AWSSigV4('execute-api'))
         response.raise_for_status()
         return response.json()
 
-    def search_image_library(self, image: Image.Image, sim_thresh: float = 0.9) -> list[LibraryImageWithScore]:
+    def search_image_library(self, image: Image.Image, sim_thresh: float = 0.9,
+                             claim_type: Optional[str] = None,
+                             created_after: Optional[str] = None,
+                             created_before: Optional[str] = None) -> list[LibraryImageWithScore]:
        
         """
-        Search the image library for similar images. 
-        This method uploads the image to S3 rather than sending it in the HTTP request body to cope with larger files.
+        Search the image library for similar images. This method uploads the image to S3 rather
+        than sending it in the HTTP request body to cope with larger files.
 
         Args:
             image (Image.Image): The image to search for.
             sim_thresh (float, optional): Similarity threshold. Defaults to 0.9.
+            claim_type (str, optional): Only return images submitted with this claim type.
+            created_after (str, optional): Only return images added on or after this ISO date or
+                time.
+            created_before (str, optional): Only return images added on or before this ISO date or
+                time.
 
         Returns:
             list: A list of LibraryImageWithScore objects.
@@ -67,8 +105,12 @@ class FraudDetectionAPIClient:
         s3.put_object(Bucket=STORAGE_BUCKET, Key=s3_key, Body=image_bytes, ContentType='image/png')
 
         params = {'sim_thresh': sim_thresh,'image_s3_key': s3_key}
+        filters = {'claim_type': claim_type, 'created_after': created_after,
+                   'created_before': created_before}
+        params.update({name: value for name, value in filters.items() if value is not None})
         
-        response = requests.post(f"{self.base_url}searchlibrary", params=params,auth=AWSSigV4('execute-api'))
+        response = requests.post(f"{self.base_url}searchlibrary", params=params,
+                                 auth=AWSSigV4('execute-api'))
         response.raise_for_status()
         response_obj = response.json()
         lib_scores = [LibraryImageWithScore(**img) for img in response_obj]
@@ -78,18 +120,19 @@ class FraudDetectionAPIClient:
         
         return lib_scores
 
-    def reverse_internet_search(self, image: Image.Image, sim_thresh: float = 0.9) -> ReverseImageSearchResults:
+    def reverse_internet_search(self, image: Image.Image,
+                                sim_thresh: float = 0.9) -> ReverseImageSearchResults:
         """
-        Perform a reverse internet search using the provided image.
-        This method uploads the image to S3 rather than sending it in the HTTP request body to cope with larger files.
+        Perform a reverse internet search using the provided image. This method uploads the image
+        to S3 rather than sending it in the HTTP request body to cope with larger files.
         
         Args:
             image (Image.Image): The image to search for.
             sim_thresh (float, optional): Similarity threshold. Defaults to 0.9.
 
         Returns:
-            ReverseImageSearchResults: An object containing the results of the reverse image search.
-            To access the list of results, use the 'results' attribute of this object.
+            ReverseImageSearchResults: An object containing the results of the reverse image
+            search. To access the list of results, use the 'results' attribute of this object.
         """
         
         # Convert the image to bytes
@@ -104,7 +147,8 @@ class FraudDetectionAPIClient:
 
         params = {'sim_thresh': sim_thresh,'image_s3_key': s3_key,'filename': image.filename}
         
-        response = requests.post(f"{self.base_url}search/internet", params=params,auth=AWSSigV4('execute-api'),timeout=60)
+        response = requests.post(f"{self.base_url}search/internet", params=params,
+                                 auth=AWSSigV4('execute-api'), timeout=60)
         response.raise_for_status()
         reponse_obj =  ReverseImageSearchResults(**response.json())
         # Delete the temp item from S3
@@ -113,8 +157,8 @@ class FraudDetectionAPIClient:
 
     def extract_exif_data(self, image: Image.Image) -> ExifDataResult:
         """
-        Extract EXIF data from the provided image.
-        This method uploads the image to S3 rather than sending it in the HTTP request body to cope with larger files.
+        Extract EXIF data from the provided image. This method uploads the image to S3 rather than
+        sending it in the HTTP request body to cope with larger files.
 
         Args:
             image (Image.Image): The image to extract EXIF data from.
@@ -134,7 +178,8 @@ class FraudDetectionAPIClient:
         
         params = {'image_s3_key': s3_key}
         
-        response = requests.post(f"{self.base_url}exifdata", params=params,auth=AWSSigV4('execute-api'))
+        response = requests.post(f"{self.base_url}exifdata", params=params,
+                                 auth=AWSSigV4('execute-api'))
         response.raise_for_status()
       
         response_obj =  ExifDataResult(**response.json())
@@ -144,10 +189,76 @@ class FraudDetectionAPIClient:
         
         return response_obj
 
-    def perform_claim_deduction(self, image: Image.Image, claim_report: str, claim_type: str, csim_threshold: float) -> DeductionResult:
+    def analyze_image(self, image: Image.Image, image_bytes: Optional[bytes] = None,
+                      sim_thresh: float = 0.9, internet_sim_thresh: Optional[float] = None,
+                      library_search: bool = True, internet_search: bool = True, exif: bool = True,
+                      labels: bool = True, generated_image: bool = True,
+                      timeout: Optional[float] = None) -> dict:
+        """
+        Run the requested checks of an image with a single request, so the image is uploaded,
+        downloaded and decoded once for all of them. This method uploads the image to S3 rather
+        than sending it in the HTTP request body to cope with larger files.
+
+        Args:
+            image (Image.Image): The image to analyze.
+            image_bytes (bytes, optional): The original image file. It is uploaded instead of a PNG
+                of `image`, so that its EXIF data is kept.
+            sim_thresh (float, optional): Similarity threshold of the library and internet
+                searches. Defaults to 0.9.
+            internet_sim_thresh (float, optional): Similarity threshold of the internet search.
+                Defaults to sim_thresh.
+            library_search (bool, optional): Whether to search the image library. Defaults to True.
+            internet_search (bool, optional): Whether to search the internet. Defaults to True.
+            exif (bool, optional): Whether to read the location and time from the EXIF data.
+                Defaults to True.
+            labels (bool, optional): Whether to detect the objects in the image. Defaults to True.
+            generated_image (bool, optional): Whether to detect if the image is AI generated.
+                Defaults to True.
+            timeout (float, optional): Seconds the API waits for the checks. Defaults to the API's
+                default.
+
+        Returns:
+            dict: The analysis, with "library_matches" (list of LibraryImageWithScore),
+            "internet_matches" (ReverseImageSearchResults), "exif" (ExifDataResult), "labels" and
+            "generated_image" keys, None for a check that was not requested, failed or timed out,
+            and the "checks" status and timing of each check.
+        """
+        filename = getattr(image, "filename", "") or "image.png"
+        s3_key = upload_temp_image(image, image_bytes)
+
+        params = {'image_s3_key': s3_key, 'filename': filename, 'sim_thresh': sim_thresh,
+                  'library_search': library_search, 'internet_search': internet_search,
+                  'exif': exif, 'labels': labels, 'generated_image': generated_image}
+        if internet_sim_thresh is not None:
+            params['internet_sim_thresh'] = internet_sim_thresh
+        if timeout is not None:
+            params['timeout'] = timeout
+
+        try:
+            response = requests.post(f"{self.base_url}analyze", params=params,
+                                     auth=AWSSigV4('execute-api'))
+            response.raise_for_status()
+            analysis = response.json()
+        finally:
+            # Delete the temp item from S3
+            s3.delete_object(Bucket=STORAGE_BUCKET, Key=s3_key)
+
+        if analysis.get("library_matches") is not None:
+            analysis["library_matches"] = [LibraryImageWithScore(**img)
+                                           for img in analysis["library_matches"]]
+        if analysis.get("internet_matches") is not None:
+            analysis["internet_matches"] = ReverseImageSearchResults(
+                **analysis["internet_matches"])
+        if analysis.get("exif") is not None:
+            analysis["exif"] = ExifDataResult(**analysis["exif"])
+
+        return analysis
+
+    def perform_claim_deduction(self, image: Image.Image, claim_report: str, claim_type: str,
+                                csim_threshold: float) -> DeductionResult:
         """
-        Perform claim deduction based on the provided image and claim details.
-        This method uploads the image to S3 rather than sending it in the HTTP request body to cope with larger files.
+        Perform claim deduction based on the provided image and claim details. This method uploads
+        the image to S3 rather than sending it in the HTTP request body to cope with larger files.
 
         Args:
             image (Image.Image): The image related to the claim.
@@ -168,7 +279,8 @@ class FraudDetectionAPIClient:
         # Upload the image to S3
         s3.put_object(Bucket=STORAGE_BUCKET, Key=s3_key, Body=image_bytes, ContentType='image/png')
         
-        params = {'image_s3_key': s3_key,'claim_report': claim_report,'claim_type': claim_type,'csim_threshold': csim_threshold,'image_filename': image.filename}
+        params = {'image_s3_key': s3_key, 'claim_report': claim_report, 'claim_type': claim_type,
+                  'csim_threshold': csim_threshold, 'image_filename': image.filename}
 
         try:
             response = requests.post(
@@ -184,6 +296,86 @@ class FraudDetectionAPIClient:
         except requests.exceptions.RequestException as e:
             raise Exception(f"Request failed: {str(e)}")
 
+    def stream_claim_deduction(self, image: Image.Image, claim_report: str, claim_type: str,
+                               csim_threshold: float, image_bytes: Optional[bytes] = None,
+                               filename: Optional[str] = None) -> Iterator[tuple[str, dict]]:
+        """
+        Perform claim deduction, receiving its progress and the deduction as it is generated. The
+        events only arrive incrementally when the API is served by an ASGI server such as uvicorn;
+        behind API Gateway and Lambda the response is buffered and subject to the API Gateway
+        timeout. This method uploads the image to S3 rather than sending it in the HTTP request
+        body to cope with larger files.
+
+        Args:
+            image (Image.Image): The image related to the claim.
+            claim_report (str): The claim report text.
+            claim_type (str): The type of claim.
+            csim_threshold (float): The similarity threshold for claim deduction.
+            image_bytes (bytes, optional): The original image file. It is uploaded instead of a PNG
+                of `image`, so that its EXIF data is kept.
+            filename (str, optional): The filename of the image. Defaults to the filename of
+                `image`.
+
+        Yields:
+            tuple[str, dict]: The events of the deduction: ("signal", {"name", "status",
+            "elapsed_ms", "error"}) as each piece of evidence is gathered, then ("token", {"text"})
+            for each chunk of the deduction.
+
+        Raises:
+            Exception: If the request or the deduction fails.
+        """
+        filename = filename or getattr(image, "filename", "") or "image.png"
+        s3_key = upload_temp_image(image, image_bytes)
+
+        params = {'image_s3_key': s3_key, 'claim_report': claim_report, 'claim_type': claim_type,
+                  'csim_threshold': csim_threshold, 'image_filename': filename}
+
+        try:
+            with requests.post(f"{self.base_url}predict/stream", params=params,
+                               auth=AWSSigV4('execute-api'),
+                               headers={'accept': 'text/event-stream'}, stream=True) as response:
+                response.raise_for_status()
+                event = None
+
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                    elif line.startswith("data:") and event:
+                        data = json.loads(line[len("data:"):])
+                        if event == "error":
+                            raise Exception(f"Deduction failed: {data['detail']}")
+                        if event == "done":
+                            return
+                        yield event, data
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Request failed: {str(e)}")
+        finally:
+            # Delete the temp item from S3
+            s3.delete_object(Bucket=STORAGE_BUCKET, Key=s3_key)
+
+    def list_image_library(self, page_size: int = 50, cursor: Optional[str] = None,
+                           include_thumbnails: bool = True) -> dict:
+        """
+        List one page of the image library.
+
+        Args:
+            page_size (int, optional): The maximum number of images per page. Defaults to 50.
+            cursor (str, optional): The next_cursor of the previous page. Defaults to the first
+                page.
+            include_thumbnails (bool, optional): Whether to include thumbnails. Defaults to True.
+
+        Returns:
+            dict: The page, with "images", "next_cursor" and "total" keys.
+        """
+        params = {'page_size': page_size, 'include_thumbnails': include_thumbnails}
+        if cursor:
+            params['cursor'] = cursor
+
+        response = requests.get(f"{self.base_url}library", params=params,
+                                auth=AWSSigV4('execute-api'))
+        response.raise_for_status()
+        return response.json()
+
     def healthcheck(self) -> dict:
         """
         Perform a healthcheck on the API.
@@ -1,16 +1,13 @@
 
 
-import io
 import os
 import re
-import string
 from datetime import datetime
 import sys
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 
-from typing import Optional
 import uuid
 import PIL
 import boto3
@@ -22,18 +19,16 @@ from dotenv import load_dotenv
 from geopy.distance import geodesic as GD
 from streamlit_cognito_auth import CognitoHostedUIAuthenticator
 from exifdata import get_lat_lon_for_img, get_exif, extract_exif_gps_timestamp
-from generated_image_detector import detect_generated_image,does_endpoint_exist
 from map import address_lookup
 from paths import get_paths
-from rekognition import detect_labels_in_image, display_labels_in_image
-from websearch import reverse_image_search
+from rekognition import display_labels_in_image
 from chat_agent import FraudDetectionAgent, get_claim_image_description
 from image_library import S3ImageLibrary
 from paths import is_running_on_ecs
 from util.s3 import url_to_base64, generate_presigned_url
-from claim_deduction import perform_deduction
-from schemas.schemas import ReverseImageSearchResults
 from api_client import FraudDetectionAPIClient
+from claim_deduction import stream_deduction
+from claim_image import ClaimImage
 
 st.set_page_config(  # Alternate names: setup_page, page, layout
     # Can be "centered" or "wide". In the future also "dashboard", etc.
@@ -55,7 +50,8 @@ try:
     print("API is healthy")
 except Exception as e:
     st.error(
-        f"An error occurred while connecting to the API: {e}. Please check the API endpoint and try again.")
+        f"An error occurred while connecting to the API: {e}. "
+        f"Please check the API endpoint and try again.")
     st.stop()
 
 cognito_domain = os.getenv('COGNITO_DOMAIN')
@@ -101,18 +97,44 @@ location = st.empty()
 TESTDATA_FOLDER, IMAGES_FOLDER, DATA_PATH = get_paths()
 
 
+def reset_library_page():
+    st.session_state.library_cursors = [None]
+
+
 def render_image_library():
 
     st.title("Image Library")
     image_library = S3ImageLibrary()
-    df_library = image_library.to_dataframe()
+
+    # cursors of the pages visited so far, the last one being the current page
+    if "library_cursors" not in st.session_state:
+        st.session_state.library_cursors = [None]
+
+    page_size = st.selectbox("Images per page", [25, 50, 100], index=1,
+                             on_change=reset_library_page)
+    cursors = st.session_state.library_cursors
+
+    # only the current page is read from DynamoDB and has its thumbnails loaded
+    page = image_library.get_page(page_size, cursors[-1], include_thumbnails=False)
+    df_library = image_library.format_df(
+        pd.DataFrame([image.model_dump() for image in page.images]))
     df_library.drop(columns=['similarity'], inplace=True)
 
+    st.caption(f"{page.total} images in the library - page {len(cursors)}")
+
     st.dataframe(df_library, column_config={
         "thumbnail": st.column_config.ImageColumn(
             "Thumbnail", width="large"
         )}, hide_index=True)
 
+    col_prev, col_next = st.columns(2)
+    if col_prev.button("Previous page", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.rerun()
+    if col_next.button("Next page", disabled=page.next_cursor is None):
+        cursors.append(page.next_cursor)
+        st.rerun()
+
     with st.expander("Add New Image", expanded=False):
         new_image_form = st.form("add_image_form")
         uploaded_file = st.file_uploader(
@@ -129,10 +151,16 @@ def render_image_library():
             image_library.add_image(
                 uploaded_image, filename=uploaded_file.name)
             uploaded_file = None
+            reset_library_page()
             st.rerun()
 
-    st.button("Clear Image Library", help="Clears the entire image library. WARNING: Cannot be reversed.",
-              on_click=image_library.clear_library)
+    def clear_library():
+        image_library.clear_library()
+        reset_library_page()
+
+    st.button("Clear Image Library",
+              help="Clears the entire image library. WARNING: Cannot be reversed.",
+              on_click=clear_library)
 
 
 @ st.cache_data()
@@ -168,20 +196,52 @@ def get_email_by_username(username):
         return None
 
 
-@ st.cache_data(show_spinner="Performing fraud analysis...")
-def perform_deduction_cached(_image: Optional[PIL.Image.Image], filename: str, claim_report: str, claim_type: str, csim_threshold=0.85):
-    # if _image:
-    #     return api_client.perform_claim_deduction(claim_report=claim_report, claim_type=claim_type, csim_threshold=csim_threshold,image=_image).deduction
-    return perform_deduction(
-        image=_image, filename=filename, claim_report=claim_report, claim_type=claim_type, csim_threshold=csim_threshold)
+def stream_claim_deduction(image_bytes: bytes, filename: str, claim_report: str, claim_type: str,
+                           csim_threshold=0.85) -> str:
+    """
+    Shows the progress of the fraud analysis as each piece of evidence is gathered, then writes the
+    deduction as it is generated. The deduction runs in-process rather than through the API: the
+    API is served by Lambda behind API Gateway, which buffers the response and times out after
+    ~29s, so /predict/stream only streams where the API runs on a server such as uvicorn.
+    """
+    progress = st.status("Gathering evidence...", expanded=True)
+
+    def deduction_text():
+        gathering = True
+        for event, data in stream_deduction(
+                image=ClaimImage(image_bytes, filename=filename), filename=filename,
+                claim_report=claim_report, claim_type=claim_type, csim_threshold=csim_threshold):
+            if event == "signal":
+                icon = '✅' if data["status"] == "ok" else '❔'
+                name = data["name"].replace("_", " ").capitalize()
+                progress.write(
+                    f'{icon} {name}: {data["status"]} in {round(data["elapsed_ms"] / 1000, 1)}s')
+            elif event == "token":
+                if gathering:
+                    progress.update(label="Evidence gathered", state="complete", expanded=False)
+                    gathering = False
+                yield data
+
+    return st.write_stream(deduction_text())
+
+
+def check_succeeded(analysis: dict, check: str) -> bool:
+    """
+    Returns whether a check of an image analysis succeeded, showing a warning if it failed or timed
+    out.
+    """
+    status = analysis["checks"].get(check)
 
+    if status is None:
+        return False
 
-@ st.cache_data(show_spinner="Performing reverse image search...")
-def get_reverse_img_search_results(_img: PIL.Image, filename: string, sim_thresh=0)->ReverseImageSearchResults:
+    if status["status"] == "timeout":
+        st.warning(f'❔ The check timed out after {round(status["elapsed_ms"] / 1000)}s, '
+                   f'please try again.')
+    elif status["status"] != "ok":
+        st.warning(f'❗ The check failed: {status["error"]}')
 
-    # Fetch the dataframe
-    # return api_client.reverse_internet_search_search_internet_post(image_file=img_byte_arr, sim_thresh=sim_thresh).results
-    return reverse_image_search(_img, filename, sim_thresh)
+    return status["status"] == "ok"
 
 
 def reinit_chat_session():
@@ -203,7 +263,8 @@ def validate_gps_coordinates(coord_str: str):
     """
     # Regular expression to check for a valid format
     pattern = re.compile(
-        r'^([-+]?[1-8]?\d(\.\d+)?|90(\.0+)?),\s*([-+]?(180(\.0+)?|((1[0-7]\d)|([1-9]?\d))(\.\d+)?))$')
+        r'^([-+]?[1-8]?\d(\.\d+)?|90(\.0+)?),\s*'
+        r'([-+]?(180(\.0+)?|((1[0-7]\d)|([1-9]?\d))(\.\d+)?))$')
     match = pattern.match(coord_str)
 
     if match:
@@ -294,7 +355,10 @@ if __name__ == "__main__":
             ("Motor Vehicle",  "Home & Contents"),
         )
         claim_report = claim_form.text_area(
-            "Claim report", value="", placeholder="Please provide details of the claim, like location where the incident occurred, date and time of incident, circumstances of the incident, any witnesses or police reports, etc.")
+            "Claim report", value="",
+            placeholder="Please provide details of the claim, like location where the incident "
+                        "occurred, date and time of incident, circumstances of the incident, any "
+                        "witnesses or police reports, etc.")
 
         run_similarity = claim_form.checkbox("Run similarity search")
 
@@ -309,14 +373,26 @@ if __name__ == "__main__":
 
         with tab_data_checks:
 
-            tab_similarity, tab_exif, tab_labels, tab_gen_image, tab_ai_deduction, tab_image_library = st.tabs(
-                ["Image Similarity", "EXIF Data", "Object Detection", "Generated Image Detection", "AI Fraud Detection", "Manage Image Library"])
+            (tab_similarity, tab_exif, tab_labels, tab_gen_image, tab_ai_deduction,
+             tab_image_library) = st.tabs(
+                ["Image Similarity", "EXIF Data", "Object Detection", "Generated Image Detection",
+                 "AI Fraud Detection", "Manage Image Library"])
+
+            analysis = None
 
             if asset_file:
                 img = PIL.Image.open(asset_file)
-            #     img_byte_arr = io.BytesIO()
-            #     img.save(img_byte_arr, format=img.format)
-            #     img_byte_arr = img_byte_arr.getvalue()
+
+                # one request runs all the selected checks concurrently on the uploaded file
+                if submit_btn and (run_similarity or run_location or run_object_detection
+                                   or run_generated_image_detection):
+                    with st.spinner("Analyzing image..."):
+                        analysis = api_client.analyze_image(
+                            img, image_bytes=asset_file.getvalue(), sim_thresh=sim_thresh,
+                            internet_sim_thresh=0, library_search=run_similarity,
+                            internet_search=run_similarity, exif=run_location,
+                            labels=run_object_detection,
+                            generated_image=run_generated_image_detection)
 
             with tab_similarity:
 
@@ -325,61 +401,66 @@ if __name__ == "__main__":
                         if asset_file:
 
                             st.subheader("Image Library Similarity Search")
-                            
-                            png_image = io.BytesIO()
-                            img.save(png_image, format='PNG')
-                            png_image.seek(0)
-                            png_image = PIL.Image.open(png_image)
-                          
-                            reverse_matches = api_client.search_image_library(image=png_image, sim_thresh=sim_thresh)
-
-                            if len(reverse_matches) > 0:
-                                st.caption(
-                                    f'❗{len(reverse_matches)} image(s) have a high similarity score - please review')
 
-                                display_matches = []
+                            if check_succeeded(analysis, "library_matches"):
+                                reverse_matches = analysis["library_matches"]
+
+                                if len(reverse_matches) > 0:
+                                    st.caption(
+                                        f'❗{len(reverse_matches)} image(s) have a high '
+                                        f'similarity score - please review')
 
-                                for match in reverse_matches:
-                                    # Generate the Base64 from presigned URL
-                                    img_url = url_to_base64(generate_presigned_url(
-                                        STORAGE_BUCKET, match.thumbnail_s3_key))
-                                    display_matches.append(
-                                        {"Filename": match.filename, "Similarity": match.score, "Thumbnail": img_url})
+                                    display_matches = []
 
-                                st.dataframe(pd.DataFrame(display_matches), column_config={
-                                    "Thumbnail": st.column_config.ImageColumn(
-                                        "Thumbnail", width="large")}, hide_index=True)
+                                    for match in reverse_matches:
+                                        # Generate the Base64 from presigned URL
+                                        img_url = url_to_base64(generate_presigned_url(
+                                            STORAGE_BUCKET, match.thumbnail_s3_key))
+                                        display_matches.append(
+                                            {"Filename": match.filename, "Similarity": match.score,
+                                             "Thumbnail": img_url})
 
-                            else:
-                                st.info(
-                                    f'✅ No images with high similarity scores were found in the image library.')
+                                    st.dataframe(pd.DataFrame(display_matches), column_config={
+                                        "Thumbnail": st.column_config.ImageColumn(
+                                            "Thumbnail", width="large")}, hide_index=True)
+
+                                else:
+                                    st.info(
+                                        f'✅ No images with high similarity scores were found '
+                                        f'in the image library.')
 
                             st.subheader("Internet Reverse Image Search")
-                            reverse_search_results = get_reverse_img_search_results(
-                                img, asset_file.name, 0).results
+                            if check_succeeded(analysis, "internet_matches"):
+                                reverse_search_results = analysis["internet_matches"].results
 
-                            reverse_match_count = sum(result.csim is not None and result.csim > sim_thresh for result in reverse_search_results)
+                                reverse_match_count = sum(
+                                    result.csim is not None and result.csim > sim_thresh
+                                    for result in reverse_search_results)
 
-                            if reverse_match_count > 0:
-                                st.caption(
-                                    f'❗{reverse_match_count} image(s) have a high similarity score - please review')
-                            else:
-                                st.info(
-                                    f'✅ No images with high similarity scores were found on the internet.')
+                                if reverse_match_count > 0:
+                                    st.caption(
+                                        f'❗{reverse_match_count} image(s) have a high '
+                                        f'similarity score - please review')
+                                else:
+                                    st.info(
+                                        f'✅ No images with high similarity scores were found '
+                                        f'on the internet.')
 
-                            reverse_search_df = pd.DataFrame(
-                                [result.model_dump() for result in reverse_search_results])
+                                reverse_search_df = pd.DataFrame(
+                                    [result.model_dump() for result in reverse_search_results])
                            
-                            st.dataframe(reverse_search_df,
-                                         column_order=[
-                                             "csim", "data_url", "source", "link", "title",  "thumbnail"],
-                                         column_config={
-                                             "data_url": st.column_config.ImageColumn(
-                                                 "Image", width="large"
-                                             ),
-                                             "csim": st.column_config.NumberColumn("Similarity", format="%.2f"),
-                                             "link": st.column_config.LinkColumn("link")
-                                         }, hide_index=True)
+                                st.dataframe(reverse_search_df,
+                                             column_order=[
+                                                 "csim", "data_url", "source", "link", "title",
+                                                 "thumbnail"],
+                                             column_config={
+                                                 "data_url": st.column_config.ImageColumn(
+                                                     "Image", width="large"
+                                                 ),
+                                                 "csim": st.column_config.NumberColumn(
+                                                     "Similarity", format="%.2f"),
+                                                 "link": st.column_config.LinkColumn("link")
+                                             }, hide_index=True)
 
                         else:
                             st.warning("Please upload a valid image file.")
@@ -389,11 +470,11 @@ if __name__ == "__main__":
                 col1, col2 = st.columns(2)
 
                 with col1:
-                    if run_location:
-                        if asset_file:
+                    if submit_btn and run_location:
+                        if asset_file and check_succeeded(analysis, "exif"):
                             img2 = PIL.Image.open(asset_file)
                             
-                            exif_result = api_client.extract_exif_data(image=img2)
+                            exif_result = analysis["exif"]
 
                             lat, lon = exif_result.latitude, exif_result.longitude
 
@@ -417,7 +498,9 @@ if __name__ == "__main__":
 
                                         if minutes_difference > 60:
                                             st.warning(
-                                                f'❗ Claim timestamp and image timestamp differs by {round(minutes_difference / 60, 2)} hour(s). Please review.')
+                                                f'❗ Claim timestamp and image timestamp differs '
+                                                f'by {round(minutes_difference / 60, 2)} '
+                                                f'hour(s). Please review.')
                                         else:
                                             st.info(
                                                 '✅ Claim timestamp and image timestamp match.')
@@ -440,13 +523,15 @@ if __name__ == "__main__":
                                 if claim_lat and claim_lon:
 
                                     st.caption(
-                                        f'Claim address lookup: {address_lookup(claim_lat, claim_lon)}')
-                                    distance = round(
-                                        float(GD((lat, lon), (float(claim_lat), float(claim_lon))).km), 2)
+                                        f'Claim address lookup: '
+                                        f'{address_lookup(claim_lat, claim_lon)}')
+                                    distance = round(float(GD(
+                                        (lat, lon), (float(claim_lat), float(claim_lon))).km), 2)
 
                                     if distance > 0.1:
                                         st.warning(
-                                            f'❗Distance between claim and GPS data in image is {distance}km, please review.')
+                                            f'❗Distance between claim and GPS data in image is '
+                                            f'{distance}km, please review.')
                                     else:
                                         st.info(
                                             '✅ Location in image and claim matches.')
@@ -478,17 +563,17 @@ if __name__ == "__main__":
 
                             st.caption(f'Exif data {exif_data}')
 
-                        else:
+                        elif not asset_file:
                             st.warning("Please upload a valid image file.")
 
             with tab_labels:
-                if submit_btn and asset_file and run_object_detection:
+                if (submit_btn and asset_file and run_object_detection
+                        and check_succeeded(analysis, "labels")):
                     labels = [s.strip().lower()
                               for s in labels_text.split(',')]
-                    rekog_response = detect_labels_in_image(
-                        img, confidence_thresh)
-                    labels_above_threshold = [label['Name'] for label in rekog_response['Labels'] if
-                                              label['Confidence'] >= confidence_thresh]
+                    rekog_response = {"Labels": analysis["labels"]}
+                    labels_above_threshold = [label['Name'] for label in rekog_response['Labels']
+                                              if label['Confidence'] >= confidence_thresh]
                     detected_labels = [s.strip().lower()
                                        for s in labels_above_threshold]
 
@@ -516,16 +601,13 @@ if __name__ == "__main__":
 
             with tab_gen_image:
                 if submit_btn and asset_file and run_generated_image_detection:
-                    if not does_endpoint_exist():
-                        st.warning(
-                            '❗SageMaker endpoint does not exist. Please contact your administrator.')
-                    else:
-                        detection_result = detect_generated_image(
-                            PIL.Image.open(asset_file))
+                    if check_succeeded(analysis, "generated_image"):
+                        detection_result = analysis["generated_image"]
                         if detection_result["confidence"] < 0.99:
                             st.warning(
                                 f'❗Unable to tell if image was generated from AI, please review.')
-                        elif detection_result["confidence"] > 0.99 and detection_result["prediction"] == 'FAKE':
+                        elif (detection_result["confidence"] > 0.99
+                              and detection_result["prediction"] == 'FAKE'):
                             st.warning(
                                 f'❗Image possibly generated from AI, please review.')
 
@@ -533,7 +615,8 @@ if __name__ == "__main__":
                             st.info(f'✅ Image was not generated from AI.')
 
                         st.caption(
-                            f'Class: {detection_result["prediction"]} Confidence: {round((detection_result["confidence"] * 100), 2)}%')
+                            f'Class: {detection_result["prediction"]} '
+                            f'Confidence: {round((detection_result["confidence"] * 100), 2)}%')
 
             with tab_ai_deduction:
                 with st.form(key="fraud_deduction_form"):
@@ -546,14 +629,11 @@ if __name__ == "__main__":
                             st.warning("Please provide claim report")
                         else:
 
-                            img_file = None
-
                             if asset_file:
-                                img_file = PIL.Image.open(asset_file)
-                                deduction = perform_deduction_cached(
-                                    _image=img_file, filename=asset_file.name, claim_report=claim_report, claim_type=claim_type, csim_threshold=sim_thresh)
-                                st.markdown(
-                                    deduction, unsafe_allow_html=True)
+                                stream_claim_deduction(
+                                    image_bytes=asset_file.getvalue(), filename=asset_file.name,
+                                    claim_report=claim_report, claim_type=claim_type,
+                                    csim_threshold=sim_thresh)
 
             with tab_image_library:
                 render_image_library()
@@ -647,7 +727,8 @@ if __name__ == "__main__":
 
                         with st.chat_message("assistant"):
                             response = st.write_stream(agent.invoke_agent(
-                                st.session_state.sessionId, prompt, st.session_state.is_new_session, image_descriptions))
+                                st.session_state.sessionId, prompt,
+                                st.session_state.is_new_session, image_descriptions))
 
                             # Add assistant response to chat history
                         st.session_state.messages.append(
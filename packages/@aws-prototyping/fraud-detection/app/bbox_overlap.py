@@ -0,0 +1,176 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Above this many boxes `overlapping_pairs` switches from the dense (N, N) IoU
+# matrix to a sort-and-sweep over the x-intervals.
+SWEEP_MIN_BOXES = 512
+
+
+def _as_boxes(boxes) -> np.ndarray:
+    boxes = np.asarray(boxes, dtype=np.float64)
+    return boxes.reshape(-1, 4)
+
+
+def box_areas(boxes) -> np.ndarray:
+    """Area of each (xmin, ymin, xmax, ymax) box.
+
+    Parameters
+    ----------
+    boxes : array-like
+        (N, 4) box co-ordinates.
+
+    Returns
+    -------
+    np.ndarray
+        (N,) areas.
+
+    """
+
+    boxes = _as_boxes(boxes)
+    return (boxes[:, 2] - boxes[:, 0]).clip(0) * (boxes[:, 3] - boxes[:, 1]).clip(0)
+
+
+def pairwise_iou(boxes_a, boxes_b=None) -> np.ndarray:
+    """Intersection over Union (IoU) of every pair of boxes.
+
+    Parameters
+    ----------
+    boxes_a : array-like
+        (N, 4) box co-ordinates in (xmin, ymin, xmax, ymax) format.
+    boxes_b : array-like, default=None
+        (M, 4) box co-ordinates. Defaults to `boxes_a`.
+
+    Returns
+    -------
+    np.ndarray
+        (N, M) IoU matrix.
+
+    """
+
+    boxes_a = _as_boxes(boxes_a)
+    boxes_b = boxes_a if boxes_b is None else _as_boxes(boxes_b)
+
+    lt = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    rb = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    wh = (rb - lt).clip(0)
+    inter = wh[..., 0] * wh[..., 1]
+    union = box_areas(boxes_a)[:, None] + box_areas(boxes_b)[None, :] - inter
+
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def paired_iou(boxes_a, boxes_b) -> np.ndarray:
+    """IoU of each box in `boxes_a` with the box at the same index in
+    `boxes_b`.
+
+    Parameters
+    ----------
+    boxes_a : array-like
+        (N, 4) box co-ordinates.
+    boxes_b : array-like
+        (N, 4) box co-ordinates.
+
+    Returns
+    -------
+    np.ndarray
+        (N,) IoU values.
+
+    """
+
+    boxes_a = _as_boxes(boxes_a)
+    boxes_b = _as_boxes(boxes_b)
+
+    lt = np.maximum(boxes_a[:, :2], boxes_b[:, :2])
+    rb = np.minimum(boxes_a[:, 2:], boxes_b[:, 2:])
+    wh = (rb - lt).clip(0)
+    inter = wh[:, 0] * wh[:, 1]
+    union = box_areas(boxes_a) + box_areas(boxes_b) - inter
+
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def _dense_pairs(boxes: np.ndarray, thresh: float):
+    iou = pairwise_iou(boxes)
+    i, j = np.triu_indices(len(boxes), k=1)
+    ious = iou[i, j]
+    mask = ious > thresh
+    return np.stack([i[mask], j[mask]], axis=1), ious[mask]
+
+
+def _sweep_pairs(boxes: np.ndarray, thresh: float, chunk_pairs: int = 1_000_000):
+    # sort by xmin: the boxes whose x-interval can overlap box k in sorted
+    # order are exactly those after it whose xmin is below its xmax
+    order = np.argsort(boxes[:, 0], kind="stable")
+    sorted_boxes = boxes[order]
+    end = np.searchsorted(sorted_boxes[:, 0], sorted_boxes[:, 2], side="left")
+    counts = np.maximum(end - np.arange(len(boxes)) - 1, 0)
+    cum_counts = np.cumsum(counts)
+
+    pairs, ious = [], []
+    start = 0
+
+    # generate the candidate pairs in chunks to bound the memory used
+    while start < len(boxes):
+        done = cum_counts[start - 1] if start > 0 else 0
+        stop = np.searchsorted(cum_counts, done + chunk_pairs, side="right")
+        stop = min(max(stop, start + 1), len(boxes))
+        chunk_counts = counts[start:stop]
+        first = np.repeat(np.arange(start, stop), chunk_counts)
+        chunk_starts = np.cumsum(chunk_counts) - chunk_counts
+        offsets = np.arange(len(first)) - np.repeat(chunk_starts, chunk_counts)
+        second = first + 1 + offsets
+
+        chunk_ious = paired_iou(sorted_boxes[first], sorted_boxes[second])
+        mask = chunk_ious > thresh
+        pairs.append(np.stack([order[first[mask]], order[second[mask]]], axis=1))
+        ious.append(chunk_ious[mask])
+        start = stop
+
+    pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+    ious = np.concatenate(ious) if ious else np.empty(0)
+
+    # report each pair as (i, j) with i < j, in lexicographic order
+    pairs = np.sort(pairs, axis=1)
+    idx = np.lexsort((pairs[:, 1], pairs[:, 0]))
+
+    return pairs[idx], ious[idx]
+
+
+def overlapping_pairs(boxes, thresh: float = 0.0, method: str = "auto"):
+    """Find the pairs of boxes whose IoU is above `thresh`.
+
+    Parameters
+    ----------
+    boxes : array-like
+        (N, 4) box co-ordinates in (xmin, ymin, xmax, ymax) format.
+    thresh : float, default=0.0
+        Report pairs with an IoU strictly greater than this, i.e. any pair
+        with a non-empty intersection by default.
+    method : str, default="auto"
+        "dense" computes the full IoU matrix, "sweep" only scores the pairs
+        whose x-intervals overlap. "auto" uses "sweep" above SWEEP_MIN_BOXES
+        boxes.
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        A (K, 2) array of (i, j) index pairs with i < j, and their (K,) IoU
+        values.
+
+    """
+
+    boxes = _as_boxes(boxes)
+
+    if method == "auto":
+        method = "sweep" if len(boxes) > SWEEP_MIN_BOXES else "dense"
+
+    if method == "dense":
+        return _dense_pairs(boxes, thresh)
+    if method == "sweep":
+        return _sweep_pairs(boxes, thresh)
+
+    raise ValueError(f"Unknown method '{method}', expected 'auto', 'dense' or 'sweep'")
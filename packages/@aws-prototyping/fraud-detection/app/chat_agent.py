@@ -1,16 +1,15 @@
 import base64
-from io import BytesIO
 import json
 import os
 from typing import List, Optional
 
 import boto3
 from botocore.exceptions import ClientError
-import PIL
 from PIL.Image import Image
 from datetime import datetime
 from dotenv import load_dotenv
 from websearch import reverse_image_search
+from claim_image import ClaimImage
 
 load_dotenv()
 
@@ -18,34 +17,25 @@ AGENT_ID = os.environ.get("AGENT_ID", "CKLEWQHZC5")
 AGENT_ALIAS_ID = os.environ.get("AGENT_ALIAS_ID", "QGW4VRNITE")
 
 
-def get_claim_image_description(claim_image: Image) -> str:
+def get_claim_image_description(claim_image: Image | ClaimImage) -> str:
     """
     Processes an insurance claim image and returns a detailed description.
 
-    This function resizes the input image to a maximum of 1024x1024 pixels while maintaining the aspect ratio,
-    converts the image to a base64-encoded string, and sends it to an AI model for detailed description.
-    The description focuses on objects, environment, and the state of objects in the image, providing intelligent
-    guesses on how the objects got to their current state.
+    This function resizes the input image to a maximum of 1024x1024 pixels while maintaining the
+    aspect ratio, converts the image to a base64-encoded string, and sends it to an AI model for
+    detailed description. The description focuses on objects, environment, and the state of objects
+    in the image, providing intelligent guesses on how the objects got to their current state.
 
     Args:
-        claim_image (Image): A PIL.Image object representing the insurance claim image.
+        claim_image (Image | ClaimImage): The insurance claim image. The 1024px JPEG rendition of a
+            ClaimImage is reused if it has already been encoded.
 
     Returns:
         str: A detailed description of the image provided by the AI model.
     """
 
-    # Resize the image to a max of 1024x1024, maintaining the aspect ratio
-    claim_image.thumbnail((1024, 1024), PIL.Image.LANCZOS)
-
-    # Create a BytesIO object to hold the image data
-
-    image_bytes_io = BytesIO()
-
-    # Save the PIL.Image object to the BytesIO object
-    claim_image.save(image_bytes_io, format='JPEG')
-
-    # Get the image bytes from the BytesIO object
-    image_bytes = image_bytes_io.getvalue()
+    # The image resized to a max of 1024x1024, maintaining the aspect ratio, as JPEG
+    image_bytes = ClaimImage.wrap(claim_image).description_jpeg
 
     # Encode the image bytes as a base64 string
     encoded_image = base64.b64encode(image_bytes).decode('utf-8')
@@ -68,7 +58,14 @@ def get_claim_image_description(claim_image: Image) -> str:
                     },
                     {
                         "type": "text",
-                        "text": "You are inspecting photos submitted for insurance claims. Describe the image in detail. Focus on objects, environment and the state of objects in the image. Provide intelligent guesses on how the objects in the image got to the state they are in. Do not mention anything about speculating or privacy, only provide a professional description."
+                        "text": (
+                            "You are inspecting photos submitted for insurance claims. Describe "
+                            "the image in detail. Focus on objects, environment and the state of "
+                            "objects in the image. Provide intelligent guesses on how the objects "
+                            "in the image got to the state they are in. Do not mention anything "
+                            "about speculating or privacy, only provide a professional "
+                            "description."
+                        )
                     }
                 ]
             }
@@ -127,7 +124,8 @@ class FraudDetectionAgent:
         prompt += f"The current date/time is: {current_datetime}\n"
 
         if len(claim_image_descriptions) > 0:
-            prompt += "The user uploaded photos as part of the claim. The descriptions of the photos are as follows:\n"
+            prompt += ("The user uploaded photos as part of the claim. The descriptions of the "
+                       "photos are as follows:\n")
             for claim_image_description in claim_image_descriptions:
                 prompt += f"<ImageDescription>{claim_image_description}</ImageDescription>\n"
 
@@ -151,7 +149,8 @@ class FraudDetectionAgent:
 
         return input_string
 
-    def invoke_agent(self, session_id, prompt, is_new_session: bool, claim_image_descriptions: List[str] = []):
+    def invoke_agent(self, session_id, prompt, is_new_session: bool,
+                     claim_image_descriptions: List[str] = []):
         """
         Sends a prompt for the agent to process and respond to.
 
@@ -1,17 +1,45 @@
+import os
+import time
 from datetime import datetime
-from typing import Optional
+from typing import Any, Iterator, Optional
 import PIL
-import pandas as pd
+from loguru import logger
 from chat_agent import get_claim_image_description
 from langchain_aws import ChatBedrock
 from langchain_core.prompts import PromptTemplate
 from websearch import reverse_image_search
 from exifdata import get_lat_lon_for_img, extract_exif_gps_timestamp
 from map import address_lookup
-from image_library import S3ImageLibrary
+from image_library import get_image_library
+from claim_image import ClaimImage
+from schemas.schemas import CheckResult
 from generated_image_detector import detect_generated_image,does_endpoint_exist
+from analysis import iter_checks
 import random
 
+# Seconds to wait for each piece of evidence before the deduction goes ahead without it
+DEDUCTION_SIGNAL_TIMEOUT = float(os.environ.get("DEDUCTION_SIGNAL_TIMEOUT", "30"))
+
+SIGNAL_TIMEOUTS = {
+    "location": DEDUCTION_SIGNAL_TIMEOUT,
+    "timestamp": DEDUCTION_SIGNAL_TIMEOUT,
+    "generated_image": DEDUCTION_SIGNAL_TIMEOUT,
+    "image_description": DEDUCTION_SIGNAL_TIMEOUT,
+    # SerpAPI and the download of every result
+    "internet_matches": 2 * DEDUCTION_SIGNAL_TIMEOUT,
+    "library_matches": DEDUCTION_SIGNAL_TIMEOUT,
+}
+
+# How each piece of evidence is described to the LLM when it is missing
+SIGNAL_DESCRIPTIONS = {
+    "location": "location of the image from its EXIF data",
+    "timestamp": "date and time the image was taken from its EXIF data",
+    "generated_image": "generated image detection",
+    "image_description": "description of the image",
+    "internet_matches": "internet search for similar images",
+    "library_matches": "search for similar images in previous claims",
+}
+
 
 def get_random_weather() -> str:
     """
@@ -28,7 +56,8 @@ def get_random_weather() -> str:
 
     # Generate a random number between 7 and 35
     temperature = random.randint(7, 35)
-    # Randmly select a weather condition - using the format similar to "30 degrees, sunny, light winds"
+    # Randmly select a weather condition - using the format similar to
+    # "30 degrees, sunny, light winds"
 
     weather_conditions = [
         f"{temperature} degrees, sunny, light winds",
@@ -46,17 +75,75 @@ def get_random_weather() -> str:
     return random.choice(weather_conditions)
 
 
-def perform_deduction(image: Optional[PIL.Image.Image], filename: str, claim_report: str, claim_type: str, csim_threshold:float=0.85) -> str:
+def iter_signals(image: ClaimImage, filename: str,
+                 csim_threshold: float) -> Iterator[tuple[str, Any, CheckResult]]:
+    '''
+    Gathers the evidence about a claim image concurrently, each piece with its own timeout. A check
+    that fails or times out does not affect the others.
+    Args:
+        image (ClaimImage): The image associated with the claim.
+        filename (str): The filename of the image. The internet search is skipped without one.
+        csim_threshold (float): The cosine similarity threshold of the image library search.
+    Yields:
+        tuple[str, Any, CheckResult]: The name of each check, one of SIGNAL_TIMEOUTS, its result
+            (None unless it succeeded) and its status and timing, as soon as it completes.
+    '''
+    def locate():
+        lat, lon = get_lat_lon_for_img(image)
+        if lat and lon:
+            return lat, lon, address_lookup(lat=lat, lon=lon)
+        return None
+
+    def detect_generated():
+        if does_endpoint_exist():
+            return detect_generated_image(img=image)
+        return None
+
+    signals = {
+        "location": locate,
+        "timestamp": lambda: extract_exif_gps_timestamp(image),
+        "generated_image": detect_generated,
+        "image_description": lambda: get_claim_image_description(image),
+        "library_matches": lambda: get_image_library().search_images(
+            image, min_score=csim_threshold),
+    }
+
+    if len(filename) > 0:
+        signals["internet_matches"] = lambda: reverse_image_search(
+            image=image, filename=filename, sim_thresh=0)
+
+    start = time.perf_counter()
+    statuses = {}
+
+    for name, result, status in iter_checks(signals, SIGNAL_TIMEOUTS):
+        statuses[name] = status
+        yield name, result, status
+
+    slowest = max(statuses, key=lambda name: statuses[name].elapsed_ms)
+    n_ok = sum(status.status == "ok" for status in statuses.values())
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    logger.info(f"Gathered {n_ok}/{len(statuses)} signals in {elapsed_ms:.0f}ms, "
+                f"critical path: {slowest} ({statuses[slowest].elapsed_ms:.0f}ms)")
+
+
+def stream_deduction(image: Optional[PIL.Image.Image | ClaimImage], filename: str,
+                     claim_report: str, claim_type: str,
+                     csim_threshold:float=0.85) -> Iterator[tuple[str, Any]]:
     '''
-    Perform deduction to determine if an insurance claim is fraudulent based on the provided image, filename, claim report, and claim type.
+    Perform deduction to determine if an insurance claim is fraudulent, reporting its progress as
+    it goes. See `perform_deduction`.
     Args:
-        image (Optional[PIL.Image.Image]): The image associated with the claim.
+        image (Optional[PIL.Image.Image | ClaimImage]): The image associated with the claim.
         filename (str): The filename of the image.
         claim_report (str): The detailed report of the insurance claim.
-        claim_type (str): The type of insurance claim (e.g., motor vehicle accident, theft, damage).
-        csim_threshold (float, optional): The cosine similarity threshold for image matching. Defaults to 0.85.
-    Returns:
-        str: A markdown-formatted string containing the deduction results, including a summary of the claim report and a determination of whether the claim is fraudulent, inconclusive, or not fraudulent, with detailed reasoning.
+        claim_type (str): The type of insurance claim (e.g., motor vehicle accident, theft,
+            damage).
+        csim_threshold (float, optional): The cosine similarity threshold for image matching.
+            Defaults to 0.85.
+    Yields:
+        tuple[str, Any]: ("signal", dict) with the "name", "status", "elapsed_ms" and "error" of
+        each piece of evidence as it is gathered, then ("token", str) for each chunk of the
+        markdown-formatted deduction as the LLM generates it.
     '''
     image_description = ""
     similar_images = ""
@@ -66,59 +153,103 @@ def perform_deduction(image: Optional[PIL.Image.Image], filename: str, claim_rep
     ai_generated_image = ""
 
     rand_weather = get_random_weather()
-    weather_conditions = f'The weather on the date of the incident has been provided via an external API. The weather was {rand_weather}. If the claim report contains weather information, use this to cross-reference the weather in the image to check for discrepancies. Only use the weather information if it is relevant to the claim.'
+    weather_conditions = (
+        f'The weather on the date of the incident has been provided via an external API. '
+        f'The weather was {rand_weather}. If the claim report contains weather information, use '
+        f'this to cross-reference the weather in the image to check for discrepancies. Only use '
+        f'the weather information if it is relevant to the claim.')
+
+    missing_signals = ""
 
     if image:
+        image = ClaimImage.wrap(image, filename)
 
-        lat, lon = get_lat_lon_for_img(image)
+        signals, statuses = {}, {}
 
-        if does_endpoint_exist():
+        for name, result, status in iter_signals(image, filename, csim_threshold):
+            statuses[name] = status
+            if status.status == "ok":
+                signals[name] = result
+            yield "signal", {"name": name, **status.model_dump()}
+
+        detection_result = signals.get("generated_image")
+        if detection_result:
             print("Sagemaker Endpoint for generated image detection exists")
-            detection_result = detect_generated_image(img=image)
-            if detection_result["confidence"] >= 0.98 and detection_result["prediction"] == 'FAKE':
+            if (detection_result["confidence"] >= 0.98
+                    and detection_result["prediction"] == 'FAKE'):
                 confidence = detection_result["confidence"]
-                ai_generated_image = f"The image uploaded has a {str(round(confidence*100,2))} detected as a generated image. This indicates that the image is not an original photo and has been manipulated. This could be an attempt to deceive the insurance company and is a strong indicator of fraud."
-
-        if lat and lon:
+                ai_generated_image = (
+                    f"The image uploaded has a {str(round(confidence*100,2))} detected as a "
+                    f"generated image. This indicates that the image is not an original photo and "
+                    f"has been manipulated. This could be an attempt to deceive the insurance "
+                    f"company and is a strong indicator of fraud.")
+
+        if signals.get("location"):
+            lat, lon, address = signals["location"]
             print(f"Latitude: {lat}, Longitude: {lon}")
-            address = address_lookup(lat=lat, lon=lon)
-            lat_lon_prompt = f"The location specified in the EXIF data of the image uploaded is {address}, which is at latitude {lat} and longitude {lon}. If the claim report contains location information, use this to cross-reference the location in the image to check for discrepancies.\n"
+            lat_lon_prompt = (
+                f"The location specified in the EXIF data of the image uploaded is {address}, "
+                f"which is at latitude {lat} and longitude {lon}. If the claim report contains "
+                f"location information, use this to cross-reference the location in the image to "
+                f"check for discrepancies.\n")
 
-        img_date_time = extract_exif_gps_timestamp(image)
+        img_date_time = signals.get("timestamp")
 
         if img_date_time:
             print(f"Image date and time: {img_date_time}")
-            date_time_prompt += f" Based on EXIF data, the uploaded image was taken on {img_date_time}. If the claim report contains the incident date and time information, use this to cross-reference the date and time in the image to check for discrepancies.\n"
+            date_time_prompt += (
+                f" Based on EXIF data, the uploaded image was taken on {img_date_time}. If the "
+                f"claim report contains the incident date and time information, use this to "
+                f"cross-reference the date and time in the image to check for discrepancies.\n")
 
-        image_description = get_claim_image_description(image)
-        image_description = f"You are provided a description of the image uploaded for the claim. Use the image description to cross reference against the claim report to check for discrepencies.\n <image_description>{image_description} </image_description >"
+        if "image_description" in signals:
+            image_description = (
+                f"You are provided a description of the image uploaded for the claim. Use the "
+                f"image description to cross reference against the claim report to check for "
+                f"discrepencies.\n <image_description>{signals['image_description']} "
+                f"</image_description >")
 
-        if len(filename) > 0:
+        if "internet_matches" in signals:
 
-            rev_image_search = reverse_image_search(
-                image=image, filename=filename, sim_thresh=0)
+            rev_image_search = signals["internet_matches"]
             
             reverse_matches =  [r for r in rev_image_search.results if r.csim > csim_threshold]
             reverse_match_count =len(reverse_matches)
                         
             if reverse_match_count > 0:
-                similar_images = f"Similar images have been found on the internet that match the image uploaded by the user. A similarity of more than {round(csim_threshold*100, 2)}% shows possible usage of stock or internet photos, which indicate fraud:"
+                similar_images = (
+                    f"Similar images have been found on the internet that match the image "
+                    f"uploaded by the user. A similarity of more than "
+                    f"{round(csim_threshold*100, 2)}% shows possible usage of stock or internet "
+                    f"photos, which indicate fraud:")
                 for match in reverse_matches:
                     link = match.link
                     source = match.source
                     title = match.title   
                     similarity = str(round(match.csim*100, 2))
-                    similar_images_str = f"<SimilarImage>Image source: {source}, Similarity: {similarity}, Image URL: {link}</SimilarImage>"
+                    similar_images_str = (
+                        f"<SimilarImage>Image source: {source}, Similarity: {similarity}, "
+                        f"Image URL: {link}</SimilarImage>")
                     print(similar_images_str)
                     similar_images += f"\n{similar_images_str}\n"
-                similar_images += "\nFor each image, include at least one link in the deduction where the image can be found on the internet.\n"
+                similar_images += ("\nFor each image, include at least one link in the "
+                                   "deduction where the image can be found on the internet.\n")
 
-        image_library = S3ImageLibrary()
-        similar_images_in_library_lst = image_library.search_images(image)
-        similar_images_in_library_lst = [
-            image for image in similar_images_in_library_lst if image.score > csim_threshold]
+        similar_images_in_library_lst = signals.get("library_matches") or []
         if len(similar_images_in_library_lst) > 0:
-            similar_images_in_library = f"{len(similar_images_in_library_lst)} similar image(s) have been found that match the image uploaded by the user. This means that the image uploaded by the user is not unique and has been used before in previous insurance claims. This indicates fraud."
+            similar_images_in_library = (
+                f"{len(similar_images_in_library_lst)} similar image(s) have been found that "
+                f"match the image uploaded by the user. This means that the image uploaded by the "
+                f"user is not unique and has been used before in previous insurance claims. This "
+                f"indicates fraud.")
+
+        missing = [SIGNAL_DESCRIPTIONS[name] for name, status in statuses.items()
+                   if status.status != "ok"]
+        if missing:
+            missing_signals = (
+                f"The following checks of the image could not be completed, so no information is "
+                f"available from them: {', '.join(missing)}. Do not assume anything about their "
+                f"outcome, and state in the deduction that they were not checked.\n")
 
     llm = ChatBedrock(
         region_name="us-west-2",
@@ -130,12 +261,19 @@ def perform_deduction(image: Optional[PIL.Image.Image], filename: str, claim_rep
     <instructions>
     You are an insurance fraud detection agent in Australia.
 
-    Your job is to examine insurance claim reports, and determine if there is fraud. You are provided with a claim report.
-    A claim can be for motor vehicle accidents, theft of personal property and damage to items (e.g. electronics).
+    Your job is to examine insurance claim reports, and determine if there is fraud. You are
+    provided with a claim report.
+    A claim can be for motor vehicle accidents, theft of personal property and damage to items
+    (e.g. electronics).
     The claim report should have sufficient detail.
-    For example, the weather, the date, time and location it occurred, any witnesses, the angle items are dropped or the amount of force of collisions. Consider all details in the claim report. Make sure you take into account any information you have already been provided with in the claim report.
-    Provide step-by-step reasoning to make a deduction on whether there is fraud or not. Provide a score between 0% and 100% to indicate your confidence in the deduction.
-    Do not say you are making a deduction or summary, just provide the information. Do not mention you are providing the output in markdown format.
+    For example, the weather, the date, time and location it occurred, any witnesses, the angle
+    items are dropped or the amount of force of collisions. Consider all details in the claim
+    report. Make sure you take into account any information you have already been provided with in
+    the claim report.
+    Provide step-by-step reasoning to make a deduction on whether there is fraud or not. Provide a
+    score between 0% and 100% to indicate your confidence in the deduction.
+    Do not say you are making a deduction or summary, just provide the information. Do not mention
+    you are providing the output in markdown format.
 
     The current date and time is {current_datetime}.
 
@@ -151,33 +289,45 @@ def perform_deduction(image: Optional[PIL.Image.Image], filename: str, claim_rep
     {similar_images}
     {similar_images_in_library}
     {ai_generated_image}
+    {missing_signals}
 
     The <claim_report> and <image_description> tags enclose the relevant information.
 
     To establish if there is fraud, perform these checks:
 
-    <check>For motor vehicle accidents, you can ask the speed at which the user was travelling at. Use the speed to cross reference against the damage in the provided image to see if it matches up. If the user was travelling very slowly, it should not have resulted in extensive damage to the vehicle.</check>
+    <check>For motor vehicle accidents, you can ask the speed at which the user was travelling at.
+    Use the speed to cross reference against the damage in the provided image to see if it matches
+    up. If the user was travelling very slowly, it should not have resulted in extensive damage to
+    the vehicle.</check>
 
-    <check>logical contradictions in the report (e.g. the car is a modern car but did not have seatbelt warning alarms)</check>
+    <check>logical contradictions in the report (e.g. the car is a modern car but did not have
+    seatbelt warning alarms)</check>
 
-    <check>data mismatch (for example, if the claim report says a laptop was damaged, but there is no laptop in the image description)</check>
+    <check>data mismatch (for example, if the claim report says a laptop was damaged, but there is
+    no laptop in the image description)</check>
 
-    <check>look for factual inaccuracies (for example, the user says the it was not a rainy day but the car skidded)</check>
+    <check>look for factual inaccuracies (for example, the user says the it was not a rainy day but
+    the car skidded)</check>
 
-    <check>look for inconsistences (for example when the user uploads images that do not match the story)</check>
+    <check>look for inconsistences (for example when the user uploads images that do not match the
+    story)</check>
 
-    <check>unlikely events (for example, breaking a phone screen when dropping in water or sand)</check>
+    <check>unlikely events (for example, breaking a phone screen when dropping in water or
+    sand)</check>
 
-    <check>Impossible scenarios, (for example, a car breaking its windscreen when flying upside down)</check>
+    <check>Impossible scenarios, (for example, a car breaking its windscreen when flying upside
+    down)</check>
 
-    <check>Ask the user about their claim history to see if there is a pattern of similar claims</check>
+    <check>Ask the user about their claim history to see if there is a pattern of similar
+    claims</check>
 
     </instructions>
     """)
 
     user_input = """ Produce the following output:
     - A summary of the claim report
-    - A deduction of whether the claim is fraudulent or not. This can be "Not fraudulent", "Inconclusive" or "Fraudulent" with a detailed explanation of why you think so.
+    - A deduction of whether the claim is fraudulent or not. This can be "Not fraudulent",
+      "Inconclusive" or "Fraudulent" with a detailed explanation of why you think so.
     
     The output should be well-formatted in markdown format.
 """
@@ -191,6 +341,7 @@ def perform_deduction(image: Optional[PIL.Image.Image], filename: str, claim_rep
         weather_conditions=weather_conditions,
         lat_lon_prompt=lat_lon_prompt,
         ai_generated_image=ai_generated_image,
+        missing_signals=missing_signals,
         date_time_prompt=date_time_prompt, current_datetime=datetime.now().strftime(
             "%d %b %Y %H:%M:%S"))
 
@@ -204,8 +355,33 @@ def perform_deduction(image: Optional[PIL.Image.Image], filename: str, claim_rep
         ("human", user_input),
     ]
 
-    ai_msg = llm.invoke(messages)
+    for chunk in llm.stream(messages):
+        if chunk.content:
+            yield "token", chunk.content
+
+
+def perform_deduction(image: Optional[PIL.Image.Image | ClaimImage], filename: str,
+                      claim_report: str, claim_type: str, csim_threshold:float=0.85) -> str:
+    '''
+    Perform deduction to determine if an insurance claim is fraudulent based on the provided image,
+    filename, claim report, and claim type.
+    Args:
+        image (Optional[PIL.Image.Image | ClaimImage]): The image associated with the claim. It is
+            decoded and re-encoded at most once for all the checks.
+        filename (str): The filename of the image.
+        claim_report (str): The detailed report of the insurance claim.
+        claim_type (str): The type of insurance claim (e.g., motor vehicle accident, theft,
+            damage).
+        csim_threshold (float, optional): The cosine similarity threshold for image matching.
+            Defaults to 0.85.
+    Returns:
+        str: A markdown-formatted string containing the deduction results, including a summary of
+            the claim report and a determination of whether the claim is fraudulent, inconclusive,
+            or not fraudulent, with detailed reasoning.
+    '''
+    deduction = "".join(text for event, text in stream_deduction(
+        image, filename, claim_report, claim_type, csim_threshold) if event == "token")
 
-    print(f'Response from deduction: {ai_msg.content}')
+    print(f'Response from deduction: {deduction}')
 
-    return ai_msg.content
+    return deduction
@@ -0,0 +1,249 @@
+import hashlib
+import io
+import mimetypes
+import os
+import sys
+import threading
+from typing import Callable, Union
+
+import PIL
+import PIL.Image
+import PIL.ImageOps
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+THUMBNAIL_SIZE = 256
+DESCRIPTION_SIZE = 1024
+DETECTOR_SIZE = 32
+
+
+class ClaimImage:
+    """An image submitted with a claim, shared by every analysis step of a
+    request. The file is downloaded once and its raw bytes kept, so the
+    original EXIF data survives, and each derived rendition is computed on
+    first use and memoized. Renditions may be requested concurrently from
+    several threads; each one is still only computed once.
+
+    """
+
+    def __init__(self, data: bytes = None, filename: str = "", content_type: str = None,
+                 image: PIL.Image.Image = None):
+        """Constructor. Either `data` or `image` must be given.
+
+        Parameters
+        ----------
+        data : bytes, default=None
+            The encoded image file.
+        filename : str, default=""
+        content_type : str, default=None
+            MIME type of `data`. Defaults to a guess from `filename`.
+        image : PIL.Image, default=None
+            An already decoded image, used when there is no file, e.g. an
+            upload in the UI. It is encoded as PNG if `data` is needed.
+
+        """
+
+        if data is None and image is None:
+            raise ValueError("ClaimImage requires the image data or a decoded image")
+
+        self.filename = filename
+        # a decoded image without its file is encoded as PNG
+        self._content_type = content_type or (None if data is not None else "image/png")
+        self._memo = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+        if data is not None:
+            self._memo["data"] = data
+        if image is not None:
+            self._memo["image"] = image
+
+        return
+
+    @classmethod
+    def from_s3(cls, bucket: str, key: str, s3=None, filename: str = None) -> "ClaimImage":
+        """Download an image from S3.
+
+        Parameters
+        ----------
+        bucket : str
+        key : str
+        s3 : default=None
+            The S3 client to use. Defaults to the shared client.
+        filename : str, default=None
+            Defaults to the basename of `key`.
+
+        Returns
+        -------
+        ClaimImage
+
+        """
+
+        if s3 is None:
+            from util.s3 import get_s3_client
+            s3 = get_s3_client()
+
+        response = s3.get_object(Bucket=bucket, Key=key)
+        return cls(response["Body"].read(), filename=filename or os.path.basename(key),
+                   content_type=response.get("ContentType"))
+
+    @classmethod
+    def wrap(cls, image: Union["ClaimImage", PIL.Image.Image], filename: str = "") -> "ClaimImage":
+        """Return `image` if it already is a ClaimImage, otherwise wrap the
+        decoded image.
+
+        Parameters
+        ----------
+        image : ClaimImage or PIL.Image
+        filename : str, default=""
+
+        Returns
+        -------
+        ClaimImage
+
+        """
+
+        if isinstance(image, cls):
+            return image
+
+        return cls(image=image, filename=filename or getattr(image, "filename", "") or "")
+
+    def _get(self, name: str, compute: Callable):
+        # one lock per rendition, so that computing one does not block another
+        with self._lock:
+            if name in self._memo:
+                return self._memo[name]
+            lock = self._locks.setdefault(name, threading.Lock())
+
+        with lock:
+            if name not in self._memo:
+                self._memo[name] = compute()
+
+        return self._memo[name]
+
+    def _encode(self, img: PIL.Image.Image, format: str, **kwargs) -> bytes:
+        buf = io.BytesIO()
+        img.save(buf, format=format, **kwargs)
+        return buf.getvalue()
+
+    def _resized(self, size: int) -> PIL.Image.Image:
+        def compute():
+            img = self.rgb.copy()
+            img.thumbnail((size, size), PIL.Image.LANCZOS)
+            return img
+
+        return self._get(f"resized_{size}", compute)
+
+    @property
+    def data(self) -> bytes:
+        """The encoded image file."""
+        return self._get("data", lambda: self._encode(self.image, "PNG"))
+
+    @property
+    def content_type(self) -> str:
+        """MIME type of `data`."""
+        return (self._content_type or mimetypes.guess_type(self.filename)[0]
+                or "application/octet-stream")
+
+    @property
+    def content_hash(self) -> str:
+        """SHA-256 of the encoded file."""
+        return self._get("content_hash", lambda: hashlib.sha256(self.data).hexdigest())
+
+    @property
+    def image(self) -> PIL.Image.Image:
+        """The decoded image in its original mode, with its EXIF data."""
+        def compute():
+            img = PIL.Image.open(io.BytesIO(self.data))
+            img.load()
+            return img
+
+        return self._get("image", compute)
+
+    @property
+    def exif(self) -> dict:
+        """The EXIF tags of the original image, including the GPS tags."""
+        from exifdata import get_exif
+        return self._get("exif", lambda: get_exif(self.image))
+
+    @property
+    def rgb(self) -> PIL.Image.Image:
+        """The image converted to RGB."""
+        return self._get("rgb", lambda: self.image.convert("RGB"))
+
+    def decode(self) -> "ClaimImage":
+        """Decode the image to RGB now rather than on first use, e.g. on a CPU
+        worker before the renditions are requested from other threads.
+
+        Returns
+        -------
+        ClaimImage
+            This image.
+
+        """
+
+        self.rgb.load()
+        return self
+
+    @property
+    def rgb_array(self) -> np.ndarray:
+        """(H, W, 3) uint8 array of the RGB image."""
+        return self._get("rgb_array", lambda: np.asarray(self.rgb))
+
+    @property
+    def thumbnail(self) -> PIL.Image.Image:
+        """The RGB image resized to fit THUMBNAIL_SIZE pixels."""
+        return self._resized(THUMBNAIL_SIZE)
+
+    @property
+    def description_jpeg(self) -> bytes:
+        """JPEG of the RGB image resized to fit DESCRIPTION_SIZE pixels, as
+        sent to the image description model."""
+        return self._get("description_jpeg",
+                         lambda: self._encode(self._resized(DESCRIPTION_SIZE), "JPEG"))
+
+    @property
+    def public_jpeg(self) -> bytes:
+        """JPEG of the full-size RGB image without its EXIF data, for sharing
+        outside the account, e.g. with the reverse image search. The EXIF
+        orientation is applied to the pixels before it is dropped."""
+        def compute():
+            img = PIL.ImageOps.exif_transpose(self.image).convert("RGB")
+            return self._encode(img, "JPEG", quality=95, exif=b"")
+
+        return self._get("public_jpeg", compute)
+
+    @property
+    def detector_jpeg(self) -> bytes:
+        """JPEG of the RGB image resized to DETECTOR_SIZE x DETECTOR_SIZE
+        pixels, as sent to the generated image detector."""
+        def compute():
+            img = self.rgb.resize((DETECTOR_SIZE, DETECTOR_SIZE), PIL.Image.LANCZOS)
+            return self._encode(img, "JPEG")
+
+        return self._get("detector_jpeg", compute)
+
+    def embedding(self, encoder) -> np.ndarray:
+        """Return the embedding of the RGB image by an `ImageEncoder`. The
+        encoder's own transforms produce its (e.g. 224px) model input, and its
+        `cache_key` keys the embedding cache, so the same image shares one
+        cache entry across every code path and a change of weights is never
+        served a stale embedding.
+
+        Parameters
+        ----------
+        encoder : ImageEncoder
+
+        Returns
+        -------
+        np.ndarray
+            1D float32 embedding vector.
+
+        """
+
+        def compute():
+            return encoder.encode_batch([self.rgb], keys=[encoder.cache_key(self.rgb)])[0]
+
+        name = f"embedding_{encoder.model_name}_{encoder.backend}_{encoder.fingerprint}"
+        return self._get(name, compute)
@@ -0,0 +1,294 @@
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import PIL
+import numpy as np
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "1024"))
+# Path of the optional SQLite tier, e.g. /mnt/efs/embeddings.db. Disabled when unset.
+EMBEDDING_CACHE_DB = os.environ.get("EMBEDDING_CACHE_DB")
+EMBEDDING_CACHE_TTL = float(os.environ.get("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600)))
+EMBEDDING_CACHE_DB_MAX_ITEMS = int(os.environ.get("EMBEDDING_CACHE_DB_MAX_ITEMS", "100000"))
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def content_hash(data: bytes) -> str:
+    """Hash raw image bytes.
+
+    Parameters
+    ----------
+    data : bytes
+
+    Returns
+    -------
+    str
+
+    """
+
+    return hashlib.sha256(data).hexdigest()
+
+
+def image_content_hash(img: PIL.Image) -> str:
+    """Hash the decoded pixels of an image, so that the same picture maps to
+    the same key however it was encoded or transported.
+
+    Parameters
+    ----------
+    img : PIL.Image
+
+    Returns
+    -------
+    str
+
+    """
+
+    h = hashlib.sha256()
+    h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+class _SqliteTier:
+    """Persistent cache tier backed by a local SQLite file. Entries older than
+    `ttl` seconds are treated as misses and purged; the oldest entries are
+    evicted once `max_items` is exceeded.
+
+    """
+
+    def __init__(self, db_fn: str, ttl: float, max_items: int):
+        Path(db_fn).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(db_fn, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL, created REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_created ON embeddings (created)")
+        self._conn.commit()
+        self._ttl = ttl
+        self._max_items = max_items
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT embedding, created FROM embeddings WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                return None
+
+            if self._ttl > 0 and time.time() - row[1] > self._ttl:
+                self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+
+        return np.frombuffer(row[0], dtype=np.float32)
+
+    def put(self, key: str, x_emb: np.ndarray):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, embedding, created) VALUES (?, ?, ?)",
+                (key, np.asarray(x_emb, dtype=np.float32).tobytes(), time.time()))
+            self._writes += 1
+
+            # evict in batches rather than on every write
+            if self._writes % 100 == 0:
+                self._evict()
+
+            self._conn.commit()
+
+    def _evict(self):
+        if self._ttl > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE created < ?", (time.time() - self._ttl,))
+
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings "
+            "ORDER BY created DESC LIMIT -1 OFFSET ?)", (self._max_items,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class EmbeddingCache:
+    """Two tier cache of image embeddings: a bounded in-memory LRU in front of
+    an optional persistent SQLite file. Keys combine the model name, backend
+    and a content hash of the image, so the same image is only ever run
+    through a given model once.
+
+    """
+
+    def __init__(
+            self,
+            max_items: int = EMBEDDING_CACHE_SIZE,
+            db_fn: str = EMBEDDING_CACHE_DB,
+            ttl: float = EMBEDDING_CACHE_TTL,
+            db_max_items: int = EMBEDDING_CACHE_DB_MAX_ITEMS,
+    ):
+        """Constructor.
+
+        Parameters
+        ----------
+        max_items : int, default=EMBEDDING_CACHE_SIZE or 1024
+            Capacity of the in-memory LRU tier.
+        db_fn : str, default=EMBEDDING_CACHE_DB
+            Path of the SQLite file used as the persistent tier. The persistent
+            tier is disabled if this is None.
+        ttl : float, default=EMBEDDING_CACHE_TTL or 7 days
+            Time to live of the persistent entries, in seconds. 0 disables
+            expiry.
+        db_max_items : int, default=EMBEDDING_CACHE_DB_MAX_ITEMS or 100000
+
+        """
+
+        self._max_items = max_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._persistent = _SqliteTier(db_fn, ttl, db_max_items) if db_fn else None
+        self.memory_hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+        if self._persistent is not None:
+            logger.info(f"Persisting image embeddings to {db_fn}")
+
+        return
+
+    @staticmethod
+    def make_key(model_name: str, backend: str, img_hash: str, weights: str = "") -> str:
+        if weights:
+            return f"{model_name}@{weights}[{backend}]:{img_hash}"
+        return f"{model_name}[{backend}]:{img_hash}"
+
+    def get(self, key: str):
+        """Look up an embedding, promoting persistent hits into memory.
+
+        Parameters
+        ----------
+        key : str
+
+        Returns
+        -------
+        np.ndarray or None
+
+        """
+
+        with self._lock:
+            x_emb = self._memory.get(key)
+
+            if x_emb is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return x_emb
+
+        if self._persistent is not None:
+            x_emb = self._persistent.get(key)
+
+            if x_emb is not None:
+                self._put_memory(key, x_emb)
+                with self._lock:
+                    self.persistent_hits += 1
+                return x_emb
+
+        with self._lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, key: str, x_emb: np.ndarray):
+        """Store an embedding in every tier.
+
+        Parameters
+        ----------
+        key : str
+        x_emb : np.ndarray
+
+        """
+
+        x_emb = np.array(x_emb, dtype=np.float32)
+        x_emb.setflags(write=False)
+        self._put_memory(key, x_emb)
+
+        if self._persistent is not None:
+            self._persistent.put(key, x_emb)
+
+        return
+
+    def _put_memory(self, key, x_emb):
+        if self._max_items <= 0:
+            return
+
+        with self._lock:
+            self._memory[key] = x_emb
+            self._memory.move_to_end(key)
+
+            while len(self._memory) > self._max_items:
+                self._memory.popitem(last=False)
+
+    def clear(self):
+        """Empty the in-memory tier and reset the counters."""
+
+        with self._lock:
+            self._memory.clear()
+            self.memory_hits = 0
+            self.persistent_hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Return the hit/miss counters and tier sizes.
+
+        Returns
+        -------
+        dict
+
+        """
+
+        with self._lock:
+            hits = self.memory_hits + self.persistent_hits
+            lookups = hits + self.misses
+            stats = {
+                "hits": hits,
+                "memory_hits": self.memory_hits,
+                "persistent_hits": self.persistent_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_items": len(self._memory),
+                "memory_capacity": self._max_items,
+            }
+
+        if self._persistent is not None:
+            stats["persistent_items"] = len(self._persistent)
+
+        return stats
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Return the process-wide embedding cache shared by every
+    `ImageEncoder`.
+
+    Returns
+    -------
+    EmbeddingCache
+
+    """
+
+    global _shared_cache
+
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = EmbeddingCache()
+
+    return _shared_cache
@@ -0,0 +1,436 @@
+import os
+import sys
+import threading
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+def normalize_rows(X_emb: np.ndarray) -> np.ndarray:
+    """Scale the rows of `X_emb` to unit L2 norm, as float32."""
+
+    X_emb = np.asarray(X_emb, dtype=np.float32)
+    return X_emb / np.maximum(np.linalg.norm(X_emb, axis=1, keepdims=True), 1e-12)
+
+
+class EmbeddingSnapshot:
+    """An immutable view of an `EmbeddingStore`. Rows below `n_frozen` live in
+    the memory-mapped matrix on disk and the remainder in the in-memory delta.
+    Writers never modify a snapshot in place, they publish a new one, so a
+    snapshot can be read from any thread without locking.
+
+    Embeddings are stored L2-normalized, so the cosine similarity of two rows
+    is their dot product.
+
+    Every image has a stable id, `ids[row]`, which is never reused. Ids are in
+    increasing order of row, so `rows` maps them back with a binary search.
+    Rows, unlike ids, are renumbered by compaction: `epoch` changes whenever
+    the matrix is (re)loaded, and `version` whenever a new snapshot is
+    published.
+
+    """
+
+    def __init__(self, frozen, delta, label_codes, label_names, fns, valid, ids, next_id,
+                 epoch=0, version=0, frozen_cache=None):
+        self.frozen = frozen
+        self.delta = delta
+        self.label_codes = label_codes
+        self.label_names = tuple(str(name) for name in label_names)
+        self.fns = fns
+        self.valid = valid
+        self.ids = ids
+        self.next_id = next_id
+        self.n_frozen = len(frozen)
+        self.n = len(valid)
+        self.epoch = epoch
+        self.version = version
+        # conversions of the memory-mapped matrix, shared by the snapshots of an epoch
+        self._frozen_cache = {} if frozen_cache is None else frozen_cache
+
+    def rows(self, ids: np.ndarray) -> np.ndarray:
+        """Map image ids to rows, dropping the ids that are not in the store.
+
+        Parameters
+        ----------
+        ids : np.ndarray
+
+        Returns
+        -------
+        np.ndarray
+
+        """
+
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.searchsorted(self.ids, ids)
+        found = rows < self.n
+        found[found] = self.ids[rows[found]] == ids[found]
+        return rows[found]
+
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        """Gather the embeddings of `rows` into a contiguous (len(rows), D)
+        float32 matrix.
+
+        Parameters
+        ----------
+        rows : np.ndarray
+
+        Returns
+        -------
+        np.ndarray
+
+        """
+
+        rows = np.asarray(rows, dtype=np.int64)
+        X_emb = np.empty((len(rows), self.frozen.shape[1]), dtype=np.float32)
+        is_frozen = rows < self.n_frozen
+        X_emb[is_frozen] = self.frozen[rows[is_frozen]]
+        X_emb[~is_frozen] = self.delta[rows[~is_frozen] - self.n_frozen]
+        return X_emb
+
+    def frozen_as(self, dtype=np.float32) -> np.ndarray:
+        """Return the memory-mapped rows in `dtype`. For float32 this is the
+        matrix on disk; other dtypes are converted once per epoch.
+
+        Parameters
+        ----------
+        dtype : default=np.float32
+            np.float16 halves the memory at a small cost in precision.
+
+        Returns
+        -------
+        np.ndarray
+
+        """
+
+        if np.dtype(dtype) == self.frozen.dtype:
+            return self.frozen
+
+        key = np.dtype(dtype).name
+        X_frozen = self._frozen_cache.get(key)
+
+        if X_frozen is None:
+            X_frozen = self.frozen.astype(dtype)
+            self._frozen_cache[key] = X_frozen
+
+        return X_frozen
+
+    def similarity(self, q_emb: np.ndarray, dtype=np.float32) -> np.ndarray:
+        """Cosine similarity of every row with `q_emb`, computed in `dtype`.
+        Removed images score -inf.
+
+        Parameters
+        ----------
+        q_emb : np.ndarray
+        dtype : default=np.float32
+
+        Returns
+        -------
+        np.ndarray
+            (n,) float32 scores, indexed by row.
+
+        """
+
+        q_norm = normalize_rows(q_emb.reshape(1, -1))[0].astype(dtype)
+        scores = np.empty(self.n, dtype=np.float32)
+        scores[:self.n_frozen] = self.frozen_as(dtype) @ q_norm
+        scores[self.n_frozen:] = self.delta.astype(dtype) @ q_norm
+        scores[~self.valid] = -np.inf
+        return scores
+
+    def labels(self, rows: np.ndarray) -> np.ndarray:
+        names = np.array(self.label_names, dtype=object)
+        return names[self.label_codes[rows]]
+
+    def label_mask(self, rows: np.ndarray, labels: list[str]) -> np.ndarray:
+        """Boolean mask of the `rows` whose label is in `labels`."""
+
+        codes = [i for i, name in enumerate(self.label_names) if name in set(labels)]
+        return np.isin(self.label_codes[rows], codes)
+
+    def n_removed(self, n_rows: int) -> int:
+        """Number of removed images among the rows below `n_rows`."""
+
+        return int(n_rows - np.count_nonzero(self.valid[:n_rows]))
+
+
+class EmbeddingStoreWriter:
+    """Streams rows into a new embedding matrix on disk. The files are only
+    swapped in when `commit` is called.
+
+    """
+
+    def __init__(self, store, n: int, dim: int, next_id: int = 0):
+        self._store = store
+        self._tmp_emb_fn = f"{store.emb_fn}.{os.getpid()}.tmp"
+        self._X_emb = np.lib.format.open_memmap(
+            self._tmp_emb_fn, mode="w+", dtype=np.float32, shape=(n, dim))
+        self._label_codes = np.zeros(n, dtype=np.int32)
+        self._label_names = []
+        self._fns = [""] * n
+        self._valid = np.zeros(n, dtype=bool)
+        self._ids = np.arange(n, dtype=np.int64)
+        self._next_id = next_id
+
+    def _label_code(self, label):
+        if label not in self._label_names:
+            self._label_names.append(label)
+        return self._label_names.index(label)
+
+    def write(self, offset: int, X_emb: np.ndarray, labels: list[str], fns: list[str],
+              ids: np.ndarray = None):
+        """Write the rows `offset` to `offset + len(X_emb)`, normalized. The
+        image ids default to the row numbers."""
+
+        end = offset + len(X_emb)
+        self._X_emb[offset:end] = normalize_rows(X_emb)
+        self._label_codes[offset:end] = [self._label_code(label) for label in labels]
+        self._fns[offset:end] = fns
+        self._valid[offset:end] = True
+
+        if ids is not None:
+            self._ids[offset:end] = ids
+
+    def write_row(self, i: int, x_emb: np.ndarray, label: str, fn: str):
+        self.write(i, np.asarray(x_emb, dtype=np.float32).reshape(1, -1), [label], [fn])
+
+    def commit(self):
+        with self._store._lock:
+            self._commit()
+
+    def _commit(self):
+        # must be called with the store lock held
+        self._X_emb.flush()
+        del self._X_emb
+        next_id = max(self._next_id, int(self._ids.max(initial=-1)) + 1)
+        self._store._replace_frozen(self._tmp_emb_fn, self._label_codes, self._label_names,
+                                    self._fns, self._valid, self._ids, next_id)
+
+
+class EmbeddingStore:
+    """L2-normalized embeddings of the image library, stored as a contiguous
+    float32 `.npy` matrix opened with `np.memmap`, with the labels and filenames held in
+    compact arrays alongside it.
+
+    Images added after the matrix was written are kept in a small delta
+    (persisted to `<prefix>.delta.npz`) until `compact` folds them into a new
+    matrix. Removed images are masked out until then; compaction drops them
+    and moves the remaining images to contiguous rows, preserving their order
+    and their ids.
+
+    """
+
+    def __init__(self, prefix: str, dim: int):
+        """Constructor.
+
+        Parameters
+        ----------
+        prefix : str
+            Path prefix of the store files: `<prefix>.npy` (embeddings),
+            `<prefix>.meta.npz` (labels, filenames, validity mask, ids) and
+            `<prefix>.delta.npz` (pending additions and removals).
+        dim : int
+            Dimensionality of the embeddings.
+
+        """
+
+        self.emb_fn = f"{prefix}.npy"
+        self.meta_fn = f"{prefix}.meta.npz"
+        self.delta_fn = f"{prefix}.delta.npz"
+        self._dim = dim
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self._version = 0
+        self._snapshot = EmbeddingSnapshot(
+            np.empty((0, dim), dtype=np.float32), np.empty((0, dim), dtype=np.float32),
+            np.empty(0, dtype=np.int32), [], np.empty(0, dtype=str), np.empty(0, dtype=bool),
+            np.empty(0, dtype=np.int64), 0)
+
+    def exists(self) -> bool:
+        return Path(self.emb_fn).exists() and Path(self.meta_fn).exists()
+
+    def delete(self):
+        for fn in (self.emb_fn, self.meta_fn, self.delta_fn):
+            if Path(fn).exists():
+                logger.warning(f"{fn} exists, deleting...")
+                os.remove(fn)
+
+    def snapshot(self) -> EmbeddingSnapshot:
+        return self._snapshot
+
+    def __len__(self):
+        return int(np.count_nonzero(self._snapshot.valid))
+
+    def load(self):
+        """Open the matrix on disk and apply any pending delta."""
+
+        with self._lock:
+            self._load()
+
+        return self
+
+    def _load(self):
+        # must be called with the lock held
+        frozen = np.load(self.emb_fn, mmap_mode="r")
+
+        with np.load(self.meta_fn) as meta:
+            label_codes = meta["label_codes"]
+            label_names = list(meta["label_names"])
+            fns = meta["fns"]
+            valid = meta["valid"].copy()
+            # stores written before ids were introduced used the row numbers
+            ids = meta["ids"] if "ids" in meta else np.arange(len(valid), dtype=np.int64)
+            next_id = int(meta["next_id"]) if "next_id" in meta else len(valid)
+
+        delta = np.empty((0, self._dim), dtype=np.float32)
+
+        if Path(self.delta_fn).exists():
+            with np.load(self.delta_fn) as pending:
+                delta = pending["X_emb"]
+                label_names += [name for name in pending["label_names"]
+                                if name not in label_names]
+                delta_codes = [label_names.index(name) for name in pending["labels"]]
+                label_codes = np.concatenate(
+                    [label_codes, np.array(delta_codes, dtype=np.int32)])
+                fns = np.concatenate([fns, pending["fns"]])
+                valid = np.concatenate([valid, pending["valid"]])
+                valid[pending["removed"]] = False
+                if "ids" in pending:
+                    ids = np.concatenate([ids, pending["ids"]])
+                    next_id = int(pending["next_id"])
+                else:
+                    ids = np.arange(len(valid), dtype=np.int64)
+                    next_id = len(valid)
+
+        self._epoch += 1
+        self._publish(EmbeddingSnapshot(
+            frozen, delta, label_codes, label_names, fns, valid, ids, next_id,
+            epoch=self._epoch))
+
+    def _publish(self, snap: EmbeddingSnapshot):
+        # must be called with the lock held
+        self._version += 1
+        snap.version = self._version
+        self._snapshot = snap
+
+    def writer(self, n: int, next_id: int = 0) -> EmbeddingStoreWriter:
+        """Start writing a new matrix of `n` rows, replacing the store on
+        commit. New ids are assigned from `next_id` or above."""
+
+        return EmbeddingStoreWriter(self, n, self._dim, next_id)
+
+    def _replace_frozen(self, tmp_emb_fn, label_codes, label_names, fns, valid, ids, next_id):
+        # must be called with the lock held
+        tmp_meta_fn = f"{self.meta_fn}.{os.getpid()}.tmp"
+
+        with open(tmp_meta_fn, "wb") as f:
+            np.savez(f, label_codes=label_codes, label_names=np.array(label_names, dtype=str),
+                     fns=np.array(fns, dtype=str), valid=valid, ids=ids, next_id=next_id)
+
+        # readers holding the previous snapshot keep the old (unlinked) file mapped
+        os.replace(tmp_emb_fn, self.emb_fn)
+        os.replace(tmp_meta_fn, self.meta_fn)
+
+        if Path(self.delta_fn).exists():
+            os.remove(self.delta_fn)
+
+        self._load()
+
+    def _save_delta(self, snap: EmbeddingSnapshot):
+        tmp_delta_fn = f"{self.delta_fn}.{os.getpid()}.tmp"
+        n_frozen = snap.n_frozen
+
+        with open(tmp_delta_fn, "wb") as f:
+            np.savez(
+                f,
+                X_emb=snap.delta,
+                labels=np.array(snap.labels(np.arange(n_frozen, snap.n)), dtype=str),
+                label_names=np.array(snap.label_names, dtype=str),
+                fns=snap.fns[n_frozen:],
+                valid=snap.valid[n_frozen:],
+                removed=np.flatnonzero(~snap.valid[:n_frozen]),
+                ids=snap.ids[n_frozen:],
+                next_id=snap.next_id,
+            )
+
+        os.replace(tmp_delta_fn, self.delta_fn)
+
+    def append(self, X_emb: np.ndarray, labels: list[str], fns: list[str]) -> list[int]:
+        """Add rows to the delta.
+
+        Returns
+        -------
+        list[int]
+            The ids assigned to the new rows.
+
+        """
+
+        with self._lock:
+            snap = self._snapshot
+            label_names = list(snap.label_names)
+            label_names += [label for label in dict.fromkeys(labels) if label not in label_names]
+            codes = np.array([label_names.index(label) for label in labels], dtype=np.int32)
+            ids = np.arange(snap.next_id, snap.next_id + len(fns), dtype=np.int64)
+
+            new_snap = EmbeddingSnapshot(
+                snap.frozen,
+                np.concatenate([snap.delta, normalize_rows(X_emb)]),
+                np.concatenate([snap.label_codes, codes]),
+                label_names,
+                np.concatenate([snap.fns, np.array(fns, dtype=str)]),
+                np.concatenate([snap.valid, np.ones(len(fns), dtype=bool)]),
+                np.concatenate([snap.ids, ids]),
+                snap.next_id + len(fns),
+                epoch=snap.epoch,
+                frozen_cache=snap._frozen_cache,
+            )
+            self._save_delta(new_snap)
+            self._publish(new_snap)
+
+        return ids.tolist()
+
+    def remove(self, ids: list[int]):
+        """Mask the images `ids` out of the store. Unknown ids are ignored."""
+
+        with self._lock:
+            snap = self._snapshot
+            valid = snap.valid.copy()
+            valid[snap.rows(ids)] = False
+
+            new_snap = EmbeddingSnapshot(
+                snap.frozen, snap.delta, snap.label_codes, snap.label_names, snap.fns, valid,
+                snap.ids, snap.next_id, epoch=snap.epoch, frozen_cache=snap._frozen_cache)
+            self._save_delta(new_snap)
+            self._publish(new_snap)
+
+        return
+
+    def compact(self) -> EmbeddingSnapshot:
+        """Fold the delta into a new matrix on disk, dropping the removed rows.
+        The remaining rows are moved to contiguous rows in their current order
+        and keep their ids. Writers block until the compaction completes;
+        readers are not affected.
+
+        Returns
+        -------
+        EmbeddingSnapshot
+            The new snapshot, in which every row is memory-mapped and valid.
+
+        """
+
+        with self._lock:
+            snap = self._snapshot
+            keep = np.flatnonzero(snap.valid)
+            writer = self.writer(len(keep), snap.next_id)
+            chunk = 4096
+
+            for offset in range(0, len(keep), chunk):
+                rows = keep[offset:offset + chunk]
+                writer.write(offset, snap.vectors(rows), list(snap.labels(rows)),
+                             list(snap.fns[rows]), ids=snap.ids[rows])
+
+            writer._commit()
+
+            return self._snapshot
@@ -0,0 +1,96 @@
+import asyncio
+import functools
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+# Bounded thread pools that async request handlers hand their blocking work to,
+# so that the event loop stays free to serve other requests:
+#   "cpu" - image decoding and model inference (torch and PIL release the GIL)
+#   "io"  - blocking AWS and HTTP calls (boto3, OpenSearch, Bedrock, SerpAPI)
+#   "signal" - the evidence a claim deduction gathers concurrently. Deductions
+#              themselves run on the "io" executor, so their fan-out gets its own
+#              pool rather than waiting on the one they occupy.
+CPU_EXECUTOR_WORKERS = int(os.environ.get("CPU_EXECUTOR_WORKERS", str(os.cpu_count() or 4)))
+IO_EXECUTOR_WORKERS = int(os.environ.get("IO_EXECUTOR_WORKERS", "32"))
+SIGNAL_EXECUTOR_WORKERS = int(os.environ.get("SIGNAL_EXECUTOR_WORKERS", "32"))
+
+_executors = {}
+_lock = threading.Lock()
+
+
+def get_executor(kind: str) -> ThreadPoolExecutor:
+    """Return the shared executor of `kind`, creating it on first use.
+
+    Parameters
+    ----------
+    kind : str
+        "cpu", "io" or "signal".
+
+    Returns
+    -------
+    ThreadPoolExecutor
+
+    """
+
+    sizes = {"cpu": CPU_EXECUTOR_WORKERS, "io": IO_EXECUTOR_WORKERS,
+             "signal": SIGNAL_EXECUTOR_WORKERS}
+
+    if kind not in sizes:
+        raise ValueError(f"Unknown executor '{kind}', expected 'cpu', 'io' or 'signal'")
+
+    with _lock:
+        if kind not in _executors:
+            _executors[kind] = ThreadPoolExecutor(
+                max_workers=sizes[kind], thread_name_prefix=f"{kind}-executor")
+            logger.info(f"Started {kind} executor with {sizes[kind]} workers")
+
+        return _executors[kind]
+
+
+async def run_in(kind: str, fn: Callable, *args, **kwargs) -> Any:
+    """Run `fn(*args, **kwargs)` on the executor of `kind` and await its
+    result.
+
+    Parameters
+    ----------
+    kind : str
+        "cpu" or "io".
+    fn : Callable
+
+    Returns
+    -------
+    Any
+        The return value of `fn`.
+
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(kind), functools.partial(fn, *args, **kwargs))
+
+
+async def run_cpu(fn: Callable, *args, **kwargs) -> Any:
+    """Run CPU-bound work, e.g. decoding or inference, on the "cpu" executor."""
+    return await run_in("cpu", fn, *args, **kwargs)
+
+
+async def run_io(fn: Callable, *args, **kwargs) -> Any:
+    """Run blocking network calls on the "io" executor."""
+    return await run_in("io", fn, *args, **kwargs)
+
+
+def shutdown():
+    """Shut down the executors, waiting for the running work to finish."""
+
+    with _lock:
+        executors = list(_executors.values())
+        _executors.clear()
+
+    for executor in executors:
+        executor.shutdown(wait=True)
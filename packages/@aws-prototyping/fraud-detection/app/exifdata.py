@@ -9,6 +9,7 @@ from PIL.ExifTags import TAGS
 from geopy.distance import geodesic as GD
 
 from augment import get_all_files_in_directory, IMAGE_EXTENSIONS
+from claim_image import ClaimImage
 from image_search import make_data_url_from_path
 
 codec = 'ISO-8859-1'  # or latin-1
@@ -29,7 +30,8 @@ def get_distances(imagePath, lat: float, lon: float):
 
     Returns:
         list: A list of dictionaries containing GPS data and calculated distances. Each dictionary
-              includes the keys 'lat', 'lon', 'distance', and optionally 'data_url' if 'filepath' is present.
+              includes the keys 'lat', 'lon', 'distance', and optionally 'data_url' if 'filepath'
+              is present.
     """
     df_gps_data = get_gps_data(imagePath)
 
@@ -63,17 +65,22 @@ def decimal_coords(coords, ref):
     return decimal_degrees
 
 
-def get_lat_lon_for_img(img: PIL.Image):
+def _get_exif_for(img) -> dict:
+    # a ClaimImage parses the EXIF of its original file once
+    return img.exif if isinstance(img, ClaimImage) else get_exif(img)
+
+
+def get_lat_lon_for_img(img: PIL.Image.Image | ClaimImage):
     """
     Extracts the latitude and longitude from the EXIF data of an image.
 
     Args:
-        img (PIL.Image): The image from which to extract the EXIF data.
+        img (PIL.Image | ClaimImage): The image from which to extract the EXIF data.
 
     Returns:
         tuple: A tuple containing the latitude and longitude as floats.
     """
-    exif_data = get_exif(img)
+    exif_data = _get_exif_for(img)
 
     lat, lon = get_exif_location(exif_data)
     return lat, lon
@@ -88,8 +95,8 @@ def get_exif_data_for_image(imageFilePath):
 
     lat, lon = get_exif_location(exif_data)
 
-    gps_data_item = {"filepath": imageFilePath, "filename": file_name_with_extension, "exif": exif_data, "lat": lat,
-                     "lon": lon}
+    gps_data_item = {"filepath": imageFilePath, "filename": file_name_with_extension,
+                     "exif": exif_data, "lat": lat, "lon": lon}
 
     return gps_data_item
 
@@ -129,7 +136,8 @@ def _convert_to_degress(value):
 
 def get_exif_location(exif_data):
     """
-    Returns the latitude and longitude, if available, from the provided exif_data (obtained through get_exif_data above)
+    Returns the latitude and longitude, if available, from the provided exif_data (obtained through
+    get_exif_data above)
     """
     lat = None
     lon = None
@@ -151,18 +159,18 @@ def get_exif_location(exif_data):
     return lat, lon
 
 
-def extract_exif_gps_timestamp(img: PIL.Image):
+def extract_exif_gps_timestamp(img: PIL.Image.Image | ClaimImage):
     """
     Extracts the GPS timestamp and datestamp from the EXIF data of an image.
 
     Args:
-        img (PIL.Image): The image from which to extract EXIF data.
+        img (PIL.Image | ClaimImage): The image from which to extract EXIF data.
 
     Returns:
-        datetime.datetime or None: A datetime object representing the GPS timestamp and datestamp if available,
-                                   otherwise None.
+        datetime.datetime or None: A datetime object representing the GPS timestamp and datestamp
+                                   if available, otherwise None.
     """
-    exif_data = get_exif(img)
+    exif_data = _get_exif_for(img)
     # Assuming exif_data is a dictionary containing the EXIF tags and values
 
     # Extract the GPS timestamp and datestamp
@@ -1,50 +1,127 @@
 import ast
-import io
 import os
+import threading
+import time
 
-import PIL
+import PIL.Image
 import boto3
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
+from loguru import logger
 import numpy as np
 from paths import is_running_on_ecs
-from PIL.Image import Image
+from claim_image import ClaimImage
 
 if not is_running_on_ecs():
     load_dotenv(".env")
     
+# The name of the SSM parameter holding the name of the SageMaker endpoint
 SM_ENDPOINT_NAME_SSM_PARAMETER = os.getenv(
-    "SM_ENDPOINT_NAME_SSM_PARAMETER", "fraud-detection-endpoint")  # The name of the SageMaker endpoint
+    "SM_ENDPOINT_NAME_SSM_PARAMETER", "fraud-detection-endpoint")
+
+# Seconds the resolved endpoint name is reused before it is looked up again
+SM_ENDPOINT_CACHE_TTL = float(os.getenv("SM_ENDPOINT_CACHE_TTL", "300"))
+# Seconds a missing endpoint is remembered, so that checks fail fast without any AWS calls
+SM_ENDPOINT_NEGATIVE_CACHE_TTL = float(os.getenv("SM_ENDPOINT_NEGATIVE_CACHE_TTL", "60"))
 
 print('Using endpoint:', SM_ENDPOINT_NAME_SSM_PARAMETER)
 
-def does_endpoint_exist()->bool:
+# Long-lived clients shared by every check, boto3 clients are thread safe
+_clients = {}
+_clients_lock = threading.Lock()
+
+# The last resolution of the endpoint: (endpoint name or None if it does not exist, expiry time)
+_endpoint = None
+_endpoint_lock = threading.Lock()
+
+
+def _get_client(service_name: str):
+    with _clients_lock:
+        if service_name not in _clients:
+            _clients[service_name] = boto3.client(service_name)
+
+        return _clients[service_name]
+
+
+def _lookup_endpoint() -> str | None:
     """
-    Checks if the SageMaker endpoint exists.
+    Reads the SageMaker endpoint name from the parameter store and checks that the endpoint exists.
 
     Returns:
-        bool: True if the endpoint exists, False otherwise.
+        str | None: The endpoint name, or None if there is no such parameter or endpoint.
+
+    Raises:
+        botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError: If the lookup failed
+            for any other reason, e.g. throttling, expired credentials or a network error.
     """
-    
     if not SM_ENDPOINT_NAME_SSM_PARAMETER:
-        return False
-    
-    # Get the value of the SageMaker endpoint name from the parameter store
-    ssm = boto3.client('ssm')
-    ssm_response = ssm.get_parameter(Name=SM_ENDPOINT_NAME_SSM_PARAMETER)
-    SAGEMAKER_ENDPOINT_NAME = ssm_response['Parameter']['Value']
-    
-    client = boto3.client('sagemaker')
+        return None
+
+    ssm = _get_client('ssm')
+
     try:
-        response = client.describe_endpoint(
-            EndpointName=SAGEMAKER_ENDPOINT_NAME
-        )
-        return True
-    except client.exceptions.ClientError as e:
-        if "Could not find endpoint" in str(e):
-            return False
-    except:
-            return False
-    return False
+        # Get the value of the SageMaker endpoint name from the parameter store
+        ssm_response = ssm.get_parameter(Name=SM_ENDPOINT_NAME_SSM_PARAMETER)
+    except ssm.exceptions.ParameterNotFound:
+        logger.warning(f"SSM parameter {SM_ENDPOINT_NAME_SSM_PARAMETER} does not exist")
+        return None
+
+    endpoint_name = ssm_response['Parameter']['Value']
+
+    try:
+        _get_client('sagemaker').describe_endpoint(EndpointName=endpoint_name)
+    except ClientError as e:
+        # SageMaker reports a missing endpoint as a validation error
+        if e.response['Error']['Code'] not in ("ValidationException", "ValidationError"):
+            raise
+        logger.warning(f"SageMaker endpoint {endpoint_name} does not exist: {e}")
+        return None
+
+    return endpoint_name
+
+
+def resolve_endpoint() -> str | None:
+    """
+    Returns the name of the SageMaker endpoint if it exists. The result, including a missing
+    endpoint, is cached for SM_ENDPOINT_CACHE_TTL (SM_ENDPOINT_NEGATIVE_CACHE_TTL if missing)
+    seconds, so that most calls make no AWS calls at all. A failed lookup is not cached.
+
+    Returns:
+        str | None: The endpoint name, or None if the endpoint does not exist.
+
+    Raises:
+        botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError: If the endpoint could
+            not be looked up, see `_lookup_endpoint`.
+    """
+    global _endpoint
+
+    with _endpoint_lock:
+        if _endpoint is None or time.monotonic() >= _endpoint[1]:
+            endpoint_name = _lookup_endpoint()
+            ttl = SM_ENDPOINT_CACHE_TTL if endpoint_name else SM_ENDPOINT_NEGATIVE_CACHE_TTL
+            _endpoint = (endpoint_name, time.monotonic() + ttl)
+
+        return _endpoint[0]
+
+
+def clear_endpoint_cache():
+    """
+    Forgets the resolved endpoint, so that the next check looks it up again.
+    """
+    global _endpoint
+
+    with _endpoint_lock:
+        _endpoint = None
+
+
+def does_endpoint_exist()->bool:
+    """
+    Checks if the SageMaker endpoint exists, see `resolve_endpoint`.
+
+    Returns:
+        bool: True if the endpoint exists, False otherwise.
+    """
+    return resolve_endpoint() is not None
         
 
 def train_model():
@@ -64,12 +141,12 @@ def train_model():
     pass
 
 
-def detect_generated_image(img: PIL.Image):
+def detect_generated_image(img: PIL.Image.Image | ClaimImage):
     """
     Detects whether an image is generated or real using a machine learning model.
 
     Args:
-        img (PIL.Image): The input image to be classified.
+        img (PIL.Image | ClaimImage): The input image to be classified.
 
     Returns:
         dict: A dictionary containing the prediction and confidence level.
@@ -77,27 +154,27 @@ def detect_generated_image(img: PIL.Image):
             - 'confidence' (float): The confidence level of the prediction.
     """
     
-    if not does_endpoint_exist():
+    endpoint_name = resolve_endpoint()
+
+    if endpoint_name is None:
         raise Exception("The SageMaker endpoint does not exist.")
     
-    client = boto3.client('runtime.sagemaker')
-
-    buffer = io.BytesIO()
-    img = img.resize((32, 32), PIL.Image.LANCZOS)
-    img = img.convert('RGB')
-    img.save(buffer, format="JPEG")
-    image_bytes = buffer.getvalue()
+    client = _get_client('runtime.sagemaker')
 
-    # Read the endpoint name from the parameter store
-    ssm = boto3.client('ssm')
-    ssm_response = ssm.get_parameter(Name=SM_ENDPOINT_NAME_SSM_PARAMETER)
+    # 32x32 JPEG
+    image_bytes = ClaimImage.wrap(img).detector_jpeg
 
-    response = client.invoke_endpoint(
-        EndpointName=ssm_response['Parameter']['Value'],
-        Body=image_bytes,
-        # Adjust if your endpoint expects a different format
-        ContentType='application/x-image',
-    )
+    try:
+        response = client.invoke_endpoint(
+            EndpointName=endpoint_name,
+            Body=image_bytes,
+            # Adjust if your endpoint expects a different format
+            ContentType='application/x-image',
+        )
+    except client.exceptions.ValidationError:
+        # e.g. the endpoint was deleted since it was resolved
+        clear_endpoint_cache()
+        raise
 
     result = response['Body'].read().decode('utf-8')
     print(result)
@@ -105,4 +182,5 @@ def detect_generated_image(img: PIL.Image):
     predicted_class = np.argmax(prediction_result)
 
     labels = ['FAKE', 'REAL']
-    return {"prediction": labels[predicted_class], "confidence": prediction_result[predicted_class]}
+    return {"prediction": labels[predicted_class],
+            "confidence": prediction_result[predicted_class]}
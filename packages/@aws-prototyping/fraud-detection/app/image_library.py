@@ -1,23 +1,28 @@
 from datetime import datetime
+import base64
 import io
+import json
+import mimetypes
 import os
 import sys
+import threading
+from collections import OrderedDict
 from typing import List
+import time
 import uuid
-import timm
 import pandas as pd
-import torch
-from torchvision import transforms
-from timm.data import resolve_data_config
-from timm.data.transforms_factory import create_transform
 import PIL
 import PIL.Image
 from schemas.schemas import LibraryImage
 from dotenv import load_dotenv
 import boto3
-from opensearch_manager import ImageEmbeddingManager
-from schemas.schemas import LibraryImageWithScore
-from util.s3 import url_to_base64, make_data_url, generate_presigned_url, upload_image_to_s3
+from boto3.dynamodb.types import TypeDeserializer
+from vector_store import VectorStore, get_vector_store
+from image_search import ImageEncoder
+from claim_image import ClaimImage
+from micro_batch import MICRO_BATCHING_ENABLED, get_batcher
+from schemas.schemas import LibraryImagePage, LibraryImageWithScore, LibraryImageWithThumbnail
+from util.s3 import get_s3_client, s3_object_to_data_url
 from util.file import format_file_size
 from concurrent.futures import ThreadPoolExecutor
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -31,41 +36,83 @@ STORAGE_BUCKET = os.environ.get("STORAGE_BUCKET", "STORAGE_BUCKET")
 LIBRARY_FILES_TABLE = os.environ.get(
     "LIBRARY_FILES_TABLE", "LIBRARY_FILES_TABLE")
 VECTOR_INDEX_NAME = os.environ.get("VECTOR_INDEX_NAME", "VECTOR_INDEX_NAME")
+# Concurrent BatchGetItem calls when hydrating search results
+DYNAMODB_MAX_WORKERS = int(os.environ.get("DYNAMODB_MAX_WORKERS", "8"))
+DYNAMODB_MAX_RETRIES = int(os.environ.get("DYNAMODB_MAX_RETRIES", "5"))
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_MAX_KEYS = 100
+# DeleteObjects accepts at most 1000 keys per call, i.e. the image and thumbnail of 500 library
+# images
+S3_DELETE_MAX_KEYS = 1000
+# Concurrent S3 requests when loading thumbnails
+S3_MAX_WORKERS = int(os.environ.get("S3_MAX_WORKERS", "16"))
+# Number of base64 thumbnails kept in memory
+THUMBNAIL_CACHE_ITEMS = int(os.environ.get("THUMBNAIL_CACHE_ITEMS", "2048"))
 table = dynamodb.Table(LIBRARY_FILES_TABLE)
+# LRU of base64 thumbnail data URLs keyed by thumbnail_s3_key, shared by every S3ImageLibrary
+_thumbnails = OrderedDict()
+_thumbnails_lock = threading.Lock()
 model_name = "hf_hub:timm/vit_base_patch16_224_miil.in21k"
 
 
+def _encode_cursor(last_evaluated_key: dict | None) -> str | None:
+    if not last_evaluated_key:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key).encode()).decode()
+
+
+def _decode_cursor(cursor: str | None) -> dict | None:
+    if not cursor:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(key, dict):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return key
+
+
 class S3ImageLibrary:
     '''
-    S3ImageLibrary is a class that manages an image library stored in S3, with image embeddings indexed in OpenSearch. 
-    It provides functionalities to add, retrieve, delete, and search images within the library.
+    S3ImageLibrary is a class that manages an image library stored in S3, with image embeddings
+    indexed in OpenSearch. It provides functionalities to add, retrieve, delete, and search images
+    within the library.
     '''
 
-    def __init__(self, opensearch_host=OPENSEARCH_ENDPOINT) -> None:
+    def __init__(self, opensearch_host=OPENSEARCH_ENDPOINT,
+                 micro_batching: bool = MICRO_BATCHING_ENABLED,
+                 vector_store: VectorStore = None) -> None:
         """
-        Initializes the S3ImageLibrary with a Vision Transformer (ViT) model and an ImageEmbeddingManager.
+        Initializes the S3ImageLibrary with a Vision Transformer (ViT) model and a vector store.
 
         Args:
-            opensearch_host (str, optional): The OpenSearch endpoint. Defaults to OPENSEARCH_ENDPOINT.
+            opensearch_host (str, optional): The OpenSearch endpoint. Defaults to
+                OPENSEARCH_ENDPOINT.
+            micro_batching (bool, optional): Whether single-image encodes are merged with
+                concurrent requests into one forward pass. Defaults to the ENCODER_MICRO_BATCHING
+                environment variable.
+            vector_store (VectorStore, optional): Where the image embeddings are indexed. Defaults
+                to the process-wide store selected by the VECTOR_STORE environment variable
+                (OpenSearch unless set).
 
         Attributes:
-            _model: The Vision Transformer (ViT) model loaded from timm.
-            _config: The data configuration resolved for the model.
-            _tfms: The transformation pipeline created based on the model configuration.
-            _embeddings_manager: The manager for handling image embeddings with OpenSearch.
+            _encoder: The ImageEncoder wrapping the shared Vision Transformer (ViT) model from the
+                model registry.
+            _batcher: The shared MicroBatcher for the model, or None if micro-batching is disabled.
+            _s3: The shared, pooled S3 client.
+            _vector_store: The VectorStore holding the image embeddings.
         """
-        # Load the ViT model from timm
-        self._model = timm.create_model(
-            model_name, pretrained=True, num_classes=0)
-        self._model.eval()
-
-        self._config = resolve_data_config({}, model=self._model)
-        self._tfms = create_transform(**self._config)
-        self._embeddings_manager = ImageEmbeddingManager(
-            endpoint=opensearch_host, index_name=VECTOR_INDEX_NAME)
+        # The ViT model is loaded once per process by the model registry
+        self._encoder = ImageEncoder(model_name=model_name)
+        self._batcher = get_batcher(model_name) if micro_batching else None
+        self._s3 = get_s3_client()
+        self._vector_store = vector_store or get_vector_store(
+            dim=self._encoder.num_features, endpoint=opensearch_host, index_name=VECTOR_INDEX_NAME)
 
         print(
-            f'Initialized S3ImageLibrary with Opensearch host {opensearch_host}')
+            f'Initialized S3ImageLibrary with {type(self._vector_store).__name__} '
+            f'(Opensearch host {opensearch_host})')
 
     def get_image(self, image_id: str) -> LibraryImage | None:
         """
@@ -83,15 +130,124 @@ class S3ImageLibrary:
             return LibraryImage(**item)
         return None
 
+    def _batch_get_images(self, image_ids: List[str]) -> List[dict]:
+        """
+        Fetches up to BATCH_GET_MAX_KEYS items with a single BatchGetItem call, retrying any
+        unprocessed keys with exponential backoff.
+
+        Args:
+            image_ids (List[str]): The IDs of the images to fetch.
+
+        Returns:
+            List[dict]: The items found.
+
+        Raises:
+            RuntimeError: If some keys are still unprocessed after DYNAMODB_MAX_RETRIES retries, so
+                that images that exist are never reported as missing.
+        """
+        # the low level client is thread safe, unlike the resource
+        client = table.meta.client
+        deserializer = TypeDeserializer()
+        request = {table.name: {"Keys": [{"id": {"S": image_id}} for image_id in image_ids]}}
+        items = []
+
+        for attempt in range(DYNAMODB_MAX_RETRIES + 1):
+            response = client.batch_get_item(RequestItems=request)
+            items.extend(
+                {key: deserializer.deserialize(value) for key, value in item.items()}
+                for item in response.get("Responses", {}).get(table.name, []))
+            request = response.get("UnprocessedKeys") or {}
+
+            if not request:
+                return items
+
+            time.sleep(min(0.05 * 2 ** attempt, 2.0))
+
+        raise RuntimeError(f'{len(request[table.name]["Keys"])} keys still unprocessed after '
+                           f'{DYNAMODB_MAX_RETRIES} retries')
+
+    def get_images_by_id(self, image_ids: List[str]) -> dict[str, LibraryImage]:
+        """
+        Retrieves many images from the library with chunked BatchGetItem calls issued concurrently.
+
+        Args:
+            image_ids (List[str]): The IDs of the images to retrieve.
+
+        Returns:
+            dict[str, LibraryImage]: The images found, keyed by ID.
+
+        Raises:
+            RuntimeError: If DynamoDB keeps throttling some of the lookups.
+        """
+        image_ids = list(dict.fromkeys(image_ids))
+        chunks = [image_ids[i:i + BATCH_GET_MAX_KEYS]
+                  for i in range(0, len(image_ids), BATCH_GET_MAX_KEYS)]
+
+        if len(chunks) == 0:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=min(len(chunks), DYNAMODB_MAX_WORKERS)) as executor:
+            items = [item for chunk in executor.map(self._batch_get_images, chunks)
+                     for item in chunk]
+
+        return {item["id"]: LibraryImage(**item) for item in items}
+
+    def _load_thumbnail(self, thumbnail_s3_key: str) -> str | None:
+        try:
+            return s3_object_to_data_url(STORAGE_BUCKET, thumbnail_s3_key, s3=self._s3)
+        except Exception as e:
+            print(f"Error loading thumbnail {thumbnail_s3_key}: {e}")
+            return None
+
+    def load_thumbnails(self, thumbnail_s3_keys: List[str]) -> dict[str, str | None]:
+        """
+        Loads thumbnails as base64 data URLs, fetching the ones that are not cached concurrently.
+
+        Args:
+            thumbnail_s3_keys (List[str]): The S3 keys of the thumbnails.
+
+        Returns:
+            dict[str, str | None]: The data URL of each thumbnail, or None if it could not be
+                loaded.
+        """
+        thumbnails = {}
+
+        with _thumbnails_lock:
+            for key in dict.fromkeys(thumbnail_s3_keys):
+                if key in _thumbnails:
+                    _thumbnails.move_to_end(key)
+                    thumbnails[key] = _thumbnails[key]
+
+        missing = [key for key in dict.fromkeys(thumbnail_s3_keys) if key not in thumbnails]
+
+        if len(missing) > 0:
+            with ThreadPoolExecutor(max_workers=min(len(missing), S3_MAX_WORKERS)) as executor:
+                loaded = dict(zip(missing, executor.map(self._load_thumbnail, missing)))
+
+            thumbnails.update(loaded)
+
+            with _thumbnails_lock:
+                for key, data_url in loaded.items():
+                    # failures are retried on the next request
+                    if data_url is not None:
+                        _thumbnails[key] = data_url
+
+                while len(_thumbnails) > THUMBNAIL_CACHE_ITEMS:
+                    _thumbnails.popitem(last=False)
+
+        return thumbnails
+
     def format_df(self, df_results: pd.DataFrame) -> pd.DataFrame:
         """
-        Formats the given DataFrame by adding missing columns and populating the 'thumbnail' and 'filesize' columns.
+        Formats the given DataFrame by adding missing columns and populating the 'thumbnail' and
+        'filesize' columns.
 
         Args:
             df_results (pandas.DataFrame): The DataFrame to be formatted.
 
         Returns:
-            pandas.DataFrame: The formatted DataFrame with added columns and populated 'thumbnail' and 'filesize' columns.
+            pandas.DataFrame: The formatted DataFrame with added columns and populated 'thumbnail'
+                and 'filesize' columns.
         """
 
         columns = ['id', 'filename', 'filesize', 'thumbnail']
@@ -103,15 +259,18 @@ class S3ImageLibrary:
         if 'similarity' not in df_results.columns:
             df_results['similarity'] = 0.0
 
-        for idx, row in df_results.iterrows():
-            if "thumbnail_s3_key" in row and row["thumbnail_s3_key"]:
-                base_64_image = url_to_base64(generate_presigned_url(
-                    STORAGE_BUCKET, row['thumbnail_s3_key']))
-                df_results.at[idx, "thumbnail"] = base_64_image
-                df_results.at[idx, "filesize"] = format_file_size(row["size"])
+        if "thumbnail_s3_key" in df_results.columns:
+            keys = df_results["thumbnail_s3_key"].fillna("").tolist()
+            thumbnails = self.load_thumbnails([key for key in keys if key])
+            df_results["thumbnail"] = [
+                thumbnails[key] if key else thumbnail
+                for key, thumbnail in zip(keys, df_results["thumbnail"])]
+            df_results["filesize"] = [
+                format_file_size(size) if key else filesize
+                for key, size, filesize in zip(keys, df_results["size"], df_results["filesize"])]
 
-        df_results = df_results[['filename', 'filesize', 'thumbnail', 'similarity']].sort_values(by="filename",
-                                                                                                 ascending=False)
+        df_results = df_results[['filename', 'filesize', 'thumbnail', 'similarity']].sort_values(
+            by="filename", ascending=False)
 
         return df_results
 
@@ -150,63 +309,162 @@ class S3ImageLibrary:
 
         return images
 
-    def _extract_image_features(self, image: PIL.Image.Image) -> List[float]:
+    def list_images(self, page_size: int = 50,
+                    cursor: str | None = None) -> tuple[List[LibraryImage], str | None]:
+        """
+        Retrieves one page of the library.
+
+        Args:
+            page_size (int, optional): The maximum number of images to return. Defaults to 50.
+            cursor (str, optional): The cursor returned with the previous page. Defaults to the
+                first page.
+
+        Returns:
+            tuple[List[LibraryImage], str | None]: The images, and the cursor of the next page or
+                None if this is the last page.
+
+        Raises:
+            ValueError: If the cursor is invalid.
+        """
+        scan_kwargs = {"Limit": page_size}
+        start_key = _decode_cursor(cursor)
+        if start_key:
+            scan_kwargs["ExclusiveStartKey"] = start_key
+
+        response = table.scan(**scan_kwargs)
+        images = [LibraryImage(**item) for item in response.get('Items', [])]
+
+        return images, _encode_cursor(response.get('LastEvaluatedKey'))
+
+    def count_images(self) -> int:
+        """
+        Returns the number of images in the library. This is answered by the vector store, which
+        keeps an exact document count, so it does not scan the DynamoDB table.
+
+        Returns:
+            int: The number of images.
+        """
+        return self._vector_store.count()
+
+    def get_page(self, page_size: int = 50, cursor: str | None = None,
+                 include_thumbnails: bool = True) -> LibraryImagePage:
+        """
+        Retrieves one page of the library together with the thumbnails of just that page.
+
+        Args:
+            page_size (int, optional): The maximum number of images to return. Defaults to 50.
+            cursor (str, optional): The cursor returned with the previous page. Defaults to the
+                first page.
+            include_thumbnails (bool, optional): Whether to load the thumbnails. Defaults to True.
+
+        Returns:
+            LibraryImagePage: The page of images, the next cursor and the total number of images.
+        """
+        images, next_cursor = self.list_images(page_size, cursor)
+        thumbnails = {}
+
+        if include_thumbnails:
+            thumbnails = self.load_thumbnails(
+                [image.thumbnail_s3_key for image in images if image.thumbnail_s3_key])
+
+        return LibraryImagePage(
+            images=[LibraryImageWithThumbnail(**image.model_dump(),
+                                              thumbnail=thumbnails.get(image.thumbnail_s3_key))
+                    for image in images],
+            next_cursor=next_cursor,
+            total=self.count_images(),
+        )
+
+    def _extract_image_features(self, image: PIL.Image.Image | ClaimImage) -> List[float]:
         """
         Extracts features from an image using a pre-trained model.
 
         Args:
-            image (PIL.Image.Image): The input image to extract features from.
+            image (PIL.Image.Image | ClaimImage): The input image to extract features from. The
+                embedding of a ClaimImage is memoized with it.
 
         Returns:
             List[float]: A list of extracted features as a numpy array.
         """
-        # Load and preprocess the image
-        with torch.no_grad():
-            # Apply the transformation pipeline to the image and stack it into a batch of size 1
-            inputs = torch.stack([self._tfms(image)])
-            # Extract features from the image using the pre-trained model
-            features = self._model(inputs)
-            # Squeeze the features tensor to remove unnecessary dimensions and convert it to a numpy array
-            X_emb = features.squeeze().cpu().numpy()
+        if isinstance(image, ClaimImage):
+            return image.embedding(self._encoder)
+        if self._batcher is not None:
+            return self._batcher.encode(image)
+        return self._encoder.encode(image)
 
-        return X_emb
+    def _extract_images_features(self, images: List[PIL.Image.Image]):
+        """
+        Extracts features from a list of images in batched forward passes.
 
-    def clear_library(self) -> None:
+        Args:
+            images (List[PIL.Image.Image]): The input images to extract features from.
+
+        Returns:
+            numpy.ndarray: An (N, D) float32 matrix with one row of features per image.
+        """
+        return self._encoder.encode_batch(images)
+
+    def clear_library(self) -> int:
         """
         Clears all images from the library. WARNING: This operation is irreversible.
+
+        The table is scanned one page at a time, projecting only the ID and the S3 keys, and each
+        page is deleted before the next one is read, so memory use does not grow with the size of
+        the library.
+
+        Returns:
+            int: The number of images deleted.
         """
-        images = self.get_images()
-        with ThreadPoolExecutor() as executor:
-            executor.map(self.delete_image, (image.id for image in images))
+        page_size = S3_DELETE_MAX_KEYS // 2 * DYNAMODB_MAX_WORKERS
+        scan_kwargs = {"Limit": page_size,
+                       "ProjectionExpression": "#id, image_s3_key, thumbnail_s3_key",
+                       "ExpressionAttributeNames": {"#id": "id"}}
+        n_deleted = 0
+
+        while True:
+            response = table.scan(**scan_kwargs)
+            n_deleted += self._delete_items(response.get("Items", []))
+
+            if "LastEvaluatedKey" not in response:
+                return n_deleted
 
-    def add_image(self, image: PIL.Image.Image, filename: str) -> LibraryImage:
+            scan_kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def _upload_image(self, image: PIL.Image.Image, filename: str,
+                      image_bytes: bytes | None = None, claim_type: str | None = None) -> dict:
         """
-        Adds an image to the library by uploading it to S3, creating a thumbnail, extracting image features, 
-        and indexing the features in OpenSearch.
+        Uploads an image and its thumbnail to S3.
 
         Args:
-            image (PIL.Image.Image): The image to be added.
+            image (PIL.Image.Image): The decoded image.
             filename (str): The filename of the image.
+            image_bytes (bytes, optional): The encoded image file. If given it is uploaded as is,
+                otherwise the image is encoded as PNG.
+            claim_type (str, optional): The type of claim the image was submitted with.
 
         Returns:
-            LibraryImage: An object containing metadata about the added image, including S3 keys, 
-                          creation timestamp, size, and OpenSearch ID.
+            dict: The library item for the image, without its ID.
         """
         image_obj = {}
         temp_id = str(uuid.uuid4())
-        image_obj["image_s3_key"] = f"images/{temp_id}.png"
         image_obj["created_timestamp"] = str(datetime.now())
         image_obj["filename"] = filename
-       # Upload the image to S3
-        buffer = io.BytesIO()
-        image.save(buffer, 'PNG')
-        buffer.seek(0)
-
-        s3 = boto3.client('s3')
-        s3.put_object(Bucket=STORAGE_BUCKET, Key=image_obj["image_s3_key"],
-                      Body=buffer, ContentType='image/png')
-
-        image_obj["size"] = buffer.getbuffer().nbytes
+        if claim_type:
+            image_obj["claim_type"] = claim_type
+
+        if image_bytes is None:
+            buffer = io.BytesIO()
+            image.save(buffer, 'PNG')
+            image_bytes = buffer.getvalue()
+            extension, content_type = ".png", "image/png"
+        else:
+            extension = os.path.splitext(filename)[1].lower() or ".png"
+            content_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+        image_obj["image_s3_key"] = f"images/{temp_id}{extension}"
+        self._s3.put_object(Bucket=STORAGE_BUCKET, Key=image_obj["image_s3_key"],
+                            Body=image_bytes, ContentType=content_type)
+        image_obj["size"] = len(image_bytes)
 
         # upload the thumbnail
         thumbnail = image.copy()
@@ -214,47 +472,242 @@ class S3ImageLibrary:
         thumbnail_s3_key = f"thumbnails/{temp_id}.png"
         buffer = io.BytesIO()
         thumbnail.save(buffer, 'PNG')
-        buffer.seek(0)
-        s3.put_object(Bucket=STORAGE_BUCKET, Key=thumbnail_s3_key,
-                      Body=buffer, ContentType='image/png')
+        self._s3.put_object(Bucket=STORAGE_BUCKET, Key=thumbnail_s3_key,
+                            Body=buffer.getvalue(), ContentType='image/png')
         image_obj["thumbnail_s3_key"] = thumbnail_s3_key
 
+        return image_obj
+
+    @staticmethod
+    def _index_metadata(image_obj: dict) -> dict:
+        """
+        Returns the fields indexed alongside the embedding of an image, which searches can be
+        filtered on.
+        """
+        metadata = {
+            "filename": image_obj["filename"],
+            "created_timestamp":
+                datetime.fromisoformat(image_obj["created_timestamp"]).isoformat(),
+        }
+        if image_obj.get("claim_type"):
+            metadata["claim_type"] = image_obj["claim_type"]
+
+        return metadata
+
+    def add_image(self, image: PIL.Image.Image, filename: str,
+                  claim_type: str | None = None) -> LibraryImage:
+        """
+        Adds an image to the library by uploading it to S3, creating a thumbnail, extracting image
+        features, and indexing the features in OpenSearch.
+
+        Args:
+            image (PIL.Image.Image): The image to be added.
+            filename (str): The filename of the image.
+            claim_type (str, optional): The type of claim the image was submitted with.
+
+        Returns:
+            LibraryImage: An object containing metadata about the added image, including S3 keys, 
+                          creation timestamp, size, and OpenSearch ID.
+        """
+        image_obj = self._upload_image(image, filename, claim_type=claim_type)
+
         # Get the image features
         embeddings = self._extract_image_features(image)
 
         # Index the image features
-        opensearch_id = self._embeddings_manager.add_embedding(embeddings)
+        opensearch_id = self._vector_store.add(embeddings, self._index_metadata(image_obj))
         image_obj["id"] = opensearch_id
         table.put_item(Item=image_obj)
 
         return LibraryImage(**image_obj)
 
+    def add_images(self, images: List[PIL.Image.Image], filenames: List[str],
+                   image_bytes: List[bytes | None] | None = None,
+                   claim_types: List[str | None] | None = None) -> List[LibraryImage]:
+        """
+        Adds a batch of images to the library. The uploads to S3 run concurrently while the batch
+        is encoded in a single forward pass, then the embeddings are indexed with one bulk request
+        and the items written with a DynamoDB batch writer.
+
+        Args:
+            images (List[PIL.Image.Image]): The images to be added.
+            filenames (List[str]): The filename of each image.
+            image_bytes (List[bytes | None], optional): The encoded file of each image, uploaded as
+                is. Images without one are encoded as PNG.
+            claim_types (List[str | None], optional): The type of claim each image was submitted
+                with.
+
+        Returns:
+            List[LibraryImage]: The added images, in the same order.
+        """
+        if len(images) == 0:
+            return []
+
+        image_bytes = image_bytes or [None] * len(images)
+        claim_types = claim_types or [None] * len(images)
+
+        with ThreadPoolExecutor(max_workers=min(len(images), S3_MAX_WORKERS)) as executor:
+            uploads = executor.map(self._upload_image, images, filenames, image_bytes, claim_types)
+            embeddings = self._extract_images_features(images)
+            image_objs = list(uploads)
+
+        ids = self._vector_store.bulk_add(
+            embeddings, [self._index_metadata(image_obj) for image_obj in image_objs])
+
+        with table.batch_writer() as batch:
+            for image_obj, opensearch_id in zip(image_objs, ids):
+                image_obj["id"] = opensearch_id
+                batch.put_item(Item=image_obj)
+
+        return [LibraryImage(**image_obj) for image_obj in image_objs]
+
     def delete_image(self, image_id: str) -> None:
         img = self.get_image(image_id)
-        s3 = boto3.client('s3')
 
-        # download the image from S3 and load into memory
+        if img is not None:
+            self.delete_images([img])
+
+    def _delete_batch(self, items: List[dict]) -> int:
+        """
+        Deletes up to S3_DELETE_MAX_KEYS / 2 images: their image and thumbnail objects with one
+        DeleteObjects call, then their embeddings with one bulk request and their items with a
+        DynamoDB batch writer. An image whose objects could not be deleted is kept, so that
+        deleting it can be retried.
 
-        response = s3.get_object(Bucket=STORAGE_BUCKET, Key=img.image_s3_key)
-        
+        Args:
+            items (List[dict]): The "id", "image_s3_key" and "thumbnail_s3_key" of each image.
+
+        Returns:
+            int: The number of images deleted.
+        """
+        keys = [item[name] for item in items
+                for name in ("image_s3_key", "thumbnail_s3_key") if item.get(name)]
+        failed_keys = set()
+        errors = []
 
-        self._embeddings_manager.remove_embedding(image_id=image_id)
-        table.delete_item(Key={'id': image_id})
-        s3.delete_object(Bucket=STORAGE_BUCKET, Key=img.image_s3_key)
+        # S3 rejects a DeleteObjects request without any objects as malformed
+        if keys:
+            response = self._s3.delete_objects(
+                Bucket=STORAGE_BUCKET,
+                Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True})
+            errors = response.get("Errors", [])
 
-    def search_images(self, image: PIL.Image.Image) -> List[LibraryImageWithScore]:
-        # Load and preprocess the query image
+        for error in errors:
+            print("Failed to delete", error["Key"], error.get("Code"), error.get("Message"))
+            failed_keys.add(error["Key"])
 
-        query_features = self._extract_image_features(image)
+        items = [item for item in items if not failed_keys.intersection(
+            (item.get("image_s3_key"), item.get("thumbnail_s3_key")))]
+
+        if len(items) == 0:
+            return 0
+
+        self._vector_store.bulk_remove([item["id"] for item in items])
+
+        with table.batch_writer() as batch:
+            for item in items:
+                batch.delete_item(Key={'id': item["id"]})
+
+        with _thumbnails_lock:
+            for item in items:
+                _thumbnails.pop(item.get("thumbnail_s3_key"), None)
+
+        return len(items)
+
+    def _delete_items(self, items: List[dict]) -> int:
+        batch_size = S3_DELETE_MAX_KEYS // 2
+        batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+        start = time.perf_counter()
+        n_deleted = 0
+
+        if len(batches) == 0:
+            return 0
+
+        with ThreadPoolExecutor(max_workers=min(len(batches), DYNAMODB_MAX_WORKERS)) as executor:
+            for batch_deleted in executor.map(self._delete_batch, batches):
+                n_deleted += batch_deleted
+                print(f"Deleted {n_deleted}/{len(items)} images "
+                      f"({n_deleted / max(time.perf_counter() - start, 1e-9):.1f} images/sec)")
+
+        if n_deleted < len(items):
+            print(f"Failed to delete {len(items) - n_deleted} images, "
+                  f"they are kept in the library")
+
+        return n_deleted
+
+    def delete_images(self, images: List[LibraryImage]) -> int:
+        """
+        Deletes images from the library, in concurrent batches. No S3 object is downloaded.
+
+        Args:
+            images (List[LibraryImage]): The images to delete.
+
+        Returns:
+            int: The number of images deleted. Images whose S3 objects could not be deleted are
+                kept in the library and not counted.
+        """
+        return self._delete_items([
+            {"id": image.id, "image_s3_key": image.image_s3_key,
+             "thumbnail_s3_key": image.thumbnail_s3_key}
+            for image in images])
+
+    def search_images(self, image: PIL.Image.Image | ClaimImage, k: int = 100,
+                      min_score: float | None = None,
+                      claim_type: str | None = None, created_after: str | None = None,
+                      created_before: str | None = None) -> List[LibraryImageWithScore]:
+        """
+        Searches the library for images similar to the given image, see `search_features`.
+
+        Args:
+            image (PIL.Image.Image | ClaimImage): The query image.
+
+        Returns:
+            List[LibraryImageWithScore]: The similar images, best first.
+        """
+        return self.search_features(self._extract_image_features(image), k=k, min_score=min_score,
+                                    claim_type=claim_type, created_after=created_after,
+                                    created_before=created_before)
+
+    def search_features(self, query_features, k: int = 100, min_score: float | None = None,
+                        claim_type: str | None = None, created_after: str | None = None,
+                        created_before: str | None = None) -> List[LibraryImageWithScore]:
+        """
+        Searches the library for images similar to already extracted query features. The score
+        threshold and the filters are applied by the vector store, so only matching hits are
+        returned and looked up. Images indexed before their metadata was (i.e. without a claim type
+        or timestamp in the index) are excluded from filtered searches.
+
+        Args:
+            query_features: The features of the query image, see `_extract_image_features`.
+            k (int, optional): The maximum number of results. Defaults to 100.
+            min_score (float, optional): The minimum similarity score, `(1 + cos) / 2`.
+            claim_type (str, optional): Only return images submitted with this claim type.
+            created_after (str, optional): Only return images added on or after this ISO date or
+                time.
+            created_before (str, optional): Only return images added on or before this ISO date or
+                time.
+
+        Returns:
+            List[LibraryImageWithScore]: The similar images, best first.
+        """
+        filters = {}
+        if claim_type:
+            filters["claim_type"] = claim_type
+        if created_after or created_before:
+            filters["created_timestamp"] = {
+                op: bound for op, bound in (("gte", created_after), ("lte", created_before))
+                if bound}
 
         # Search for similar images in the OpenSearch index
-        similar_images = self._embeddings_manager.search_embeddings(
-            query_features, n_results=100)
+        similar_images = self._vector_store.search(query_features, k=k, min_score=min_score,
+                                                   filters=filters)
 
         # Retrieve the similar images from the library
+        lib_images = self.get_images_by_id([similar_image.id for similar_image in similar_images])
+
         similar_images_with_score = []
         for similar_image in similar_images:
-            lib_image = self.get_image(similar_image.id)
+            lib_image = lib_images.get(similar_image.id)
 
             if lib_image:
                 similar_image_with_score = LibraryImageWithScore(
@@ -280,3 +733,26 @@ class S3ImageLibrary:
         df_results = self.format_df(df_results)
         print("Image search results:", df_results.to_string())
         return df_results
+
+
+# The library shared by every API request and claim deduction of the process, created on first use
+_image_library = None
+_image_library_lock = threading.Lock()
+
+
+def get_image_library() -> S3ImageLibrary:
+    """
+    Returns the S3ImageLibrary shared by the whole process, created on first use. Creating it loads
+    the model and connects to AWS, so async callers should run it through run_io rather than on the
+    event loop.
+
+    Returns:
+        S3ImageLibrary: The shared library.
+    """
+    global _image_library
+
+    with _image_library_lock:
+        if _image_library is None:
+            _image_library = S3ImageLibrary()
+
+    return _image_library
@@ -0,0 +1,245 @@
+"""Bulk ingestion of images into the S3 image library.
+
+Usage:
+    python library_ingest.py <directory or s3://bucket/prefix> [--checkpoint FILE]
+
+Images are decoded by a pool of threads, one batch ahead of the batch being
+added, so at most two batches of decoded images are held in memory. Each batch
+is added with `S3ImageLibrary.add_images`, i.e. concurrent uploads, one
+batched forward pass, one bulk index request and a DynamoDB batch writer.
+
+Every source that has been added or has failed is appended to the
+checkpoint file once its batch is committed, so an interrupted run can be
+restarted with the same checkpoint. Only the images that were added are
+skipped; failed images are retried.
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, List
+
+import PIL
+import PIL.Image
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from util.s3 import get_s3_client
+
+VALID_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif")
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "64"))
+INGEST_DECODE_WORKERS = int(os.environ.get("INGEST_DECODE_WORKERS", "8"))
+
+
+def _split_s3_url(url: str) -> tuple[str, str]:
+    bucket, _, prefix = url[len("s3://"):].partition("/")
+    return bucket, prefix
+
+
+def iter_sources(source: str, s3=None) -> Iterator[str]:
+    """
+    Lists the images of a local directory (recursively) or of an S3 prefix.
+
+    Args:
+        source (str): A directory, or an s3://bucket/prefix URL.
+        s3 (optional): The S3 client to use. Defaults to the shared client.
+
+    Yields:
+        str: The path or s3:// URL of each image.
+    """
+    if source.startswith("s3://"):
+        bucket, prefix = _split_s3_url(source)
+        paginator = (s3 or get_s3_client()).get_paginator("list_objects_v2")
+
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                if obj["Key"].lower().endswith(VALID_EXTENSIONS):
+                    yield f"s3://{bucket}/{obj['Key']}"
+    else:
+        for path in sorted(Path(source).rglob("*")):
+            if path.is_file() and path.suffix.lower() in VALID_EXTENSIONS:
+                yield path.as_posix()
+
+
+def read_source(source: str, s3=None) -> bytes:
+    """
+    Reads the encoded image file of a source.
+
+    Args:
+        source (str): A path, or an s3://bucket/key URL.
+        s3 (optional): The S3 client to use. Defaults to the shared client.
+
+    Returns:
+        bytes: The file contents.
+    """
+    if source.startswith("s3://"):
+        bucket, key = _split_s3_url(source)
+        return (s3 or get_s3_client()).get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    return Path(source).read_bytes()
+
+
+class IngestCheckpoint:
+    """
+    Append-only record of the sources that have been processed, one JSON object per line. A source
+    that was added has an "id", one that failed has an "error" instead; the last record of a source
+    wins.
+    """
+
+    def __init__(self, fn: str | None):
+        self._fn = fn
+        self.done = set()
+        self.failed = set()
+
+        if fn and Path(fn).exists():
+            with open(fn) as f:
+                self._update([json.loads(line) for line in f if line.strip()])
+
+    def _update(self, records: List[dict]):
+        for record in records:
+            if "error" in record:
+                self.done.discard(record["source"])
+                self.failed.add(record["source"])
+            else:
+                self.failed.discard(record["source"])
+                self.done.add(record["source"])
+
+    def record(self, records: List[dict]):
+        """
+        Appends records to the checkpoint and syncs it to disk.
+
+        Args:
+            records (List[dict]): One dict per source, with a "source" key and either the "id" of
+                the added image or the "error" it failed with.
+        """
+        self._update(records)
+
+        if not self._fn:
+            return
+
+        with open(self._fn, "a") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def ingest(
+        library,
+        source: str,
+        batch_size: int = INGEST_BATCH_SIZE,
+        workers: int = INGEST_DECODE_WORKERS,
+        checkpoint_fn: str | None = None,
+        s3=None,
+) -> dict:
+    """
+    Adds every image of a directory or S3 prefix to the library.
+
+    Args:
+        library (S3ImageLibrary): The library to add the images to.
+        source (str): A directory, or an s3://bucket/prefix URL.
+        batch_size (int, optional): Images per batch. Defaults to INGEST_BATCH_SIZE or 64.
+        workers (int, optional): Threads reading and decoding images. Defaults to
+            INGEST_DECODE_WORKERS or 8.
+        checkpoint_fn (str, optional): Checkpoint file. Sources already added according to it are
+            skipped, and those that failed are retried.
+        s3 (optional): The S3 client used to read s3:// sources. Defaults to the shared client.
+
+    Returns:
+        dict: The number of images "added", "skipped" (already added) and "failed", the "elapsed"
+            seconds and the "images_per_sec".
+    """
+    checkpoint = IngestCheckpoint(checkpoint_fn)
+    sources = list(iter_sources(source, s3=s3))
+    pending = [src for src in sources if src not in checkpoint.done]
+    stats = {"added": 0, "skipped": len(sources) - len(pending), "failed": 0}
+
+    logger.info(f"Ingesting {len(pending)} images from {source} ({stats['skipped']} already done, "
+                f"{len(checkpoint.failed.intersection(pending))} retried)")
+
+    def decode(src):
+        try:
+            image_bytes = read_source(src, s3=s3)
+            image = PIL.Image.open(io.BytesIO(image_bytes)).convert("RGB")
+            return src, image_bytes, image, None
+        except Exception as e:
+            return src, None, None, str(e)
+
+    def decode_batch(offset):
+        return executor.map(decode, pending[offset:offset + batch_size])
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        next_batch = decode_batch(0)
+
+        for offset in range(0, len(pending), batch_size):
+            batch = list(next_batch)
+
+            # decode the next batch while this one is added
+            if offset + batch_size < len(pending):
+                next_batch = decode_batch(offset + batch_size)
+
+            decoded = [(src, data, image) for src, data, image, error in batch if error is None]
+            records = [{"source": src, "error": error}
+                       for src, _, _, error in batch if error is not None]
+
+            for record in records:
+                logger.warning(f"Skipping {record['source']}: {record['error']}")
+
+            try:
+                added = library.add_images(
+                    [image for _, _, image in decoded],
+                    [os.path.basename(src) for src, _, _ in decoded],
+                    [data for _, data, _ in decoded],
+                )
+                records += [{"source": src, "id": image.id}
+                            for (src, _, _), image in zip(decoded, added)]
+            except Exception as e:
+                logger.exception(f"Failed to add a batch of {len(decoded)} images: {e}")
+                added = []
+                records += [{"source": src, "error": str(e)} for src, _, _ in decoded]
+
+            checkpoint.record(records)
+
+            stats["added"] += len(added)
+            stats["failed"] += len(batch) - len(added)
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"{offset + len(batch)}/{len(pending)} images, "
+                f"{(offset + len(batch)) / max(elapsed, 1e-9):.1f} images/sec")
+
+    stats["elapsed"] = time.perf_counter() - start
+    stats["images_per_sec"] = stats["added"] / max(stats["elapsed"], 1e-9)
+
+    logger.info(
+        f"Added {stats['added']} images in {stats['elapsed']:.1f}s "
+        f"({stats['images_per_sec']:.1f} images/sec), {stats['failed']} failed")
+
+    return stats
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description="Bulk add images to the S3 image library.")
+    parser.add_argument("source", help="A local directory or an s3://bucket/prefix URL.")
+    parser.add_argument("--checkpoint", default=None,
+                        help="Checkpoint file, re-run with the same file to resume an "
+                             "interrupted ingest.")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=INGEST_DECODE_WORKERS)
+    args = parser.parse_args(argv)
+
+    from image_library import S3ImageLibrary
+
+    ingest(S3ImageLibrary(micro_batching=False), args.source, batch_size=args.batch_size,
+           workers=args.workers, checkpoint_fn=args.checkpoint)
+
+
+if __name__ == "__main__":
+    main()
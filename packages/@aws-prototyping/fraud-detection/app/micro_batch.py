@@ -0,0 +1,213 @@
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import PIL
+import numpy as np
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from image_search import ImageEncoder
+from model_registry import canonical_model_name
+from paths import is_running_on_lambda
+
+# Lambda serves one request per container, so there is nothing to merge there.
+MICRO_BATCHING_ENABLED = os.environ.get(
+    "ENCODER_MICRO_BATCHING", str(not is_running_on_lambda())).lower() == "true"
+MAX_BATCH_SIZE = int(os.environ.get("ENCODER_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.environ.get("ENCODER_BATCH_WAIT_MS", "10"))
+
+_batchers = {}
+_lock = threading.Lock()
+
+
+class MicroBatcher:
+    """Merges concurrent single-image encode requests into one forward pass.
+
+    Callers on any thread submit an image and block on the returned future. A
+    single worker thread takes the first pending request, then keeps collecting
+    requests until either `max_batch_size` images are queued or `max_wait_ms`
+    has elapsed, and encodes them together with `ImageEncoder.encode_batch`.
+
+    """
+
+    def __init__(
+            self,
+            encoder: ImageEncoder,
+            max_batch_size: int = MAX_BATCH_SIZE,
+            max_wait_ms: float = MAX_WAIT_MS,
+    ):
+        """Constructor.
+
+        Parameters
+        ----------
+        encoder : ImageEncoder
+        max_batch_size : int, default=ENCODER_MAX_BATCH_SIZE or 16
+        max_wait_ms : float, default=ENCODER_BATCH_WAIT_MS or 10
+            How long to wait for more requests after the first one arrives.
+
+        """
+
+        self._encoder = encoder
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue = queue.Queue()
+        self._closed = False
+        self.batches = 0
+        self.images = 0
+        self._worker = threading.Thread(
+            target=self._run, name="micro-batcher", daemon=True)
+        self._worker.start()
+        return
+
+    def submit(self, img: PIL.Image) -> Future:
+        """Queue an image for encoding.
+
+        Parameters
+        ----------
+        img : PIL.Image
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the 1D embedding of `img`.
+
+        """
+
+        if self._closed:
+            raise RuntimeError("MicroBatcher has been closed")
+
+        future = Future()
+
+        # cache hits are answered immediately rather than waiting for a batch
+        key = self._encoder.cache_key(img)
+        x_emb = self._encoder.cache.get(key)
+
+        if x_emb is not None:
+            future.set_result(x_emb)
+            return future
+
+        self._queue.put((img, key, future))
+        return future
+
+    def encode(self, img: PIL.Image) -> np.ndarray:
+        """Encode a single image, sharing a forward pass with any concurrent
+        requests.
+
+        Parameters
+        ----------
+        img : PIL.Image
+
+        Returns
+        -------
+        np.ndarray
+
+        """
+
+        return self.submit(img).result()
+
+    def close(self):
+        """Stop the worker thread once the pending requests are served."""
+
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+        return
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self._max_wait
+
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is None:
+                # re-queue the sentinel so the run loop exits after this batch
+                self._queue.put(None)
+                break
+
+            batch.append(item)
+
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+
+            if first is None:
+                return
+
+            batch = [(img, key, future) for img, key, future in self._collect(first)
+                     if future.set_running_or_notify_cancel()]
+
+            if len(batch) == 0:
+                continue
+
+            try:
+                # the cache was already checked in submit()
+                X_emb = self._encoder.encode_batch(
+                    [img for img, _, _ in batch], use_cache=False)
+            except Exception:
+                logger.exception(
+                    f"Micro-batch of {len(batch)} images failed, encoding them one at a time")
+                self._run_one_at_a_time(batch)
+                continue
+
+            self.batches += 1
+            self.images += len(batch)
+
+            for (_, key, future), x_emb in zip(batch, X_emb):
+                self._encoder.cache.put(key, x_emb)
+                future.set_result(x_emb)
+
+    def _run_one_at_a_time(self, batch):
+        # isolate the images that failed the batch, so that they do not fail
+        # the unrelated requests they were batched with
+        for img, key, future in batch:
+            try:
+                x_emb = self._encoder.encode_batch([img], use_cache=False)[0]
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.images += 1
+            self._encoder.cache.put(key, x_emb)
+            future.set_result(x_emb)
+
+
+def get_batcher(model_name: str) -> MicroBatcher:
+    """Return the process-wide micro-batcher for `model_name`, creating it on
+    first use.
+
+    Parameters
+    ----------
+    model_name : str
+
+    Returns
+    -------
+    MicroBatcher
+
+    """
+
+    key = canonical_model_name(model_name)
+
+    with _lock:
+        batcher = _batchers.get(key)
+
+        if batcher is None:
+            batcher = MicroBatcher(ImageEncoder(model_name=key))
+            _batchers[key] = batcher
+
+    return batcher
@@ -0,0 +1,346 @@
+import copy
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import PIL
+import PIL.Image
+import numpy as np
+import timm
+import torch
+from loguru import logger
+from timm.data import resolve_data_config
+from timm.data.transforms_factory import create_transform
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODEL_NAME = "vit_base_patch16_224_miil.in21k"
+
+# Inference backends:
+#   "torch" - eager fp32 torch (default)
+#   "int8"  - torch with dynamic int8 quantization of the linear layers
+#   "onnx"  - fp32 model exported to ONNX and run with ONNX Runtime
+BACKENDS = ("torch", "int8", "onnx")
+DEFAULT_BACKEND = os.environ.get("ENCODER_BACKEND", "torch")
+# Exported models are named after the model and the fingerprint of its weights
+ONNX_CACHE_DIR = os.environ.get(
+    "ENCODER_ONNX_DIR", os.path.join(tempfile.gettempdir(), "fraud-detection-onnx"))
+
+# Prefix used when a timm model is referenced by its huggingface hub id. The
+# hub id and the bare timm name resolve to the same pretrained weights, so
+# both spellings share a single registry entry.
+_HF_HUB_TIMM_PREFIX = "hf_hub:timm/"
+
+_models = {}
+_status = {}
+_lock = threading.Lock()
+
+
+def weights_fingerprint(model: torch.nn.Module) -> str:
+    """Hash the parameters and buffers of a model.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+
+    Returns
+    -------
+    str
+        A short hex digest that changes whenever any weight changes.
+
+    """
+
+    digest = hashlib.sha256()
+
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+class RegisteredModel:
+    """A loaded image encoder model together with its pre-processing
+    transforms. Instances are shared by every `ImageEncoder` in the process, so
+    they must be treated as read-only.
+
+    `fingerprint` identifies the fp32 weights, and is shared by the backends
+    derived from them.
+
+    """
+
+    def __init__(self, name: str, model: torch.nn.Module, backend: str = "torch", session=None,
+                 fingerprint: str = None):
+        self.name = name
+        self.backend = backend
+        self.model = model
+        self.model.eval()
+        self.session = session
+        self.fingerprint = fingerprint or weights_fingerprint(self.model)
+        self.num_features = getattr(self.model, "num_features", 0)
+        self.config = resolve_data_config({}, model=self.model)
+        self.tfms = create_transform(**self.config)
+        self.loaded_at = time.time()
+        self.warmed_up = False
+
+    def embed(self, inputs: torch.Tensor) -> np.ndarray:
+        """Run the model over a batch of pre-processed images.
+
+        Parameters
+        ----------
+        inputs : torch.Tensor
+            (N, C, H, W) tensor produced by stacking `tfms(img)` outputs.
+
+        Returns
+        -------
+        np.ndarray
+            (N, D) float32 embeddings.
+
+        """
+
+        if self.session is not None:
+            input_name = self.session.get_inputs()[0].name
+            features = self.session.run(None, {input_name: inputs.numpy()})[0]
+            return features.reshape(len(inputs), -1).astype(np.float32, copy=False)
+
+        with torch.no_grad():
+            features = self.model(inputs)
+
+        return features.reshape(len(inputs), -1).cpu().numpy().astype(np.float32, copy=False)
+
+
+def _registry_key(name: str, backend: str) -> str:
+    return name if backend == "torch" else f"{name}[{backend}]"
+
+
+def _quantize_int8(entry: RegisteredModel) -> RegisteredModel:
+    model = torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(entry.model), {torch.nn.Linear}, dtype=torch.qint8)
+    return RegisteredModel(entry.name, model, backend="int8", fingerprint=entry.fingerprint)
+
+
+def _export_onnx(entry: RegisteredModel) -> RegisteredModel:
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise ImportError(
+            "The onnx encoder backend requires the onnx and onnxruntime packages") from e
+
+    # the export is only reused for the exact weights it was made from
+    onnx_fn = Path(ONNX_CACHE_DIR, f"{entry.name.replace('/', '_')}.{entry.fingerprint}.onnx")
+
+    if not onnx_fn.exists():
+        logger.info(f"Exporting {entry.name} to {onnx_fn}")
+        onnx_fn.parent.mkdir(parents=True, exist_ok=True)
+        size = entry.config.get("input_size", (3, 224, 224))
+        tmp_fn = onnx_fn.with_suffix(f".{os.getpid()}.tmp")
+        torch.onnx.export(
+            entry.model,
+            torch.zeros((1, *size)),
+            tmp_fn.as_posix(),
+            input_names=["input"],
+            output_names=["embedding"],
+            dynamic_axes={"input": {0: "batch"}, "embedding": {0: "batch"}},
+            opset_version=17,
+            dynamo=False,
+        )
+        os.replace(tmp_fn, onnx_fn)
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = ort.InferenceSession(
+        onnx_fn.as_posix(), sess_options=options, providers=["CPUExecutionProvider"])
+
+    return RegisteredModel(
+        entry.name, entry.model, backend="onnx", session=session, fingerprint=entry.fingerprint)
+
+
+def canonical_model_name(model_name: str) -> str:
+    """Normalise a timm model name so that the hub id and the bare name map to
+    the same registry key.
+
+    Parameters
+    ----------
+    model_name : str
+
+    Returns
+    -------
+    str
+
+    """
+
+    if model_name.startswith(_HF_HUB_TIMM_PREFIX):
+        return model_name[len(_HF_HUB_TIMM_PREFIX):]
+
+    return model_name
+
+
+def register_model(model_name: str, model: torch.nn.Module) -> RegisteredModel:
+    """Register an already constructed fp32 model under `model_name`, replacing
+    any existing entry and any backends derived from it. Useful for models that
+    are not loaded through timm. Embeddings cached for the previous weights are
+    not reused, since the cache keys include the weights fingerprint.
+
+    Parameters
+    ----------
+    model_name : str
+    model : torch.nn.Module
+
+    Returns
+    -------
+    RegisteredModel
+
+    """
+
+    key = canonical_model_name(model_name)
+    entry = RegisteredModel(key, model)
+
+    with _lock:
+        for backend in BACKENDS:
+            _models.pop(_registry_key(key, backend), None)
+            _status.pop(_registry_key(key, backend), None)
+        _models[key] = entry
+        _status[key] = "loaded"
+
+    return entry
+
+
+def _load(key: str, backend: str) -> RegisteredModel:
+    # must be called with _lock held
+    if backend == "torch":
+        logger.info(f"Loading model {key}")
+        model = timm.create_model(key, pretrained=True, num_classes=0)
+        return RegisteredModel(key, model)
+
+    base = _models.get(key) or _load(key, "torch")
+    _models[key] = base
+    _status.setdefault(key, "loaded")
+
+    logger.info(f"Building {backend} backend for model {key}")
+    if backend == "int8":
+        return _quantize_int8(base)
+
+    return _export_onnx(base)
+
+
+def get_model(model_name: str = DEFAULT_MODEL_NAME, backend: str = None) -> RegisteredModel:
+    """Return the shared model for `model_name` and `backend`, loading it on
+    first use.
+
+    Loading happens at most once per process; concurrent callers block until
+    the first load completes. The quantized and ONNX backends are derived from
+    the fp32 model.
+
+    Parameters
+    ----------
+    model_name : str, default="vit_base_patch16_224_miil.in21k"
+    backend : str, default=None
+        One of `BACKENDS`. Defaults to the ENCODER_BACKEND environment variable,
+        or "torch" if it is not set.
+
+    Returns
+    -------
+    RegisteredModel
+
+    """
+
+    backend = backend or DEFAULT_BACKEND
+
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Unknown encoder backend '{backend}', expected one of {BACKENDS}")
+
+    key = canonical_model_name(model_name)
+    registry_key = _registry_key(key, backend)
+    entry = _models.get(registry_key)
+
+    if entry is not None:
+        return entry
+
+    with _lock:
+        entry = _models.get(registry_key)
+
+        if entry is None:
+            _status[registry_key] = "loading"
+            start = time.perf_counter()
+
+            try:
+                entry = _load(key, backend)
+            except Exception:
+                _status[registry_key] = "failed"
+                raise
+
+            _models[registry_key] = entry
+            _status[registry_key] = "loaded"
+            logger.info(
+                f"Loaded model {registry_key} in {time.perf_counter() - start:.2f}s")
+
+    return entry
+
+
+def warm_up(model_name: str = DEFAULT_MODEL_NAME, backend: str = None) -> RegisteredModel:
+    """Load the model (if required) and run a single inference on a blank
+    image so that the first real request does not pay for lazy
+    initialisation inside torch or ONNX Runtime.
+
+    Parameters
+    ----------
+    model_name : str, default="vit_base_patch16_224_miil.in21k"
+    backend : str, default=None
+
+    Returns
+    -------
+    RegisteredModel
+
+    """
+
+    entry = get_model(model_name, backend)
+    size = entry.config.get("input_size", (3, 224, 224))[1:]
+    img = PIL.Image.new("RGB", (size[1], size[0]), color="white")
+
+    start = time.perf_counter()
+    entry.embed(torch.stack([entry.tfms(img)]))
+
+    entry.warmed_up = True
+    _status[_registry_key(entry.name, entry.backend)] = "ready"
+    logger.info(
+        f"Warmed up model {entry.name} ({entry.backend}) in {time.perf_counter() - start:.2f}s")
+
+    return entry
+
+
+def is_ready(model_name: str = DEFAULT_MODEL_NAME, backend: str = None) -> bool:
+    """Check if the model has been loaded and warmed up.
+
+    Parameters
+    ----------
+    model_name : str, default="vit_base_patch16_224_miil.in21k"
+    backend : str, default=None
+
+    Returns
+    -------
+    bool
+
+    """
+
+    key = _registry_key(canonical_model_name(model_name), backend or DEFAULT_BACKEND)
+    entry = _models.get(key)
+    return entry is not None and entry.warmed_up
+
+
+def get_status() -> dict:
+    """Return the load status of every model known to the registry.
+
+    Returns
+    -------
+    dict
+        Mapping of model name (suffixed with the backend for non-torch
+        backends) to one of "loading", "loaded", "ready" or "failed".
+
+    """
+
+    return dict(_status)
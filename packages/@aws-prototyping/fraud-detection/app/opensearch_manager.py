@@ -1,36 +1,133 @@
 import os
 import sys
+import threading
+from urllib.parse import urlparse
+
 import boto3
 from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
-from botocore.auth import SigV4Auth
-from botocore.awsrequest import AWSRequest
-import requests
-from urllib.parse import urlparse
 from schemas.schemas import EmbeddingsSearchResult
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from vector_store import OpenSearchVectorStore
+
+# Connections kept open per OpenSearch endpoint
+OPENSEARCH_POOL_MAXSIZE = int(os.environ.get("OPENSEARCH_POOL_MAXSIZE", "20"))
+# Seconds before a request to OpenSearch times out
+OPENSEARCH_TIMEOUT = float(os.environ.get("OPENSEARCH_TIMEOUT", "10"))
+OPENSEARCH_MAX_RETRIES = int(os.environ.get("OPENSEARCH_MAX_RETRIES", "3"))
+
+# One long-lived client per endpoint, shared by every ImageEmbeddingManager and vector store
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def create_opensearch_client(
+        endpoint: str,
+        http_auth=None,
+        pool_maxsize: int = OPENSEARCH_POOL_MAXSIZE,
+        timeout: float = OPENSEARCH_TIMEOUT,
+        max_retries: int = OPENSEARCH_MAX_RETRIES,
+) -> OpenSearch:
+    """
+    Creates a connection-pooled OpenSearch client.
+
+    Args:
+        endpoint (str): The OpenSearch endpoint, with or without the https:// scheme.
+        http_auth (optional): The request authentication, e.g. an `AWSV4SignerAuth`.
+        pool_maxsize (int, optional): Connections kept open. Defaults to
+            OPENSEARCH_POOL_MAXSIZE or 20.
+        timeout (float, optional): Request timeout in seconds. Defaults to
+            OPENSEARCH_TIMEOUT or 10.
+        max_retries (int, optional): Retries on connection errors and timeouts. Defaults to
+            OPENSEARCH_MAX_RETRIES or 3.
+
+    Returns:
+        OpenSearch: The client.
+    """
+    url = urlparse(endpoint if "://" in endpoint else f"https://{endpoint}")
+    use_ssl = url.scheme == "https"
+
+    return OpenSearch(
+        hosts=[{'host': url.hostname, 'port': url.port or (443 if use_ssl else 80)}],
+        http_auth=http_auth,
+        pool_maxsize=pool_maxsize,
+        timeout=timeout,
+        max_retries=max_retries,
+        retry_on_timeout=True,
+        use_ssl=use_ssl,
+        verify_certs=use_ssl,
+        connection_class=RequestsHttpConnection
+    )
+
+
+def get_opensearch_client(endpoint: str) -> OpenSearch:
+    """
+    Returns the shared SigV4 signed client of an OpenSearch Serverless endpoint, creating it on
+    first use.
+
+    The client signs every request with the refreshable credentials of the default boto3 session,
+    so temporary credentials (e.g. of a Lambda or ECS task role) are renewed without recreating the
+    client.
+
+    Args:
+        endpoint (str): The OpenSearch endpoint.
+
+    Returns:
+        OpenSearch: The client.
+    """
+    with _clients_lock:
+        if endpoint not in _clients:
+            session = boto3.Session()
+            auth = AWSV4SignerAuth(session.get_credentials(), session.region_name, 'aoss')
+            _clients[endpoint] = create_opensearch_client(endpoint, http_auth=auth)
 
-class ImageEmbeddingManager:
+        return _clients[endpoint]
+
+
+def connection_metrics(client: OpenSearch) -> dict:
+    """
+    Reports how well a client reuses its pooled connections.
+
+    Args:
+        client (OpenSearch): A client created by `create_opensearch_client`.
+
+    Returns:
+        dict: The number of "requests" sent, "connections" opened and the "reuse_ratio", i.e. the
+            fraction of requests sent on an already open connection.
+    """
+    n_requests, n_connections = 0, 0
+
+    for connection in client.transport.connection_pool.connections:
+        for adapter in set(connection.session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                n_requests += pool.num_requests
+                n_connections += pool.num_connections
+
+    return {
+        "requests": n_requests,
+        "connections": n_connections,
+        "reuse_ratio": 1 - n_connections / n_requests if n_requests else 0.0,
+    }
+
+
+def get_connection_metrics() -> dict:
+    """
+    Returns the connection metrics of every shared client, keyed by endpoint.
+    """
+    with _clients_lock:
+        clients = dict(_clients)
+
+    return {endpoint: connection_metrics(client) for endpoint, client in clients.items()}
 
-    def __init__(self, endpoint, index_name):
-        session = boto3.Session()
-        credentials = session.get_credentials()
-        auth = AWSV4SignerAuth(credentials,session.region_name, 'aoss')
-        
-        host = endpoint.replace("https://", "")
-        
-        self._host = host
-        self.client = OpenSearch(
-            hosts=[{'host': host, 'port': 443}],
-            http_auth=auth,
-            pool_maxsize=20,
-            use_ssl=True,
-            verify_certs=True,
-            connection_class=RequestsHttpConnection
-        )
 
+class ImageEmbeddingManager:
+
+    def __init__(self, endpoint, index_name, client=None):
+        self.client = client or get_opensearch_client(endpoint)
         self._imageindex_name = index_name
+        self._store = OpenSearchVectorStore(index_name=index_name, client=self.client)
 
     def add_embedding(self,  embedding) -> str:
         """
@@ -45,117 +142,110 @@ class ImageEmbeddingManager:
         Raises:
             Exception: If there is an error adding the embedding to the index.
         """
-
-        doc = {
-            'embedding': embedding.tolist()
-        }
         try:
-
-            resp = self.client.index(index=self._imageindex_name, body=doc)
-            print(
-                f"Successfully added embedding - response {resp}")
-            return resp["_id"]
+            doc_id = self._store.add(embedding)
+            print(f"Successfully added embedding {doc_id}")
+            return doc_id
         except Exception as e:
             print(f"Error adding embedding: {e}")
 
+    def bulk_add_embeddings(self, embeddings) -> list[str]:
+        """
+        Adds embeddings to the OpenSearch index with a single _bulk request.
+
+        Args:
+            embeddings (numpy.ndarray): An (N, D) matrix of embeddings.
+
+        Returns:
+            list[str]: The IDs of the added documents, in the same order.
+        """
+        return self._store.bulk_add(embeddings)
+
     def remove_embedding(self, image_id: str):
         """
         Removes an embedding from the OpenSearch index based on the provided image ID.
 
         Args:
             image_id (str): The ID of the image whose embedding is to be removed.
-
-        Raises:
-            Exception: If there is an error during the removal process.
-
-        This method sends a DELETE request to the OpenSearch service to remove the document
-        associated with the given image ID. It uses AWS SigV4 for request signing.
         """
         try:
+            self._store.remove(image_id)
+            print(f"Successfully removed embedding for {image_id}")
+        except Exception as e:
+            print(f"Error removing embedding for {image_id}: {e}")
 
-            session = boto3.Session()
-            credentials = session.get_credentials()
-
-            # Prepare the request
-            method = 'DELETE'
-
-            url = f"https://{self._host}/{self._imageindex_name}/_doc/{image_id}"
-            parsed_url = urlparse(url)
-            print(parsed_url)
-            headers = {}  # Initialize an empty headers dictionary
+    def bulk_remove_embeddings(self, image_ids: list[str]):
+        """
+        Removes embeddings from the OpenSearch index with a single _bulk request.
 
-            # Create the request object
-            request = AWSRequest(method=method, url=url, headers=headers)
+        Args:
+            image_ids (list[str]): The IDs of the images whose embeddings are to be removed.
+        """
+        self._store.bulk_remove(image_ids)
 
-            # Sign the request
-            SigV4Auth(credentials, 'aoss', parsed_url.netloc.split(
-                '.')[1]).add_auth(request)
+    def count_embeddings(self) -> int:
+        """
+        Returns the number of embeddings in the OpenSearch index.
+        """
+        return self._store.count()
 
-            # Send the request
-            response = requests.request(method,
-                                        url,
-                                        headers=dict(request.headers),
-                                        verify=True, timeout=5)
+    def connection_metrics(self) -> dict:
+        """
+        Returns the connection reuse metrics of the client, see `connection_metrics`.
+        """
+        return connection_metrics(self.client)
 
-            # Check the response
-            if response.status_code in [200, 204]:
-                print(f"Successfully removed embedding for {image_id}")
+    def create_index(self, dimension: int = 768):
+        """
+        Creates the kNN index with explicit mappings for the metadata fields that searches are
+        filtered on. They are mapped like OpenSearch's dynamic mapping would, i.e. strings as
+        `text` with a `keyword` sub-field, so that `vector_store.filter_clause` works the same on
+        indexes created from the console.
 
-            else:
-                print(
-                    f"Failed to delete index. Status code: {response.status_code}")
-                print(f"Response: {response.text}")
+        The lucene engine is used as it supports efficient filtering, and its `cosinesimil` scores
+        are `(1 + cos) / 2` like those of the local vector stores.
 
-        except Exception as e:
-            print(f"Error removing embedding for {image_id}: {e}")
+        Args:
+            dimension (int, optional): Dimensionality of the embeddings. Defaults to 768.
+        """
+        self.client.indices.create(index=self._imageindex_name, body={
+            "settings": {"index.knn": True},
+            "mappings": {
+                "properties": {
+                    "embedding": {
+                        "type": "knn_vector",
+                        "dimension": dimension,
+                        "method": {
+                            "name": "hnsw", "engine": "lucene", "space_type": "cosinesimil"},
+                    },
+                    "filename": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+                    "claim_type": {"type": "text", "fields": {"keyword": {"type": "keyword"}}},
+                    "created_timestamp": {"type": "date"},
+                }
+            },
+        })
 
-    def search_embeddings(self, query_embedding, n_results=10) -> list[EmbeddingsSearchResult]:
+    def search_embeddings(self, query_embedding, n_results=10, min_score=None,
+                          filters=None) -> list[EmbeddingsSearchResult]:
         """
         Searches for embeddings in the OpenSearch index based on a given query embedding.
 
         Args:
             query_embedding (ndarray): The query embedding to search for.
-            n_results (int, optional): The number of results to return. Defaults to 10.
+            n_results (int, optional): The number of results to return, i.e. the k of the kNN
+                query. Defaults to 10.
+            min_score (float, optional): Only return hits scoring at least this, see
+                `vector_store.cosine_to_score` to convert a cosine similarity.
+            filters (dict, optional): Metadata filters applied during the kNN search, e.g.
+                {"claim_type": "Motor", "created_timestamp": {"gte": "2024-01-01"}}. Documents
+                indexed without metadata never match a filter.
 
         Returns:
-            list: A list of image paths corresponding to the search results.
-
-        Raises:
-            Exception: If an error occurs while searching for embeddings.
+            list[EmbeddingsSearchResult]: The hits, best first.
         """
-        script_query = {
-            "knn": {
-                "embedding": {
-                    "vector": query_embedding,
-                    "k": 10,
-                }
-            }
-        }
-
         try:
-            res = self.client.search(
-                index=self._imageindex_name,
-                body={
-                    "_source": {"excludes": ["embedding"]},
-                    "size": n_results,
-                    "query": script_query,
-                    "sort": [
-                        {
-                            "_score": {
-                                "order": "desc"
-                            }
-                        }
-                    ]
-                }
-            )
-
-            results = []
-            for hit in res['hits']['hits']:
-                result = EmbeddingsSearchResult(
-                    id=hit['_id'], score=hit['_score'])
-                results.append(result)
-
-            return results
+            return self._store.search(
+                query_embedding, k=n_results, min_score=min_score, filters=filters)
         except Exception as e:
             print(f"Error searching for embeddings: {e}")
             return []
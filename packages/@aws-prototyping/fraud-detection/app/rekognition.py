@@ -7,16 +7,28 @@ from PIL import ImageFont
 from PIL.Image import Image
 
 from paths import is_running_on_ecs
+from claim_image import ClaimImage
 
+# Largest image Rekognition accepts as raw bytes
+REKOGNITION_MAX_BYTES = 5 * 1024 * 1024
 
-def detect_labels_in_image(img, confidence_threshold=90):
+
+def detect_labels_in_image(img: Image | ClaimImage, confidence_threshold=90):
     # Initialize Rekognition client
     rekognition = boto3.client('rekognition')
 
-    # Convert the image to bytes
-    img_byte_array = io.BytesIO()
-    img.save(img_byte_array, format=img.format)
-    image_bytes = img_byte_array.getvalue()
+    if isinstance(img, ClaimImage):
+        # Send the original file if Rekognition accepts it, so it is not re-encoded
+        if (img.content_type in ("image/jpeg", "image/png")
+                and len(img.data) <= REKOGNITION_MAX_BYTES):
+            image_bytes = img.data
+        else:
+            image_bytes = img.description_jpeg
+    else:
+        # Convert the image to bytes
+        img_byte_array = io.BytesIO()
+        img.save(img_byte_array, format=img.format)
+        image_bytes = img_byte_array.getvalue()
 
     # Use Rekognition to detect labels
     response = rekognition.detect_labels(Features=["GENERAL_LABELS"], Image={'Bytes': image_bytes})
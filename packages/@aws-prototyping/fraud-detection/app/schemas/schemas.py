@@ -1,6 +1,6 @@
 from datetime import datetime
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 
 class LibraryImage(BaseModel):
@@ -13,6 +13,7 @@ class LibraryImage(BaseModel):
         filename (str): The name of the image file.
         created_timestamp (str): The timestamp when the image was created.
         size (int): The size of the image in bytes.
+        claim_type (str, optional): The type of claim the image was submitted with.
     """
 
     id: str
@@ -21,6 +22,7 @@ class LibraryImage(BaseModel):
     filename: str
     created_timestamp: str
     size: int
+    claim_type: Optional[str] = None
     
 class DeductionResult(BaseModel):
     """
@@ -31,7 +33,8 @@ class DeductionResult(BaseModel):
     validated and serialized.
 
     Attributes:
-        deduction (str): A string representing the result of the claim deduction (whether fraud is detected and the confidence)
+        deduction (str): A string representing the result of the claim deduction (whether fraud is
+            detected and the confidence)
     """
     deduction: str
 
@@ -48,6 +51,31 @@ class LibraryImageWithScore(LibraryImage):
     score: float
 
 
+class LibraryImageWithThumbnail(LibraryImage):
+    """
+    A library image with its thumbnail.
+    Attributes:
+        thumbnail (str, optional): The thumbnail as a base64 data URL, if it was requested and
+            could be loaded.
+    """
+
+    thumbnail: Optional[str] = None
+
+
+class LibraryImagePage(BaseModel):
+    """
+    A page of the image library listing.
+    Attributes:
+        images (List[LibraryImageWithThumbnail]): The images on this page.
+        next_cursor (str, optional): Opaque cursor of the next page, None on the last page.
+        total (int): The number of images in the library.
+    """
+
+    images: List[LibraryImageWithThumbnail]
+    next_cursor: Optional[str] = None
+    total: int
+
+
 class EmbeddingsSearchResult(BaseModel):
     """
     Represents a search result for embeddings.
@@ -81,4 +109,55 @@ class ExifDataResult(BaseModel):
 
     latitude: Optional[float]=None
     longitude: Optional[float]=None
-    timestamp: Optional[datetime]=None
\ No newline at end of file
+    timestamp: Optional[datetime]=None
+
+class GeneratedImageResult(BaseModel):
+    """
+    Represents the verdict of the generated image detector.
+    Attributes:
+        prediction (str): The predicted class, 'FAKE' or 'REAL'.
+        confidence (float): The confidence of the prediction.
+    """
+
+    prediction: str
+    confidence: float
+
+
+class CheckResult(BaseModel):
+    """
+    Represents the outcome of one check of an image analysis.
+    Attributes:
+        status (str): 'ok', 'error' or 'timeout'.
+        elapsed_ms (float): The time the check took, or the time waited for it if it timed out.
+        error (str, optional): The error message of a failed check.
+    """
+
+    status: str
+    elapsed_ms: float
+    error: Optional[str] = None
+
+
+class AnalysisResult(BaseModel):
+    """
+    Represents the results of the checks run by a single image analysis. The result of a check that
+    was not requested, failed or timed out is None, see `checks` for its status.
+    Attributes:
+        library_matches (List[LibraryImageWithScore], optional): Similar images in the image
+            library.
+        internet_matches (ReverseImageSearchResults, optional): Similar images found on the
+            internet.
+        exif (ExifDataResult, optional): The location and time the image was taken.
+        labels (List[dict], optional): The objects detected in the image, as returned by
+            Rekognition.
+        generated_image (GeneratedImageResult, optional): Whether the image is AI generated.
+        checks (Dict[str, CheckResult]): The status and timing of each requested check.
+        elapsed_ms (float): The time the whole analysis took.
+    """
+
+    library_matches: Optional[List[LibraryImageWithScore]] = None
+    internet_matches: Optional[ReverseImageSearchResults] = None
+    exif: Optional[ExifDataResult] = None
+    labels: Optional[List[dict]] = None
+    generated_image: Optional[GeneratedImageResult] = None
+    checks: Dict[str, CheckResult] = {}
+    elapsed_ms: float
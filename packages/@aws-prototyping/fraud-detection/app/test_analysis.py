@@ -0,0 +1,129 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from analysis import gather_checks, iter_checks, run_checks
+
+
+async def result(value, delay=0.0):
+    await asyncio.sleep(delay)
+    return value
+
+
+async def fail():
+    raise RuntimeError("service unavailable")
+
+
+class TestRunChecks(unittest.IsolatedAsyncioTestCase):
+
+    async def test_checks_run_concurrently(self):
+        start = time.perf_counter()
+        results, statuses = await run_checks({
+            "a": lambda: result(1, 0.3),
+            "b": lambda: result(2, 0.3),
+            "c": lambda: result(3, 0.3),
+        })
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(results, {"a": 1, "b": 2, "c": 3})
+        self.assertTrue(all(status.status == "ok" for status in statuses.values()))
+        self.assertLess(elapsed, 0.6)
+        self.assertGreaterEqual(statuses["a"].elapsed_ms, 300)
+
+    async def test_partial_results(self):
+        start = time.perf_counter()
+        results, statuses = await run_checks({
+            "fast": lambda: result("done"),
+            "slow": lambda: result("late", 5.0),
+            "broken": fail,
+        }, timeout=0.3)
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(results, {"fast": "done"})
+        self.assertEqual(statuses["fast"].status, "ok")
+        self.assertEqual(statuses["slow"].status, "timeout")
+        self.assertEqual(statuses["slow"].elapsed_ms, 300)
+        self.assertEqual(statuses["broken"].status, "error")
+        self.assertEqual(statuses["broken"].error, "service unavailable")
+        self.assertLess(elapsed, 1.0)
+
+    async def test_no_checks(self):
+        self.assertEqual(await run_checks({}), ({}, {}))
+
+
+def sleep_then(value, delay):
+    def check():
+        time.sleep(delay)
+        return value
+
+    return check
+
+
+def raise_error():
+    raise RuntimeError("service unavailable")
+
+
+class TestGatherChecks(unittest.TestCase):
+
+    def test_each_check_has_its_own_timeout(self):
+        start = time.perf_counter()
+        results, statuses = gather_checks({
+            "slow": sleep_then("slow", 0.4),
+            "fast": sleep_then("fast", 0.1),
+            "late": sleep_then("late", 2.0),
+            "broken": raise_error,
+        }, timeouts={"slow": 1.0, "fast": 0.5, "late": 0.2, "broken": 1.0})
+        elapsed = time.perf_counter() - start
+
+        self.assertEqual(results, {"slow": "slow", "fast": "fast"})
+        self.assertEqual(list(statuses), ["slow", "fast", "late", "broken"])
+        self.assertEqual(statuses["late"].status, "timeout")
+        self.assertEqual(statuses["late"].elapsed_ms, 200)
+        self.assertEqual(statuses["broken"].status, "error")
+        self.assertEqual(statuses["broken"].error, "service unavailable")
+        self.assertGreaterEqual(statuses["slow"].elapsed_ms, 400)
+        # run concurrently, the slowest successful check bounds the wait
+        self.assertLess(elapsed, 0.8)
+
+    def test_checks_are_yielded_as_they_complete(self):
+        order = [name for name, _, _ in iter_checks({
+            "slow": sleep_then("slow", 0.4),
+            "late": sleep_then("late", 2.0),
+            "fast": sleep_then("fast", 0.1),
+        }, timeouts={"slow": 1.0, "late": 0.2, "fast": 1.0})]
+
+        self.assertEqual(order, ["fast", "late", "slow"])
+
+    def test_timeout_starts_when_the_check_starts(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            results, statuses = gather_checks({
+                "first": sleep_then("first", 0.3),
+                "second": sleep_then("second", 0.1),
+            }, timeouts={"first": 0.5, "second": 0.2}, executor=executor)
+
+        self.assertEqual(results, {"first": "first", "second": "second"})
+        self.assertLess(statuses["second"].elapsed_ms, 200)
+
+    def test_queued_check_times_out(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            start = time.perf_counter()
+            statuses = {name: status for name, _, status in iter_checks({
+                "busy": sleep_then("busy", 0.4),
+                "queued": sleep_then("queued", 0.0),
+            }, timeouts={"busy": 1.0, "queued": 1.0}, executor=executor, queue_timeout=0.1)}
+            elapsed = time.perf_counter() - start
+
+        self.assertEqual(statuses["busy"].status, "ok")
+        self.assertEqual(statuses["queued"].status, "timeout")
+        self.assertIsNotNone(statuses["queued"].error)
+        self.assertGreaterEqual(statuses["queued"].elapsed_ms, 100)
+        self.assertLess(elapsed, 0.8)
+
+
+if __name__ == '__main__':
+    unittest.main()
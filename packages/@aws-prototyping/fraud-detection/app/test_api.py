@@ -0,0 +1,123 @@
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+import httpx
+from PIL import Image
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+import api
+from claim_image import ClaimImage
+from schemas.schemas import ReverseImageSearchResults
+
+
+def slow_reverse_image_search(image, filename, sim_thresh):
+    time.sleep(1.0)
+    return ReverseImageSearchResults(results=[])
+
+
+def labels_response(image):
+    return {"Labels": [{"Name": "Car", "Confidence": 99.0, "Instances": []}]}
+
+
+def missing_endpoint(image):
+    raise Exception("The SageMaker endpoint does not exist.")
+
+
+def fake_stream_deduction(image, filename, claim_report, claim_type, csim_threshold):
+    yield "signal", {"name": "location", "status": "ok", "elapsed_ms": 5.0, "error": None}
+    yield "signal", {"name": "internet_matches", "status": "timeout", "elapsed_ms": 60000.0,
+                     "error": None}
+    for text in ["**Not ", "fraudulent**", "\n"]:
+        yield "token", text
+    raise RuntimeError("throttled")
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+
+def fetch_claim_image(image_s3_key):
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), color='red').save(buffer, 'PNG')
+    return ClaimImage(buffer.getvalue(), filename="image.png")
+
+
+class TestApiConcurrency(unittest.IsolatedAsyncioTestCase):
+
+    @mock.patch.object(api, "fetch_claim_image", fetch_claim_image)
+    @mock.patch.object(api, "internet_reverse_image_search", slow_reverse_image_search)
+    async def test_slow_endpoint_does_not_block_healthcheck(self):
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            slow = asyncio.create_task(client.post(
+                "/search/internet",
+                params={"image_s3_key": "temp/image.png", "filename": "image.png"}))
+            await asyncio.sleep(0.2)
+
+            start = time.perf_counter()
+            health = await asyncio.gather(*(client.get("/healthcheck") for _ in range(5)))
+            elapsed = time.perf_counter() - start
+
+            self.assertFalse(slow.done())
+            self.assertLess(elapsed, 0.5)
+            self.assertTrue(all(response.status_code in (200, 503) for response in health))
+            self.assertEqual((await slow).json(), {"results": []})
+
+    @mock.patch.object(api, "fetch_claim_image", fetch_claim_image)
+    @mock.patch.object(api, "internet_reverse_image_search", slow_reverse_image_search)
+    @mock.patch.object(api, "detect_labels_in_image", labels_response)
+    @mock.patch.object(api, "detect_generated_image", missing_endpoint)
+    async def test_analyze_returns_partial_results(self):
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post("/analyze", params={
+                "image_s3_key": "temp/image.png", "library_search": False, "timeout": 0.5})
+
+        analysis = response.json()
+        checks = analysis["checks"]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(checks), {"internet_matches", "exif", "labels", "generated_image"})
+        self.assertEqual(checks["internet_matches"]["status"], "timeout")
+        self.assertIsNone(analysis["internet_matches"])
+        self.assertEqual(checks["exif"]["status"], "ok")
+        self.assertEqual(analysis["exif"],
+                         {"latitude": None, "longitude": None, "timestamp": None})
+        self.assertEqual(checks["labels"]["status"], "ok")
+        self.assertEqual(analysis["labels"][0]["Name"], "Car")
+        self.assertEqual(checks["generated_image"]["status"], "error")
+        self.assertIsNone(analysis["generated_image"])
+        self.assertLess(analysis["elapsed_ms"], 1000)
+
+    @mock.patch.object(api, "fetch_claim_image", fetch_claim_image)
+    @mock.patch.object(api, "stream_deduction", fake_stream_deduction)
+    async def test_predict_stream(self):
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post("/predict/stream", params={
+                "image_s3_key": "temp/image.png", "image_filename": "image.png",
+                "claim_report": "report", "claim_type": "Motor Vehicle", "csim_threshold": 0.9})
+
+        events = parse_events(response.text)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/event-stream"))
+        self.assertEqual([event for event, _ in events],
+                         ["signal", "signal", "token", "token", "token", "error", "done"])
+        self.assertEqual(events[1][1]["status"], "timeout")
+        self.assertEqual("".join(data["text"] for event, data in events if event == "token"),
+                         "**Not fraudulent**\n")
+        self.assertEqual(events[5][1], {"detail": "throttled"})
+
+
+if __name__ == '__main__':
+    unittest.main()
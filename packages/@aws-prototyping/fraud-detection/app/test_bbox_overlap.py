@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+import numpy as np
+import pandas as pd
+import torch
+from torchvision.ops import box_iou
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from bbox_overlap import overlapping_pairs, pairwise_iou
+from image_search import (ImageChecker, calc_iou, convert_bbox_coords, convert_bbox_coords_batch,
+                          get_bbox_coords)
+
+
+def random_boxes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, 1000, size=(n, 2))
+    wh = rng.uniform(1, 50, size=(n, 2))
+    return np.concatenate([xy, xy + wh], axis=1)
+
+
+class TestBBoxOverlap(unittest.TestCase):
+
+    def test_pairwise_iou_matches_torchvision(self):
+        boxes = random_boxes(50)
+        expected = box_iou(torch.from_numpy(boxes), torch.from_numpy(boxes)).numpy()
+        np.testing.assert_allclose(pairwise_iou(boxes), expected, rtol=1e-10)
+        self.assertAlmostEqual(calc_iou(boxes[0], boxes[0]), 1.0)
+
+    def test_sweep_matches_dense(self):
+        boxes = random_boxes(2000, seed=1)
+        dense_pairs, dense_ious = overlapping_pairs(boxes, 0.05, method="dense")
+        sweep_pairs, sweep_ious = overlapping_pairs(boxes, 0.05, method="sweep")
+        self.assertGreater(len(dense_pairs), 0)
+        np.testing.assert_array_equal(sweep_pairs, dense_pairs)
+        np.testing.assert_allclose(sweep_ious, dense_ious)
+
+    def test_detect_overlaps(self):
+        bboxes = [np.array([0, 0, 10, 10]), np.array([5, 0, 15, 10]), np.array([20, 20, 30, 30])]
+        overlaps = ImageChecker(image_lib=None).detect_overlaps(bboxes)
+        self.assertEqual(len(overlaps), 1)
+        i, j, iou = overlaps[0]
+        self.assertEqual((i, j), (0, 1))
+        self.assertAlmostEqual(iou, 50 / 150)
+
+    def test_batched_bbox_coords(self):
+        bbox_dicts = [{"Left": 0.1, "Top": 0.2, "Width": 0.3, "Height": 0.4},
+                      {"Left": 0.5, "Top": 0.5, "Width": 0.25, "Height": 0.1}]
+        batch = convert_bbox_coords_batch(640, 480, bbox_dicts)
+        expected = np.stack([convert_bbox_coords(640, 480, b) for b in bbox_dicts])
+        np.testing.assert_allclose(batch, expected)
+
+        df = pd.DataFrame(batch, columns=["bb.x1", "bb.y1", "bb.x2", "bb.y2"])
+        self.assertEqual(get_bbox_coords(df), [tuple(b) for b in expected.tolist()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import io
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+from PIL import Image
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from claim_image import ClaimImage
+from image_search import ImageEncoder
+from test_model_registry import register_test_model
+
+GPS_IFD = 0x8825
+
+
+def make_jpeg(size=(1600, 1200), gps=True):
+    exif = Image.Exif()
+    if gps:
+        exif[GPS_IFD] = {1: "S", 2: (33.0, 51.0, 54.0), 3: "E", 4: (151.0, 12.0, 36.0)}
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color=(10, 120, 200)).save(buffer, 'JPEG', exif=exif)
+    return buffer.getvalue()
+
+
+class TestClaimImage(unittest.TestCase):
+
+    def test_renditions(self):
+        data = make_jpeg()
+        claim = ClaimImage(data, filename="claim.jpg")
+
+        self.assertEqual(claim.content_type, "image/jpeg")
+        self.assertIs(claim.data, data)
+        self.assertEqual(claim.content_hash, ClaimImage(data).content_hash)
+        self.assertEqual(claim.rgb_array.shape, (1200, 1600, 3))
+        self.assertEqual(claim.thumbnail.size, (256, 192))
+        self.assertEqual(Image.open(io.BytesIO(claim.description_jpeg)).size, (1024, 768))
+        self.assertEqual(Image.open(io.BytesIO(claim.detector_jpeg)).size, (32, 32))
+
+        # memoized
+        self.assertIs(claim.rgb, claim.rgb)
+        self.assertIs(claim.description_jpeg, claim.description_jpeg)
+
+    def test_exif_is_preserved(self):
+        claim = ClaimImage(make_jpeg(), filename="claim.jpg")
+        claim.rgb
+        gps = claim.image.getexif().get_ifd(GPS_IFD)
+        self.assertEqual(gps[1], "S")
+        self.assertEqual(tuple(map(float, gps[4])), (151.0, 12.0, 36.0))
+
+    def test_public_jpeg_strips_exif(self):
+        claim = ClaimImage(make_jpeg(), filename="claim.jpg")
+        public = Image.open(io.BytesIO(claim.public_jpeg))
+        self.assertEqual(public.size, (1600, 1200))
+        self.assertEqual(len(public.getexif()), 0)
+        self.assertNotIn("exif", public.info)
+
+    def test_wrap_decoded_image(self):
+        img = Image.new('RGBA', (40, 30))
+        claim = ClaimImage.wrap(img, "upload.png")
+        self.assertIs(ClaimImage.wrap(claim), claim)
+        self.assertIs(claim.image, img)
+        self.assertEqual(claim.content_type, "image/png")
+        self.assertEqual(Image.open(io.BytesIO(claim.data)).size, (40, 30))
+        self.assertEqual(claim.rgb.mode, "RGB")
+
+    def test_concurrent_renditions_are_computed_once(self):
+        claim = ClaimImage(make_jpeg(gps=False), filename="claim.jpg")
+        opened = []
+        open_image = Image.open
+
+        def counting_open(*args, **kwargs):
+            opened.append(1)
+            return open_image(*args, **kwargs)
+
+        with mock.patch.object(Image, "open", counting_open):
+            threads = [threading.Thread(target=lambda: claim.detector_jpeg) for _ in range(8)]
+            threads += [threading.Thread(target=lambda: claim.thumbnail) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(opened), 1)
+
+    def test_decode(self):
+        claim = ClaimImage(make_jpeg(size=(300, 200), gps=False))
+        self.assertIs(claim.decode(), claim)
+        self.assertIn("rgb", claim._memo)
+        self.assertEqual(claim.rgb.size, (300, 200))
+
+    def test_embedding(self):
+        register_test_model("claim-image-test-model")
+        encoder = ImageEncoder("claim-image-test-model")
+        claim = ClaimImage(make_jpeg(size=(300, 200), gps=False))
+
+        x_emb = claim.embedding(encoder)
+        self.assertIs(claim.embedding(encoder), x_emb)
+        np.testing.assert_allclose(x_emb, encoder.encode(claim.rgb), rtol=1e-4, atol=1e-5)
+
+        # a second request for the same file hits the embedding cache
+        hits = encoder.cache.stats()["hits"]
+        ClaimImage(claim.data).embedding(encoder)
+        self.assertEqual(encoder.cache.stats()["hits"], hits + 1)
+
+        # ... and shares its key with the library's encoder
+        self.assertIsNotNone(encoder.cache.get(encoder.cache_key(claim.rgb)))
+
+    def test_embedding_changes_with_reregistered_weights(self):
+        register_test_model("claim-image-test-model")
+        data = make_jpeg(size=(300, 200), gps=False)
+        x_emb = ClaimImage(data).embedding(ImageEncoder("claim-image-test-model"))
+
+        register_test_model("claim-image-test-model")
+        encoder = ImageEncoder("claim-image-test-model")
+        x_new = ClaimImage(data).embedding(encoder)
+        self.assertFalse(np.allclose(x_new, x_emb))
+        np.testing.assert_allclose(x_new, encoder.encode(ClaimImage(data).rgb), rtol=1e-4,
+                                   atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import time
+import unittest
+import numpy as np
+from PIL import Image
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from embedding_cache import EmbeddingCache, image_content_hash
+from image_search import ImageEncoder
+from test_model_registry import TEST_MODEL_NAME, register_test_model
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = EmbeddingCache(max_items=2, db_fn=None)
+        cache.put("a", np.ones(4))
+        cache.put("b", np.ones(4) * 2)
+        cache.get("a")
+        cache.put("c", np.ones(4) * 3)
+
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats()["memory_items"], 2)
+
+    def test_persistent_tier_and_ttl(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_fn = os.path.join(tmp_dir, "embeddings.db")
+            EmbeddingCache(db_fn=db_fn).put("a", np.arange(4))
+
+            # a new process starts with an empty memory tier
+            cache = EmbeddingCache(db_fn=db_fn)
+            np.testing.assert_array_equal(cache.get("a"), np.arange(4))
+            self.assertEqual(cache.stats()["persistent_hits"], 1)
+
+            expired = EmbeddingCache(db_fn=db_fn, ttl=0.01)
+            time.sleep(0.05)
+            self.assertIsNone(expired.get("a"))
+            self.assertEqual(expired.stats()["persistent_items"], 0)
+
+    def test_content_hash_ignores_object_identity(self):
+        img = Image.new('RGB', (32, 32), color='green')
+        self.assertEqual(image_content_hash(img), image_content_hash(img.copy()))
+        self.assertNotEqual(image_content_hash(img),
+                            image_content_hash(Image.new('RGB', (32, 32), color='blue')))
+
+    def test_encoder_skips_cached_images(self):
+        register_test_model()
+        cache = EmbeddingCache(db_fn=None)
+        encoder = ImageEncoder(model_name=TEST_MODEL_NAME, cache=cache)
+        img = Image.new('RGB', (64, 64), color='red')
+
+        x_emb = encoder.encode(img)
+        X_emb = encoder.encode_batch([img.copy(), Image.new('RGB', (64, 64), color='blue')])
+
+        np.testing.assert_array_equal(X_emb[0], x_emb)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+import boto3
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from PIL import Image
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import generated_image_detector as detector
+
+ENDPOINT_NAME = "fraud-detection-endpoint-1"
+
+
+def make_client(service_name):
+    return boto3.client(service_name, region_name="us-east-1", aws_access_key_id="test",
+                        aws_secret_access_key="test")
+
+
+class TestEndpointCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clients = {name: make_client(name)
+                        for name in ["ssm", "sagemaker", "runtime.sagemaker"]}
+        self.stubbers = {name: Stubber(client) for name, client in self.clients.items()}
+        for stubber in self.stubbers.values():
+            stubber.activate()
+
+        patcher = mock.patch.dict(detector._clients, self.clients, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        detector.clear_endpoint_cache()
+        self.addCleanup(detector.clear_endpoint_cache)
+
+    def expect_lookup(self, exists=True):
+        self.stubbers["ssm"].add_response(
+            "get_parameter", {"Parameter": {"Value": ENDPOINT_NAME}},
+            {"Name": detector.SM_ENDPOINT_NAME_SSM_PARAMETER})
+        if exists:
+            self.stubbers["sagemaker"].add_response(
+                "describe_endpoint",
+                {"EndpointName": ENDPOINT_NAME,
+                 "EndpointArn": ("arn:aws:sagemaker:us-east-1:123456789012:endpoint/"
+                                 f"{ENDPOINT_NAME}"),
+                 "EndpointConfigName": "config",
+                 "EndpointStatus": "InService", "CreationTime": "2024-01-01",
+                 "LastModifiedTime": "2024-01-01"},
+                {"EndpointName": ENDPOINT_NAME})
+        else:
+            self.stubbers["sagemaker"].add_client_error(
+                "describe_endpoint", "ValidationException",
+                f"Could not find endpoint \"{ENDPOINT_NAME}\".")
+
+    def test_endpoint_is_resolved_once(self):
+        self.expect_lookup()
+        body = b"[0.01, 0.99]"
+        self.stubbers["runtime.sagemaker"].add_response(
+            "invoke_endpoint", {"Body": StreamingBody(io.BytesIO(body), len(body))},
+            {"EndpointName": ENDPOINT_NAME, "Body": mock.ANY,
+             "ContentType": "application/x-image"})
+
+        self.assertTrue(detector.does_endpoint_exist())
+        self.assertTrue(detector.does_endpoint_exist())
+        result = detector.detect_generated_image(Image.new('RGB', (64, 64)))
+
+        self.assertEqual(result, {"prediction": "REAL", "confidence": 0.99})
+        for stubber in self.stubbers.values():
+            stubber.assert_no_pending_responses()
+
+    def test_missing_endpoint_fails_fast(self):
+        self.expect_lookup(exists=False)
+
+        self.assertFalse(detector.does_endpoint_exist())
+        # the stubbers have no more responses, so any AWS call would fail
+        with self.assertRaisesRegex(Exception, "does not exist"):
+            detector.detect_generated_image(Image.new('RGB', (64, 64)))
+        self.assertFalse(detector.does_endpoint_exist())
+
+    def test_missing_endpoint_expires(self):
+        self.expect_lookup(exists=False)
+        self.expect_lookup(exists=True)
+
+        with mock.patch.object(detector, "SM_ENDPOINT_NEGATIVE_CACHE_TTL", 0):
+            self.assertFalse(detector.does_endpoint_exist())
+            self.assertTrue(detector.does_endpoint_exist())
+
+        self.assertEqual(detector.resolve_endpoint(), ENDPOINT_NAME)
+        self.stubbers["ssm"].assert_no_pending_responses()
+
+    def test_missing_parameter_is_cached(self):
+        self.stubbers["ssm"].add_client_error("get_parameter", "ParameterNotFound")
+
+        self.assertFalse(detector.does_endpoint_exist())
+        self.assertFalse(detector.does_endpoint_exist())
+        self.stubbers["ssm"].assert_no_pending_responses()
+
+    def test_transient_error_is_not_cached(self):
+        self.stubbers["ssm"].add_client_error("get_parameter", "ThrottlingException")
+        self.stubbers["ssm"].add_response(
+            "get_parameter", {"Parameter": {"Value": ENDPOINT_NAME}},
+            {"Name": detector.SM_ENDPOINT_NAME_SSM_PARAMETER})
+        self.stubbers["sagemaker"].add_client_error("describe_endpoint", "ExpiredTokenException")
+        self.expect_lookup()
+
+        with self.assertRaises(ClientError):
+            detector.resolve_endpoint()
+        with self.assertRaises(ClientError):
+            detector.resolve_endpoint()
+        self.assertTrue(detector.does_endpoint_exist())
+        for stubber in self.stubbers.values():
+            stubber.assert_no_pending_responses()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,425 @@
+import base64
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+import uuid
+from unittest import mock
+import pandas as pd
+from boto3.dynamodb.types import TypeSerializer
+from PIL import Image
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+# the library creates its AWS resources at import time
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+import image_library
+import library_ingest
+from image_library import S3ImageLibrary
+from test_model_registry import register_test_model
+import vector_store
+from vector_store import create_vector_store
+
+
+class LocalDynamoDBClient:
+    """Stand-in for the DynamoDB client calls made by the library, counting
+    round trips. At most `max_batch_items` keys are processed per
+    BatchGetItem call, the rest are returned as unprocessed keys."""
+
+    def __init__(self, table, max_batch_items=100):
+        self._table = table
+        self._max_batch_items = max_batch_items
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def _count(self, op):
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+
+    def batch_get_item(self, RequestItems):
+        self._count("batch_get_item")
+        keys = RequestItems[self._table.name]["Keys"]
+        assert len(keys) <= 100, "BatchGetItem accepts at most 100 keys"
+
+        serializer = TypeSerializer()
+        processed, unprocessed = keys[:self._max_batch_items], keys[self._max_batch_items:]
+        items = [self._table.items[key["id"]["S"]] for key in processed
+                 if key["id"]["S"] in self._table.items]
+        response = {"Responses": {self._table.name: [
+            {name: serializer.serialize(value) for name, value in item.items()}
+            for item in items]}}
+
+        if unprocessed:
+            response["UnprocessedKeys"] = {self._table.name: {"Keys": unprocessed}}
+
+        return response
+
+
+class LocalBatchWriter:
+    """Stand-in for a DynamoDB batch writer, flushing 25 items per
+    BatchWriteItem call."""
+
+    def __init__(self, table):
+        self._table = table
+        self._items = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._flush()
+
+    def _flush(self):
+        if self._items:
+            self._table.meta.client._count("batch_write_item")
+            for op, item in self._items:
+                if op == "put":
+                    self._table.items[item["id"]] = dict(item)
+                else:
+                    self._table.items.pop(item["id"], None)
+            self._items = []
+
+    def _add(self, op, item):
+        self._items.append((op, item))
+        if len(self._items) == 25:
+            self._flush()
+
+    def put_item(self, Item):
+        self._add("put", Item)
+
+    def delete_item(self, Key):
+        self._add("delete", Key)
+
+
+class LocalTable:
+    """Stand-in for a boto3 DynamoDB Table resource keyed by "id"."""
+
+    def __init__(self, name="library-files", max_batch_items=100):
+        self.name = name
+        self.items = {}
+        self.meta = type("Meta", (), {})()
+        self.meta.client = LocalDynamoDBClient(self, max_batch_items)
+
+    @property
+    def calls(self):
+        return self.meta.client.calls
+
+    def get_item(self, Key):
+        self.meta.client._count("get_item")
+        item = self.items.get(Key["id"])
+        return {"Item": dict(item)} if item else {}
+
+    def put_item(self, Item):
+        self.meta.client._count("put_item")
+        self.items[Item["id"]] = dict(Item)
+
+    def batch_writer(self):
+        return LocalBatchWriter(self)
+
+    def scan(self, Limit=None, ExclusiveStartKey=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None):
+        self.meta.client._count("scan")
+        ids = sorted(self.items)
+        if ExclusiveStartKey:
+            ids = [i for i in ids if i > ExclusiveStartKey["id"]]
+        page = ids[:Limit] if Limit else ids
+        items = [dict(self.items[i]) for i in page]
+        if ProjectionExpression:
+            names = [(ExpressionAttributeNames or {}).get(name.strip(), name.strip())
+                     for name in ProjectionExpression.split(",")]
+            items = [{name: item[name] for name in names if name in item} for item in items]
+        response = {"Items": items, "Count": len(page)}
+        if Limit and len(ids) > Limit:
+            response["LastEvaluatedKey"] = {"id": page[-1]}
+        return response
+
+
+class LocalS3Client:
+    """Stand-in for the S3 client calls made by the library, counting round
+    trips."""
+
+    def __init__(self):
+        self.objects = {}
+        self.undeletable = set()
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def _count(self, op):
+        with self._lock:
+            self.calls[op] = self.calls.get(op, 0) + 1
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        self._count("put_object")
+        body = Body.read() if hasattr(Body, "read") else bytes(Body)
+        self.objects[Key] = (body, ContentType)
+        return {}
+
+    def get_paginator(self, operation):
+        assert operation == "list_objects_v2"
+        client = self
+
+        class Paginator:
+            def paginate(self, Bucket, Prefix=""):
+                client._count("list_objects_v2")
+                keys = sorted(key for key in client.objects if key.startswith(Prefix))
+                yield {"Contents": [{"Key": key} for key in keys]}
+
+        return Paginator()
+
+    def delete_objects(self, Bucket, Delete):
+        self._count("delete_objects")
+        assert len(Delete["Objects"]) <= 1000, "DeleteObjects accepts at most 1000 keys"
+        assert len(Delete["Objects"]) > 0, "MalformedXML: DeleteObjects requires at least one key"
+        errors = []
+        for obj in Delete["Objects"]:
+            if obj["Key"] in self.undeletable:
+                errors.append(
+                    {"Key": obj["Key"], "Code": "AccessDenied", "Message": "Access Denied"})
+            else:
+                self.objects.pop(obj["Key"], None)
+        return {"Errors": errors} if errors else {}
+
+    def get_object(self, Bucket, Key):
+        self._count("get_object")
+        if Key not in self.objects:
+            raise KeyError(f"NoSuchKey: {Key}")
+        body, content_type = self.objects[Key]
+        return {"Body": io.BytesIO(body), "ContentType": content_type}
+
+
+class TestS3ImageLibraryLocal(unittest.TestCase):
+
+    def setUp(self):
+        register_test_model(image_library.model_name)
+        self.table = LocalTable()
+        self._table = image_library.table
+        image_library.table = self.table
+        self.library = S3ImageLibrary(
+            micro_batching=False,
+            vector_store=create_vector_store("memory", dim=192, index_name="img-vector"))
+        self.s3 = self.library._s3 = LocalS3Client()
+        image_library._thumbnails.clear()
+
+    def tearDown(self):
+        image_library.table = self._table
+
+    def add_items(self, n):
+        imgs = [Image.new('RGB', (32, 32), color=(i % 256, (7 * i) % 256, (13 * i) % 256))
+                for i in range(n)]
+        ids = self.library._vector_store.bulk_add(self.library._extract_images_features(imgs))
+        for i, image_id in enumerate(ids):
+            self.table.put_item(Item={
+                "id": image_id,
+                "image_s3_key": f"images/{uuid.uuid4()}.png",
+                "thumbnail_s3_key": f"thumbnails/{uuid.uuid4()}.png",
+                "filename": f"{i}.png",
+                "created_timestamp": "2024-01-01 00:00:00",
+                "size": 1000 + i,
+            })
+        return ids
+
+    def test_search_images_batches_lookups(self):
+        self.add_items(150)
+        results = self.library.search_images(Image.new('RGB', (32, 32), color='red'))
+
+        self.assertEqual(len(results), 100)
+        self.assertTrue(all(a.score >= b.score for a, b in zip(results, results[1:])))
+        self.assertEqual(self.table.calls.get("get_item", 0), 0)
+        self.assertEqual(self.table.calls["batch_get_item"], 1)
+
+    def test_unprocessed_keys_are_retried(self):
+        self.table.meta.client._max_batch_items = 40
+        ids = self.add_items(250)
+
+        images = self.library.get_images_by_id(ids + ids[:10])
+        self.assertEqual(set(images), set(ids))
+        self.assertEqual(images[ids[3]].size, 1003)
+        # chunks of 100, 100 and 50 keys, each retried until done at 40 keys per call
+        self.assertEqual(self.table.calls["batch_get_item"], 3 + 3 + 2)
+
+    def test_unprocessed_keys_are_not_dropped(self):
+        ids = self.add_items(5)
+        self.table.meta.client._max_batch_items = 0
+
+        with mock.patch.object(image_library, "DYNAMODB_MAX_RETRIES", 2), \
+                self.assertRaises(RuntimeError):
+            self.library.get_images_by_id(ids)
+        self.assertEqual(self.table.calls["batch_get_item"], 3)
+
+    def test_format_df_loads_thumbnails_from_s3(self):
+        thumbnail = io.BytesIO()
+        Image.new('RGB', (256, 256), color='red').save(thumbnail, 'PNG')
+        for i in range(20):
+            self.s3.put_object(Bucket="bucket", Key=f"thumbnails/{i}.png",
+                               Body=thumbnail.getvalue(), ContentType="image/png")
+
+        df = pd.DataFrame({
+            "id": [str(i) for i in range(21)],
+            "filename": [f"{i}.png" for i in range(21)],
+            "thumbnail_s3_key": ([f"thumbnails/{i}.png" for i in range(20)]
+                                 + ["thumbnails/missing.png"]),
+            "size": [2048] * 21,
+        })
+        df_results = self.library.format_df(df.copy())
+
+        expected = "data:image/png;base64," + base64.b64encode(thumbnail.getvalue()).decode()
+        thumbnails = dict(zip(df_results["filename"], df_results["thumbnail"]))
+        self.assertEqual(thumbnails["3.png"], expected)
+        self.assertTrue(pd.isna(thumbnails["20.png"]))
+        self.assertEqual(set(df_results["filesize"]), {"2.00 KB"})
+        self.assertEqual(self.s3.calls["get_object"], 21)
+
+        # served from the LRU, except the missing thumbnail which is retried
+        self.library.format_df(df.copy())
+        self.assertEqual(self.s3.calls["get_object"], 22)
+
+    def test_paginated_listing(self):
+        ids = self.add_items(120)
+        for image_id in ids[:60]:
+            key = self.table.items[image_id]["thumbnail_s3_key"]
+            self.s3.put_object(Bucket="bucket", Key=key, Body=b"png", ContentType="image/png")
+
+        listed, cursor, pages = [], None, 0
+        while True:
+            page = self.library.get_page(page_size=50, cursor=cursor)
+            self.assertEqual(page.total, 120)
+            listed += page.images
+            cursor, pages = page.next_cursor, pages + 1
+            if cursor is None:
+                break
+
+        self.assertEqual(pages, 3)
+        self.assertEqual(sorted(image.id for image in listed), sorted(ids))
+        self.assertEqual(self.s3.calls["get_object"], 120)
+        self.assertEqual(sum(image.thumbnail is not None for image in listed), 60)
+
+        page = self.library.get_page(page_size=10, include_thumbnails=False)
+        self.assertEqual(len(page.images), 10)
+        self.assertEqual(self.s3.calls["get_object"], 120)
+
+        with self.assertRaises(ValueError):
+            self.library.list_images(cursor="not-a-cursor")
+
+    def test_bulk_ingest(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for i in range(10):
+                Image.new('RGB', (64, 48), color=(25 * i, 0, 0)).save(
+                    os.path.join(tmp_dir, f"{i}.jpg"))
+            with open(os.path.join(tmp_dir, "broken.png"), "wb") as f:
+                f.write(b"not an image")
+            checkpoint_fn = os.path.join(tmp_dir, "ingest.checkpoint")
+
+            stats = library_ingest.ingest(self.library, tmp_dir, batch_size=4,
+                                          checkpoint_fn=checkpoint_fn)
+            self.assertEqual((stats["added"], stats["failed"], stats["skipped"]), (10, 1, 0))
+            self.assertEqual(self.library.count_images(), 10)
+            self.assertEqual(len(self.table.items), 10)
+            self.assertEqual(self.table.calls["batch_write_item"], 3)
+            self.assertEqual(self.s3.calls["put_object"], 20)
+
+            item = next(iter(self.table.items.values()))
+            self.assertTrue(item["image_s3_key"].endswith(".jpg"))
+            self.assertEqual(self.s3.objects[item["image_s3_key"]][1], "image/jpeg")
+
+            # resuming with the same checkpoint only retries the failed image
+            stats = library_ingest.ingest(self.library, tmp_dir, batch_size=4,
+                                          checkpoint_fn=checkpoint_fn)
+            self.assertEqual((stats["added"], stats["failed"], stats["skipped"]), (0, 1, 10))
+            self.assertEqual(self.library.count_images(), 10)
+
+            # once fixed, the failed image is added
+            Image.new('RGB', (64, 48), color='blue').save(os.path.join(tmp_dir, "broken.png"))
+            stats = library_ingest.ingest(self.library, tmp_dir, batch_size=4,
+                                          checkpoint_fn=checkpoint_fn)
+            self.assertEqual((stats["added"], stats["failed"], stats["skipped"]), (1, 0, 10))
+            self.assertEqual(self.library.count_images(), 11)
+
+    def test_bulk_ingest_from_s3(self):
+        for i in range(3):
+            buffer = io.BytesIO()
+            Image.new('RGB', (64, 48), color=(0, 50 * i, 0)).save(buffer, 'PNG')
+            self.s3.put_object(Bucket="claims", Key=f"history/{i}.png", Body=buffer.getvalue())
+
+        stats = library_ingest.ingest(self.library, "s3://claims/history/", s3=self.s3)
+        self.assertEqual(stats["added"], 3)
+        self.assertEqual(sorted(item["filename"] for item in self.table.items.values()),
+                         ["0.png", "1.png", "2.png"])
+
+    def test_bulk_delete(self):
+        images = [Image.new('RGB', (32, 32), color=(20 * i, 0, 0)) for i in range(12)]
+        added = self.library.add_images(images, [f"{i}.png" for i in range(12)])
+        self.assertEqual(len(self.s3.objects), 24)
+
+        self.library.delete_image(added[0].id)
+        self.assertEqual(len(self.s3.objects), 22)
+        self.assertNotIn(added[0].id, self.table.items)
+        self.assertEqual(self.library.count_images(), 11)
+
+        # the library is scanned in pages of 5 * 2 images, deleted in batches of 5
+        self.s3.undeletable.add(added[1].thumbnail_s3_key)
+        with mock.patch.multiple(image_library, S3_DELETE_MAX_KEYS=10, DYNAMODB_MAX_WORKERS=2):
+            n_deleted = self.library.clear_library()
+
+        # the image whose thumbnail could not be deleted is kept
+        self.assertEqual(n_deleted, 10)
+        self.assertEqual(list(self.table.items), [added[1].id])
+        self.assertEqual(self.library.count_images(), 1)
+        self.assertEqual(self.table.calls["scan"], 2)
+        # 1 call for the single delete, then batches of 5, 5 and 1 images
+        self.assertEqual(self.s3.calls["delete_objects"], 1 + 3)
+        self.assertNotIn("get_object", self.s3.calls)
+
+        self.s3.undeletable.clear()
+        self.assertEqual(self.library.clear_library(), 1)
+        self.assertEqual(
+            (len(self.s3.objects), len(self.table.items), self.library.count_images()), (0, 0, 0))
+
+    def test_delete_images_without_objects(self):
+        [added] = self.library.add_images([Image.new('RGB', (32, 32))], ["0.png"])
+        self.s3.objects.clear()
+        for name in ("image_s3_key", "thumbnail_s3_key"):
+            del self.table.items[added.id][name]
+
+        self.assertEqual(self.library.clear_library(), 1)
+        self.assertEqual((len(self.table.items), self.library.count_images()), (0, 0))
+        self.assertNotIn("delete_objects", self.s3.calls)
+
+    def test_search_filters(self):
+        images = [Image.new('RGB', (32, 32), color=(200, 10 * i, 0)) for i in range(6)]
+        added = self.library.add_images(images, [f"{i}.png" for i in range(6)],
+                                        claim_types=["Motor", "Theft", None] * 2)
+        self.assertEqual(added[1].claim_type, "Theft")
+
+        results = self.library.search_images(images[0], claim_type="Motor")
+        self.assertEqual({image.id for image in results}, {added[0].id, added[3].id})
+
+        results = self.library.search_images(images[0], min_score=0.999)
+        self.assertEqual(results[0].id, added[0].id)
+        self.assertTrue(all(image.score >= 0.999 for image in results))
+
+        self.assertEqual(len(self.library.search_images(images[0], created_after="2000-01-01")), 6)
+        self.assertEqual(self.library.search_images(images[0], created_before="2000-01-01"), [])
+
+    def test_libraries_share_the_local_vector_store(self):
+        with mock.patch.object(vector_store, "VECTOR_STORE", "exact"), \
+                mock.patch.dict(vector_store._stores, clear=True):
+            writer = S3ImageLibrary(micro_batching=False)
+            writer._s3 = self.s3
+            image = Image.new('RGB', (32, 32), color='blue')
+            added = writer.add_image(image, "blue.png")
+
+            # e.g. another request
+            reader = S3ImageLibrary(micro_batching=False)
+
+            self.assertIs(reader._vector_store, writer._vector_store)
+            self.assertEqual(reader.search_images(image, min_score=0.999)[0].id, added.id)
+
+    def test_get_image_library_is_shared(self):
+        with mock.patch.object(vector_store, "VECTOR_STORE", "exact"), \
+                mock.patch.dict(vector_store._stores, clear=True), \
+                mock.patch.object(image_library, "_image_library", None):
+            self.assertIs(image_library.get_image_library(), image_library.get_image_library())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import io
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+from PIL import Image, ImageDraw
+from sqlitedict import SqliteDict
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from image_search import ImageChecker, ImageLibrary
+from thumbnail_cache import ThumbnailCache
+from test_model_registry import TEST_MODEL_NAME, register_test_model
+
+COLOURS = ['red', 'green', 'blue', 'yellow', 'purple', 'orange', 'white', 'black']
+
+
+def make_dataset(root, labels=("existing", "external"), colours=COLOURS):
+    for label in labels:
+        os.makedirs(os.path.join(root, label))
+        for colour in colours:
+            Image.new('RGB', (80, 60), color=colour).save(
+                os.path.join(root, label, f'{colour}.png'))
+
+
+class TestImageLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.vec_size = register_test_model().num_features
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp_dir.name, 'data')
+        make_dataset(self.root)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_library(self, load_existing=False, **kwargs):
+        return ImageLibrary(self.root,
+                            os.path.join(self.tmp_dir.name, 'images.db'),
+                            os.path.join(self.tmp_dir.name, 'images.ann'),
+                            model_name=TEST_MODEL_NAME,
+                            ann_vec_size=self.vec_size,
+                            load_existing=load_existing,
+                            **kwargs)
+
+    def test_build_and_query(self):
+        ImageLibrary._build_batch_size = 3
+        try:
+            library = self.make_library()
+        finally:
+            ImageLibrary._build_batch_size = 32
+
+        self.assertEqual(library.get_count(), 2 * len(COLOURS))
+        self.assertEqual(library._ann_index.get_n_items(), 2 * len(COLOURS))
+
+        _, df_results = library.query(
+            Image.new('RGB', (80, 60), color='blue'), thresh=0.999, labels=["external"])
+        self.assertIn('blue.png', [os.path.basename(fn) for fn in df_results["fn"]])
+        self.assertEqual(set(df_results["label"]), {"external"})
+
+    def test_load_existing(self):
+        self.make_library()
+        library = self.make_library(load_existing=True)
+        self.assertEqual(library._ann_index.get_n_items(), 2 * len(COLOURS))
+        self.assertEqual(len(library._store), 2 * len(COLOURS))
+        self.assertIsInstance(library._store.snapshot().frozen, np.memmap)
+
+    def test_migrate_sqlitedict_db(self):
+        library = self.make_library()
+        snap = library._store.snapshot()
+        db = SqliteDict(os.path.join(self.tmp_dir.name, 'images.db'))
+        for i in range(snap.n):
+            db[i] = {"x_emb": snap.frozen[i].tolist(), "label": snap.labels([i])[0],
+                     "fn": snap.fns[i]}
+        db.commit()
+        db.close()
+        library._store.delete()
+
+        migrated = self.make_library(load_existing=True)
+        np.testing.assert_allclose(migrated._store.snapshot().frozen, snap.frozen, rtol=1e-6)
+        np.testing.assert_array_equal(migrated._store.snapshot().fns, snap.fns)
+
+    def test_incremental_updates(self):
+        library = self.make_library(search_mode="ann")
+        n_images = 2 * len(COLOURS)
+        new_fn = os.path.join(self.tmp_dir.name, 'new.png')
+        Image.new('RGB', (80, 60), color='pink').save(new_fn)
+        query_img = Image.new('RGB', (80, 60), color='pink')
+
+        [new_id] = library.add_images([new_fn], label="existing")
+        self.assertEqual(library.get_count(), n_images + 1)
+        self.assertEqual(library._ann_index.get_n_items(), n_images)
+        _, df_results = library.query(query_img, thresh=0.999)
+        self.assertIn(new_id, list(df_results["i"]))
+
+        _, df_results = library.query(Image.new('RGB', (80, 60), color='red'), thresh=0.999)
+        removed_id = int(df_results["i"].iloc[0])
+        removed_fn = df_results["fn"].iloc[0]
+        library.remove_images([removed_id])
+        _, df_results = library.query(Image.new('RGB', (80, 60), color='red'), thresh=0)
+        self.assertNotIn(removed_id, list(df_results["i"]))
+
+        library.compact()
+        snap = library._store.snapshot()
+        self.assertEqual(snap.n_frozen, n_images)
+        self.assertEqual(snap.n_removed(snap.n), 0)
+        self.assertEqual(library._ann_index.get_n_items(), n_images)
+        self.assertNotIn(removed_fn, list(snap.fns))
+        # ids are stable across compaction, and removed ids are not reused
+        self.assertEqual(os.path.basename(snap.fns[snap.rows([new_id])[0]]), 'new.png')
+        _, df_results = library.query(query_img, thresh=0.999)
+        self.assertIn(new_id, list(df_results["i"]))
+        library.remove_images([removed_id])
+        self.assertEqual(library.get_count(), n_images)
+
+        reloaded = self.make_library(load_existing=True, search_mode="ann")
+        self.assertEqual(reloaded.get_count(), n_images)
+        _, df_results = reloaded.query(query_img, thresh=0.999)
+        self.assertIn(new_id, list(df_results["i"]))
+        [next_id] = reloaded.add_images([new_fn], label="existing")
+        self.assertEqual(next_id, new_id + 1)
+
+    def test_exact_search(self):
+        library = self.make_library()
+        query_img = Image.new('RGB', (80, 60), color=(200, 30, 90))
+        n = 2 * len(COLOURS) - 2
+
+        library._search_mode = "ann"
+        _, df_ann = library.query(query_img, thresh=0, n=n)
+        library._search_mode = "exact"
+        _, df_exact = library.query(query_img, thresh=0, n=n)
+
+        self.assertEqual(list(df_exact.columns), list(df_ann.columns))
+        np.testing.assert_allclose(np.sort(df_exact["csim"])[-n:], np.sort(df_ann["csim"])[-n:],
+                                   rtol=1e-5)
+        self.assertTrue((np.diff(df_exact["csim"]) <= 0).all())
+
+        library.remove_images([int(df_exact["i"].iloc[0])])
+        _, df_removed = library.query(query_img, thresh=0, n=n)
+        self.assertNotIn(df_exact["i"].iloc[0], list(df_removed["i"]))
+
+    def test_exact_search_float16(self):
+        library = self.make_library(search_mode="exact", exact_dtype=np.float16)
+        _, df_results = library.query(Image.new('RGB', (80, 60), color='blue'), thresh=0.999)
+        self.assertIn('blue.png', [os.path.basename(fn) for fn in df_results["fn"]])
+        snap = library._store.snapshot()
+        self.assertEqual(snap.frozen_as(np.float16).dtype, np.float16)
+        self.assertIs(snap.frozen_as(np.float32), snap.frozen)
+        np.testing.assert_allclose(np.linalg.norm(snap.frozen, axis=1), 1, rtol=1e-5)
+
+    def test_auto_search_mode(self):
+        library = self.make_library()
+        snap = library._store.snapshot()
+        self.assertTrue(library._use_exact(snap))
+        self.assertEqual(list(library._exact_timings), [snap.version])
+
+        library.remove_images([0])
+        self.assertGreater(library._store.snapshot().version, snap.version)
+
+        library = self.make_library(load_existing=True, latency_budget_ms=0)
+        self.assertFalse(library._use_exact(library._store.snapshot()))
+
+        with self.assertRaises(ValueError):
+            self.make_library(load_existing=True, search_mode="brute")
+
+    def test_lazy_thumbnails(self):
+        library = self.make_library()
+        thumb_dir = os.path.join(self.tmp_dir.name, 'images.db.thumbnails')
+        self.assertEqual(len(os.listdir(thumb_dir)), 2 * len(COLOURS))
+
+        checker = ImageChecker(library)
+        df_results = checker.find_similar(
+            Image.new('RGB', (80, 60), color='blue'), ["existing"], 0.999)
+        self.assertNotIn("data_url", df_results.columns)
+        self.assertIn("blue.png", list(df_results["filename"]))
+
+        df_results = checker.add_thumbnails(df_results)
+        self.assertTrue(all(url.startswith("data:image/png;base64,")
+                            for url in df_results["data_url"]))
+        self.assertEqual(len(os.listdir(thumb_dir)), 2 * len(COLOURS))
+
+        # a modified image gets a new thumbnail, which replaces the old one
+        fn = df_results["fn"].iloc[0]
+        Image.new('RGB', (800, 600), color='blue').save(fn)
+        os.utime(fn, ns=(0, 10 ** 9))
+        thumb = Image.open(io.BytesIO(library.thumbnail(fn)))
+        self.assertEqual(thumb.size, (500, 375))
+        self.assertEqual(len(os.listdir(thumb_dir)), 2 * len(COLOURS))
+        self.assertEqual(Image.open(io.BytesIO(library.thumbnail(fn))).size, (500, 375))
+
+    def test_concurrent_thumbnail_writes(self):
+        thumb_dir = os.path.join(self.tmp_dir.name, 'thumbnails')
+        cache = ThumbnailCache(thumb_dir, size=32)
+        fn = os.path.join(self.root, 'existing', 'red.png')
+        results = []
+
+        def render():
+            results.append(cache.get(fn))
+
+        threads = [threading.Thread(target=render) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 8)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(os.listdir(thumb_dir), [cache.path(fn).name])
+
+        # a thumbnail that cannot be written is served uncached
+        os.remove(cache.path(fn))
+        with mock.patch("thumbnail_cache.os.replace", side_effect=OSError("disk full")):
+            self.assertEqual(cache.get(fn), results[0])
+        self.assertEqual(os.listdir(thumb_dir), [])
+
+    def test_estimate_rotations(self):
+        checker = ImageChecker(self.make_library(), rotation_cache_size=4)
+        r_img = Image.new('RGB', (120, 80), color='white')
+        ImageDraw.Draw(r_img).rectangle((10, 10, 70, 40), fill='red')
+        ImageDraw.Draw(r_img).ellipse((80, 50, 110, 75), fill='blue')
+        q_img = r_img.rotate(90, expand=True, fillcolor="white")
+
+        exhaustive = checker.estimate_rotations(q_img, r_img, exhaustive=True, ref_key="r")
+        self.assertEqual(exhaustive["angle"], 90)
+        self.assertEqual(exhaustive["n_encoded"], 361)
+        self.assertEqual(len(exhaustive["scores"]), 360)
+
+        estimate = checker.estimate_rotations(q_img, r_img)
+        self.assertLessEqual(abs(estimate["angle"] - exhaustive["angle"]), 1)
+        self.assertLess(estimate["n_encoded"], 60)
+
+        # the rotated reference embeddings are reused
+        cached = checker.estimate_rotations(q_img, r_img, ref_key="r")
+        self.assertEqual(cached["angle"], 90)
+        self.assertEqual(cached["n_encoded"], 1)
+
+    def test_rotation_cache_is_lru(self):
+        checker = ImageChecker(self.make_library(), rotation_cache_size=2)
+        r_img = Image.new('RGB', (120, 80), color='white')
+        ImageDraw.Draw(r_img).rectangle((10, 10, 70, 40), fill='red')
+
+        for ref_key in ("a", "b", "a", "c"):
+            checker.estimate_rotations(r_img, r_img, coarse_step=90, tolerance=90, ref_key=ref_key)
+
+        # "a" was used more recently than "b", so "b" is evicted
+        self.assertEqual(list(checker._rotation_cache), ["a", "c"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from image_search import ImageEncoder
+from micro_batch import MicroBatcher
+from test_model_registry import TEST_MODEL_NAME, register_test_model
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+    def setUp(self):
+        register_test_model()
+        self.encoder = ImageEncoder(model_name=TEST_MODEL_NAME)
+        self.images = [Image.new('RGB', (64, 64), color=(i * 30, 0, 255 - i * 30))
+                       for i in range(8)]
+
+    def test_encode_batch_matches_encode(self):
+        X_emb = self.encoder.encode_batch(self.images, batch_size=3)
+        self.assertEqual(X_emb.dtype, np.float32)
+        self.assertEqual(X_emb.shape[0], len(self.images))
+        np.testing.assert_allclose(
+            X_emb[2], self.encoder.encode(self.images[2]), rtol=1e-4, atol=1e-4)
+
+    def test_concurrent_requests_share_forward_passes(self):
+        batcher = MicroBatcher(self.encoder, max_batch_size=8, max_wait_ms=200)
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.images)) as executor:
+                results = list(executor.map(batcher.encode, self.images))
+        finally:
+            batcher.close()
+
+        self.assertEqual(batcher.images, len(self.images))
+        self.assertLess(batcher.batches, len(self.images))
+        expected = self.encoder.encode_batch(self.images)
+        np.testing.assert_allclose(np.stack(results), expected, rtol=1e-4, atol=1e-4)
+
+    def test_errors_propagate_to_callers(self):
+        batcher = MicroBatcher(self.encoder, max_wait_ms=0)
+        try:
+            with self.assertRaises(Exception):
+                batcher.encode(None)
+            # the worker keeps serving after a failed batch
+            self.assertEqual(batcher.encode(self.images[0]).shape[0],
+                             self.encoder.encode(self.images[0]).shape[0])
+        finally:
+            batcher.close()
+
+    def test_bad_image_only_fails_its_own_request(self):
+        batcher = MicroBatcher(self.encoder, max_batch_size=8, max_wait_ms=200)
+        try:
+            with ThreadPoolExecutor(max_workers=len(self.images)) as executor:
+                # an empty image hashes fine but cannot be encoded
+                corrupt = Image.new('RGB', (0, 0))
+                futures = [executor.submit(batcher.encode, img)
+                           for img in self.images[:3] + [corrupt] + self.images[3:6]]
+        finally:
+            batcher.close()
+
+        with self.assertRaises(Exception):
+            futures[3].result()
+
+        results = [future.result() for i, future in enumerate(futures) if i != 3]
+        expected = self.encoder.encode_batch(self.images[:6])
+        np.testing.assert_allclose(np.stack(results), expected, rtol=1e-4, atol=1e-4)
+        self.assertEqual(batcher.images, 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import sys
+import tempfile
+import unittest
+import timm
+from PIL import Image
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import model_registry
+from embedding_cache import get_embedding_cache
+from image_search import ImageEncoder, check_encoder_parity
+
+TEST_MODEL_NAME = "hf_hub:timm/test_vit_tiny"
+
+
+def register_test_model(model_name=TEST_MODEL_NAME):
+    # A randomly initialised tiny ViT avoids downloading pretrained weights
+    model = timm.create_model(
+        "vit_tiny_patch16_224", pretrained=False, num_classes=0)
+    return model_registry.register_model(model_name, model)
+
+
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registered = register_test_model()
+
+    def test_hub_and_bare_names_share_model(self):
+        self.assertIs(model_registry.get_model(TEST_MODEL_NAME),
+                      model_registry.get_model("test_vit_tiny"))
+
+    def test_encoders_share_model(self):
+        encoder1 = ImageEncoder(model_name=TEST_MODEL_NAME)
+        encoder2 = ImageEncoder(model_name="test_vit_tiny")
+        self.assertIs(encoder1._model, encoder2._model)
+        self.assertIs(encoder1._model, self.registered.model)
+
+    def test_warm_up_reports_ready(self):
+        self.assertFalse(model_registry.is_ready(TEST_MODEL_NAME))
+        model_registry.warm_up(TEST_MODEL_NAME)
+        self.assertTrue(model_registry.is_ready(TEST_MODEL_NAME))
+        self.assertEqual(model_registry.get_status()["test_vit_tiny"], "ready")
+
+    def test_encode(self):
+        encoder = ImageEncoder(model_name=TEST_MODEL_NAME)
+        emb = encoder.encode(Image.new('RGB', (300, 200), color='red'))
+        self.assertEqual(emb.shape, (self.registered.model.num_features,))
+
+    def test_reregistered_weights_are_not_served_from_cache(self):
+        img = Image.new('RGB', (300, 200), color='green')
+        encoder = ImageEncoder(model_name=TEST_MODEL_NAME)
+        emb = encoder.encode(img)
+        self.assertIn(self.registered.fingerprint, encoder.cache_key(img))
+
+        registered = register_test_model()
+        new_encoder = ImageEncoder(model_name=TEST_MODEL_NAME)
+        self.assertNotEqual(registered.fingerprint, self.registered.fingerprint)
+        self.assertNotEqual(new_encoder.cache_key(img), encoder.cache_key(img))
+        self.assertIsNone(get_embedding_cache().get(new_encoder.cache_key(img)))
+        self.assertFalse((new_encoder.encode(img) == emb).all())
+
+
+class TestEncoderBackends(unittest.TestCase):
+
+    def setUp(self):
+        register_test_model()
+        self.images = [Image.new('RGB', (64, 64), color=(i * 40, 255 - i * 40, 128))
+                       for i in range(5)]
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            ImageEncoder(model_name=TEST_MODEL_NAME, backend="tensorrt")
+
+    def test_int8_parity(self):
+        encoder = ImageEncoder(model_name=TEST_MODEL_NAME, backend="int8")
+        self.assertEqual(encoder.backend, "int8")
+        self.assertIsNot(encoder._model, model_registry.get_model(TEST_MODEL_NAME).model)
+
+        report = check_encoder_parity(self.images, "int8", model_name=TEST_MODEL_NAME)
+        self.assertEqual(report["n_images"], len(self.images))
+        self.assertGreater(report["csim_mean"], 0.9)
+
+    def test_onnx_parity(self):
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError:
+            self.skipTest("onnxruntime is not installed")
+
+        onnx_cache_dir = model_registry.ONNX_CACHE_DIR
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_registry.ONNX_CACHE_DIR = tmp_dir
+            try:
+                report = check_encoder_parity(self.images, "onnx", model_name=TEST_MODEL_NAME)
+                exported = os.listdir(tmp_dir)
+            finally:
+                model_registry.ONNX_CACHE_DIR = onnx_cache_dir
+
+        # re-registered weights are exported again rather than served from a stale file
+        fingerprint = model_registry.get_model(TEST_MODEL_NAME).fingerprint
+        self.assertEqual(exported, [f"test_vit_tiny.{fingerprint}.onnx"])
+
+        self.assertGreater(report["csim_min"], 0.999)
+        self.assertEqual(report["decision_agreement"], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
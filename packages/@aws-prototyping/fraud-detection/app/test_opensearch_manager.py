@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from opensearch_manager import ImageEmbeddingManager, connection_metrics, create_opensearch_client
+
+
+class OpenSearchHandler(BaseHTTPRequestHandler):
+    """Minimal keep-alive OpenSearch endpoint answering _doc, _bulk and
+    _count requests."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+
+    def do_POST(self):
+        body = self._read_body()
+        if "/_count" in self.path:
+            self._reply({"count": 3})
+        elif self.path.startswith("/_bulk"):
+            actions = [json.loads(line) for line in body.splitlines() if line.strip()]
+            items = [{op: {"_id": str(i), "status": 200}} for i, action in enumerate(actions)
+                     for op in action if op in ("index", "delete")]
+            self._reply({"took": 1, "errors": False, "items": items})
+        else:
+            self._reply({"_id": "doc", "result": "created"})
+
+    def do_GET(self):
+        self._read_body()
+        self._reply({"count": 3})
+
+    def do_DELETE(self):
+        self._reply({"_id": self.path.rsplit("/", 1)[-1], "result": "deleted"})
+
+    def log_message(self, *args):
+        pass
+
+
+class TestImageEmbeddingManager(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), OpenSearchHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        client = create_opensearch_client(f"http://127.0.0.1:{self.server.server_port}",
+                                          pool_maxsize=4)
+        self.manager = ImageEmbeddingManager(None, "img-vector", client=client)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_operations_reuse_connections(self):
+        X = np.random.default_rng(0).normal(size=(3, 8)).astype(np.float32)
+
+        self.assertEqual(self.manager.add_embedding(X[0]), "doc")
+        self.assertEqual(len(self.manager.bulk_add_embeddings(X)), 3)
+        self.manager.remove_embedding("doc")
+        self.manager.bulk_remove_embeddings(["0", "1"])
+        for _ in range(6):
+            self.assertEqual(self.manager.count_embeddings(), 3)
+
+        metrics = self.manager.connection_metrics()
+        self.assertEqual(metrics["requests"], 10)
+        self.assertEqual(metrics["connections"], 1)
+        self.assertAlmostEqual(metrics["reuse_ratio"], 0.9)
+
+    def test_no_requests(self):
+        client = create_opensearch_client("https://example.aoss.amazonaws.com")
+        self.assertEqual(connection_metrics(client),
+                         {"requests": 0, "connections": 0, "reuse_ratio": 0.0})
+
+
+if __name__ == '__main__':
+    unittest.main()
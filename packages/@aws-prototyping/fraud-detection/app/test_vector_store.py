@@ -0,0 +1,120 @@
+import os
+import sys
+import unittest
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from vector_store import (AnnoyVectorStore, ExactVectorStore, InMemoryOpenSearchClient,
+                          OpenSearchVectorStore, VectorStore, create_vector_store)
+
+DIM = 16
+
+
+class TestVectorStores(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.X = rng.normal(size=(200, DIM)).astype(np.float32)
+        self.q = self.X[7] + 0.01 * rng.normal(size=DIM).astype(np.float32)
+
+    def make_stores(self):
+        return {
+            "exact": ExactVectorStore(DIM),
+            "annoy": AnnoyVectorStore(DIM, rebuild_size=50),
+            "memory": create_vector_store("memory", dim=DIM, index_name="img-vector"),
+        }
+
+    def test_stores_agree(self):
+        results = {}
+        for kind, store in self.make_stores().items():
+            self.assertIsInstance(store, VectorStore)
+            ids = store.bulk_add(self.X[:150])
+            ids += [store.add(x) for x in self.X[150:]]
+            self.assertEqual(store.count(), len(self.X))
+
+            hits = store.search(self.q, k=5)
+            self.assertEqual(hits[0].id, ids[7], kind)
+            self.assertTrue(all(a.score >= b.score for a, b in zip(hits, hits[1:])), kind)
+            results[kind] = hits
+
+            store.remove(ids[7])
+            self.assertEqual(store.count(), len(self.X) - 1)
+            self.assertNotIn(ids[7], [hit.id for hit in store.search(self.q, k=5)])
+
+            store.bulk_remove(ids[:5] + ids[7:8])
+            self.assertEqual(store.count(), len(self.X) - 6)
+
+        self.assertAlmostEqual(results["exact"][0].score, results["memory"][0].score, places=5)
+        self.assertGreater(results["exact"][0].score, 0.99)
+
+    def test_filters_and_min_score(self):
+        metadata = [{"claim_type": ["Motor", "Theft"][i % 2],
+                     "created_timestamp": f"2024-{1 + i % 12:02d}-01"}
+                    for i in range(len(self.X))]
+        for kind, store in self.make_stores().items():
+            ids = store.bulk_add(self.X, metadata)
+
+            hits = store.search(self.q, k=20, filters={"claim_type": "Theft"})
+            self.assertEqual(len(hits), 20, kind)
+            self.assertEqual(hits[0].id, ids[7], kind)
+            self.assertTrue(all(ids.index(hit.id) % 2 == 1 for hit in hits), kind)
+
+            hits = store.search(self.q, k=20, filters={
+                "claim_type": ["Motor"],
+                "created_timestamp": {"gte": "2024-03-01", "lte": "2024-05-01"}})
+            self.assertTrue(all(ids.index(hit.id) % 12 in (2, 4) for hit in hits), kind)
+
+            hits = store.search(self.q, k=20, min_score=0.99)
+            self.assertEqual([hit.id for hit in hits], [ids[7]], kind)
+
+    def test_search_request_body(self):
+        client = InMemoryOpenSearchClient()
+        requests = []
+        search = client.search
+        client.search = lambda index, body: requests.append(body) or search(index, body)
+        store = OpenSearchVectorStore(index_name="img-vector", client=client)
+
+        store.search(self.q, k=25, min_score=0.95, filters={"claim_type": "Motor"})
+        body = requests[0]
+        self.assertEqual((body["size"], body["min_score"], body["_source"]), (25, 0.95, False))
+        self.assertEqual(body["query"]["knn"]["embedding"]["k"], 25)
+        self.assertEqual(body["query"]["knn"]["embedding"]["filter"],
+                         {"bool": {"filter": [{"term": {"claim_type.keyword": "Motor"}}]}})
+        self.assertNotIn("sort", body)
+
+    def test_annoy_searches_pending_rows(self):
+        store = AnnoyVectorStore(DIM, rebuild_size=1000)
+        store.bulk_add(self.X[:100])
+        store.search(self.q)
+        [new_id] = store.bulk_add(self.X[7:8] * 2)
+        self.assertIn(new_id, [hit.id for hit in store.search(self.q, k=2)])
+        self.assertEqual(store._n_indexed, 100)
+
+    def test_in_memory_client_response_shape(self):
+        client = InMemoryOpenSearchClient()
+        store = OpenSearchVectorStore(index_name="img-vector", client=client)
+        store.bulk_add(self.X[:10])
+
+        res = client.search(index="img-vector", body={
+            "_source": {"excludes": ["embedding"]},
+            "size": 3,
+            "query": {"knn": {"embedding": {"vector": self.q.tolist(), "k": 3}}},
+        })
+        hits = res["hits"]["hits"]
+        self.assertEqual(len(hits), 3)
+        self.assertEqual(res["hits"]["max_score"], hits[0]["_score"])
+        self.assertEqual(set(hits[0]), {"_index", "_id", "_score", "_source"})
+        self.assertNotIn("embedding", hits[0]["_source"])
+
+    def test_create_vector_store(self):
+        self.assertIsInstance(create_vector_store("exact", dim=DIM), ExactVectorStore)
+        self.assertIsInstance(create_vector_store("annoy", dim=DIM), AnnoyVectorStore)
+        self.assertIsInstance(create_vector_store("memory", dim=DIM, index_name="img-vector"),
+                              OpenSearchVectorStore)
+
+    def test_unknown_store(self):
+        with self.assertRaises(ValueError):
+            create_vector_store("faiss", dim=DIM)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+from typing import Callable
+
+import PIL
+from PIL import Image
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", "500"))
+
+
+class ThumbnailCache:
+    """On-disk cache of image thumbnails. Entries are keyed by the absolute
+    path and modification time of the source image, so an image that is
+    replaced on disk is never served a stale thumbnail, and writing the new
+    thumbnail deletes the entries of the previous versions of the image.
+
+    """
+
+    def __init__(self, cache_dir: str, size: int = THUMBNAIL_SIZE):
+        """Constructor.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory holding the thumbnail files, created if required.
+        size : int, default=THUMBNAIL_SIZE or 500
+            Maximum width and height of the thumbnails.
+
+        """
+
+        self._cache_dir = Path(cache_dir)
+        self._cache_dir.mkdir(parents=True, exist_ok=True)
+        self._size = size
+        return
+
+    @staticmethod
+    def _format(fn: str) -> str:
+        return "PNG" if Path(fn).suffix.lower() == ".png" else "JPEG"
+
+    def path(self, fn: str) -> Path:
+        """Return the cache path of the thumbnail of `fn`.
+
+        Parameters
+        ----------
+        fn : str
+
+        Returns
+        -------
+        Path
+
+        """
+
+        fn = Path(fn).resolve()
+        version = hashlib.sha1(f"{fn.stat().st_mtime_ns}:{self._size}".encode()).hexdigest()
+        key = f"{self._source_key(fn)}-{version[:16]}"
+        return self._cache_dir / f"{key}.{self._format(fn).lower()}"
+
+    @staticmethod
+    def _source_key(fn: Path) -> str:
+        return hashlib.sha1(fn.as_posix().encode()).hexdigest()
+
+    def _remove_stale(self, fn: str, thumb_fn: Path):
+        # entries of the same source image with an older modification time (or size)
+        for stale_fn in self._cache_dir.glob(f"{self._source_key(Path(fn).resolve())}-*"):
+            if stale_fn != thumb_fn and not stale_fn.name.endswith(".tmp"):
+                stale_fn.unlink(missing_ok=True)
+
+    def _render(self, fn: str, img: PIL.Image) -> bytes:
+        thumb = img.copy()
+        thumb.thumbnail((self._size, self._size), PIL.Image.LANCZOS)
+
+        if thumb.mode not in ("RGB", "L"):
+            thumb = thumb.convert("RGB")
+
+        buf = io.BytesIO()
+        thumb.save(buf, format=self._format(fn))
+        return buf.getvalue()
+
+    def _write(self, fn: str, thumb_fn: Path, data: bytes):
+        # write a temporary file unique to this call, then rename it, so that
+        # concurrent writers and readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=self._cache_dir, suffix=".tmp",
+                                         delete=False) as f:
+            f.write(data)
+
+        try:
+            os.replace(f.name, thumb_fn)
+        except OSError as e:
+            # the thumbnail is simply not cached, and regenerated next time
+            logger.warning(f"Could not cache the thumbnail of {fn}: {e}")
+            Path(f.name).unlink(missing_ok=True)
+            return
+
+        self._remove_stale(fn, thumb_fn)
+
+    def put(self, fn: str, img: PIL.Image) -> Path:
+        """Write the thumbnail of `fn` from its already decoded image.
+
+        Parameters
+        ----------
+        fn : str
+        img : PIL.Image
+            The decoded image; it is not modified.
+
+        Returns
+        -------
+        Path
+            The cache path, which may not exist if the thumbnail could not be
+            written.
+
+        """
+
+        thumb_fn = self.path(fn)
+
+        if not thumb_fn.exists():
+            self._write(fn, thumb_fn, self._render(fn, img))
+
+        return thumb_fn
+
+    def get(self, fn: str, loader: Callable[[str], PIL.Image] = Image.open) -> bytes:
+        """Return the encoded thumbnail of `fn`, generating it on a miss.
+
+        Parameters
+        ----------
+        fn : str
+        loader : Callable[[str], PIL.Image], default=Image.open
+            Used to decode `fn` on a cache miss.
+
+        Returns
+        -------
+        bytes
+
+        """
+
+        thumb_fn = self.path(fn)
+
+        try:
+            return thumb_fn.read_bytes()
+        except FileNotFoundError:
+            pass
+
+        data = self._render(fn, loader(fn))
+        self._write(fn, thumb_fn, data)
+        return data
+
+    def data_url(self, fn: str, loader: Callable[[str], PIL.Image] = Image.open) -> str:
+        """Return the thumbnail of `fn` as a base64 data URL.
+
+        Parameters
+        ----------
+        fn : str
+        loader : Callable[[str], PIL.Image], default=Image.open
+
+        Returns
+        -------
+        str
+
+        """
+
+        bytes_str = base64.b64encode(self.get(fn, loader)).decode()
+        return f"data:image/{self._format(fn).lower()};base64,{bytes_str}"
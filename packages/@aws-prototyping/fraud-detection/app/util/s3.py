@@ -1,12 +1,65 @@
 import base64
 from io import BytesIO
 import io
+import mimetypes
 import os
+import threading
 import uuid
 import boto3
+from botocore.config import Config
 import PIL
 import requests
 
+# Size of the connection pool of the shared S3 client, i.e. the number of
+# requests it can have in flight at once
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", "32"))
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Returns the process-wide S3 client. boto3 clients are thread safe, so a single pooled client is
+    shared rather than creating one per request.
+
+    Returns:
+    botocore.client.S3: The shared S3 client.
+    """
+
+    global _s3_client
+
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                's3', config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+
+    return _s3_client
+
+
+def s3_object_to_data_url(bucket_name: str, key: str, s3=None):
+    """
+    Fetch an image object from S3 and return it as a base64 data URL as stored, without decoding
+    it first.
+
+    Args:
+    - bucket_name (str): The name of the bucket.
+    - key (str): The key of the image object.
+    - s3 (optional): The S3 client to use. Defaults to the shared client.
+
+    Returns:
+    str: The data URL.
+    """
+
+    response = (s3 or get_s3_client()).get_object(Bucket=bucket_name, Key=key)
+    content_type = response.get("ContentType")
+
+    if not content_type or not content_type.startswith("image/"):
+        content_type = mimetypes.guess_type(key)[0] or "image/png"
+
+    bytes_str = base64.b64encode(response["Body"].read()).decode()
+    return f"data:{content_type};base64,{bytes_str}"
+
 
 def upload_image_to_s3(bucket_name: str, image: PIL.Image, filename):
     """
@@ -0,0 +1,501 @@
+import operator
+import os
+import sys
+import threading
+import time
+import uuid
+from typing import List, Optional, Protocol, runtime_checkable
+
+import numpy as np
+from annoy import AnnoyIndex
+from loguru import logger
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from schemas.schemas import EmbeddingsSearchResult
+
+# One of "opensearch", "annoy", "exact" or "memory" (an in-process stand-in for
+# OpenSearch, for running the API offline).
+VECTOR_STORE = os.environ.get("VECTOR_STORE", "opensearch")
+
+
+@runtime_checkable
+class VectorStore(Protocol):
+    """Storage and nearest neighbour search of image embeddings.
+
+    Scores follow the OpenSearch `cosinesimil` space, i.e. `(1 + cos) / 2`, so
+    that similarity thresholds mean the same thing whichever implementation is
+    used.
+
+    Each embedding can carry a metadata document (e.g. "claim_type" or
+    "created_timestamp") that searches can be filtered on. Filters map a field
+    to a value, a list of accepted values, or a dict of "gte", "gt", "lte" and
+    "lt" range bounds. Embeddings indexed without metadata never match a
+    filter.
+    """
+
+    def add(self, embedding: np.ndarray, metadata: Optional[dict] = None) -> str:
+        ...
+
+    def bulk_add(self, embeddings: np.ndarray, metadata: Optional[List[dict]] = None) -> List[str]:
+        ...
+
+    def remove(self, image_id: str) -> None:
+        ...
+
+    def bulk_remove(self, image_ids: List[str]) -> None:
+        ...
+
+    def search(self, query_embedding: np.ndarray, k: int = 10, min_score: Optional[float] = None,
+               filters: Optional[dict] = None) -> List[EmbeddingsSearchResult]:
+        ...
+
+    def count(self) -> int:
+        ...
+
+
+def _cosine_score(csim: np.ndarray) -> np.ndarray:
+    return (1 + csim) / 2
+
+
+def cosine_to_score(csim: float) -> float:
+    """Converts a cosine similarity to the score of the `cosinesimil` space."""
+    return float(_cosine_score(csim))
+
+
+def _normalize(X: np.ndarray) -> np.ndarray:
+    X = np.asarray(X, dtype=np.float32)
+    return X / np.maximum(np.linalg.norm(X, axis=-1, keepdims=True), 1e-12)
+
+
+_RANGE_OPS = {"gte": operator.ge, "gt": operator.gt, "lte": operator.le, "lt": operator.lt}
+# Exact-value sub-field of the string fields, as added by OpenSearch's dynamic mapping
+KEYWORD_SUFFIX = ".keyword"
+
+
+def _term_field(field: str, values: list) -> str:
+    # dynamically mapped strings are analyzed `text`, only their keyword sub-field matches exactly
+    if all(isinstance(value, str) for value in values):
+        return field + KEYWORD_SUFFIX
+    return field
+
+
+def filter_clause(filters: dict) -> dict:
+    """
+    Converts search filters to an OpenSearch bool filter clause. String values are matched against
+    the `.keyword` sub-field, which dynamic mapping adds to every string field, so the clause works
+    on indexes created without explicit mappings (e.g. from the console).
+
+    Args:
+        filters (dict): Maps a field to a value (term), a list of values (terms) or a dict of range
+            bounds.
+
+    Returns:
+        dict: The clause.
+    """
+    clauses = []
+    for field, cond in filters.items():
+        if isinstance(cond, dict):
+            clauses.append({"range": {field: cond}})
+        elif isinstance(cond, (list, tuple, set)):
+            clauses.append({"terms": {_term_field(field, list(cond)): list(cond)}})
+        else:
+            clauses.append({"term": {_term_field(field, [cond]): cond}})
+
+    return {"bool": {"filter": clauses}}
+
+
+def _matches(source: dict, filters: Optional[dict]) -> bool:
+    for field, cond in (filters or {}).items():
+        value = source.get(field)
+
+        if isinstance(cond, dict):
+            if value is None:
+                return False
+            if not all(_RANGE_OPS[op](value, bound) for op, bound in cond.items()):
+                return False
+        elif isinstance(cond, (list, tuple, set)):
+            if value not in cond:
+                return False
+        elif value != cond:
+            return False
+
+    return True
+
+
+def _clause_filters(clause: dict) -> dict:
+    # inverse of `filter_clause`
+    filters = {}
+    for c in clause["bool"]["filter"]:
+        [(kind, spec)] = c.items()
+        [(field, cond)] = spec.items()
+        filters[field.removesuffix(KEYWORD_SUFFIX)] = cond
+    return filters
+
+
+class OpenSearchVectorStore:
+    """Embeddings stored in an OpenSearch (Serverless) kNN index."""
+
+    def __init__(self, endpoint: str = None, index_name: str = None, client=None):
+        """
+        Args:
+            endpoint (str, optional): The OpenSearch endpoint. Ignored if `client` is given.
+            index_name (str, optional): The kNN index holding the embeddings.
+            client (optional): An `opensearchpy.OpenSearch` compatible client. Defaults to the
+                shared SigV4 signed client of `endpoint`.
+        """
+        if client is None:
+            from opensearch_manager import get_opensearch_client
+            client = get_opensearch_client(endpoint)
+
+        self.client = client
+        self._index_name = index_name
+
+    def add(self, embedding: np.ndarray, metadata: Optional[dict] = None) -> str:
+        body = {**(metadata or {}), "embedding": np.asarray(embedding).tolist()}
+        resp = self.client.index(index=self._index_name, body=body)
+        return resp["_id"]
+
+    def bulk_add(self, embeddings: np.ndarray, metadata: Optional[List[dict]] = None) -> List[str]:
+        body = []
+        for embedding, doc in zip(embeddings, metadata or [{}] * len(embeddings)):
+            body.append({"index": {"_index": self._index_name}})
+            body.append({**doc, "embedding": np.asarray(embedding).tolist()})
+
+        resp = self.client.bulk(body=body)
+
+        if resp.get("errors"):
+            failed = [item["index"] for item in resp["items"] if "error" in item["index"]]
+            raise RuntimeError(f"Failed to index {len(failed)} embeddings: {failed[0]['error']}")
+
+        return [item["index"]["_id"] for item in resp["items"]]
+
+    def remove(self, image_id: str) -> None:
+        self.client.delete(index=self._index_name, id=image_id)
+
+    def bulk_remove(self, image_ids: List[str]) -> None:
+        if len(image_ids) == 0:
+            return
+
+        body = [{"delete": {"_index": self._index_name, "_id": image_id}}
+                for image_id in image_ids]
+        resp = self.client.bulk(body=body)
+
+        if resp.get("errors"):
+            # deleting an id that is already gone is not an error
+            failed = [item["delete"] for item in resp["items"]
+                      if "error" in item["delete"] and item["delete"].get("status") != 404]
+            if failed:
+                raise RuntimeError(
+                    f"Failed to delete {len(failed)} embeddings: {failed[0]['error']}")
+
+    def search(self, query_embedding: np.ndarray, k: int = 10, min_score: Optional[float] = None,
+               filters: Optional[dict] = None) -> List[EmbeddingsSearchResult]:
+        knn = {"vector": np.asarray(query_embedding).tolist(), "k": k}
+        if filters:
+            # efficient kNN filtering: applied during the graph search, not to its k results
+            knn["filter"] = filter_clause(filters)
+
+        body = {
+            "_source": False,
+            "size": k,
+            "query": {"knn": {"embedding": knn}},
+        }
+        if min_score is not None:
+            body["min_score"] = min_score
+
+        res = self.client.search(index=self._index_name, body=body)
+
+        return [EmbeddingsSearchResult(id=hit["_id"], score=hit["_score"])
+                for hit in res["hits"]["hits"]]
+
+    def count(self) -> int:
+        return int(self.client.count(index=self._index_name)["count"])
+
+
+class InMemoryOpenSearchClient:
+    """In-process stand-in for the subset of the `opensearchpy.OpenSearch`
+    client used by `OpenSearchVectorStore`. Responses have the same shape as
+    those of an OpenSearch kNN index using the `cosinesimil` space.
+    """
+
+    def __init__(self):
+        self._indices = {}
+        self._lock = threading.Lock()
+
+    def _index(self, index: str) -> dict:
+        return self._indices.setdefault(index, {})
+
+    def index(self, index: str, body: dict, id: str = None, **kwargs) -> dict:
+        doc_id = id or uuid.uuid4().hex
+        with self._lock:
+            self._index(index)[doc_id] = dict(body)
+        return {"_index": index, "_id": doc_id, "_version": 1, "result": "created"}
+
+    def bulk(self, body: list, index: str = None, **kwargs) -> dict:
+        start = time.perf_counter()
+        items = []
+
+        body = iter(body)
+
+        for action in body:
+            if "delete" in action:
+                params = action["delete"]
+                resp = self.delete(params.get("_index", index), params["_id"])
+                status = 200 if resp["result"] == "deleted" else 404
+                items.append({"delete": {**resp, "status": status}})
+            else:
+                params = action["index"]
+                resp = self.index(params.get("_index", index), next(body), id=params.get("_id"))
+                items.append({"index": {**resp, "status": 201}})
+
+        return {"took": int((time.perf_counter() - start) * 1000), "errors": False, "items": items}
+
+    def delete(self, index: str, id: str, **kwargs) -> dict:
+        with self._lock:
+            found = self._index(index).pop(id, None) is not None
+        return {"_index": index, "_id": id, "result": "deleted" if found else "not_found"}
+
+    def count(self, index: str, body: dict = None, **kwargs) -> dict:
+        with self._lock:
+            return {"count": len(self._index(index))}
+
+    def search(self, index: str, body: dict, **kwargs) -> dict:
+        start = time.perf_counter()
+        knn = body["query"]["knn"]["embedding"]
+        size = min(body.get("size", 10), knn["k"])
+        source = body.get("_source", True)
+        excludes = source.get("excludes", []) if isinstance(source, dict) else []
+        filters = _clause_filters(knn["filter"]) if "filter" in knn else None
+
+        with self._lock:
+            docs = [(doc_id, doc) for doc_id, doc in self._index(index).items()
+                    if _matches(doc, filters)]
+
+        hits = []
+        if docs and size > 0:
+            X = _normalize([source["embedding"] for _, source in docs])
+            scores = _cosine_score(X @ _normalize(knn["vector"]))
+            top = np.argsort(-scores, kind="stable")[:size]
+            top = top[scores[top] >= body.get("min_score", -np.inf)]
+            hits = [
+                {
+                    "_index": index,
+                    "_id": docs[i][0],
+                    "_score": float(scores[i]),
+                    **({"_source": {key: value for key, value in docs[i][1].items()
+                                    if key not in excludes}} if source is not False else {}),
+                }
+                for i in top
+            ]
+
+        return {
+            "took": int((time.perf_counter() - start) * 1000),
+            "timed_out": False,
+            "hits": {
+                "total": {"value": len(hits), "relation": "eq"},
+                "max_score": hits[0]["_score"] if hits else None,
+                "hits": hits,
+            },
+        }
+
+
+class ExactVectorStore:
+    """Embeddings held in a local, L2-normalized float32 matrix and searched
+    exhaustively.
+    """
+
+    def __init__(self, dim: int):
+        self._dim = dim
+        self._X = np.empty((0, dim), dtype=np.float32)
+        self._ids = []
+        self._metadata = []
+        self._rows = {}
+        self._valid = np.empty(0, dtype=bool)
+        self._n = 0
+        self._lock = threading.Lock()
+
+    def add(self, embedding: np.ndarray, metadata: Optional[dict] = None) -> str:
+        return self.bulk_add(np.asarray(embedding).reshape(1, -1), [metadata or {}])[0]
+
+    def bulk_add(self, embeddings: np.ndarray, metadata: Optional[List[dict]] = None) -> List[str]:
+        X = _normalize(np.asarray(embeddings).reshape(-1, self._dim))
+        ids = [uuid.uuid4().hex for _ in range(len(X))]
+
+        with self._lock:
+            end = self._n + len(X)
+
+            # grow geometrically so repeated adds are amortised O(1)
+            if end > len(self._X):
+                capacity = max(end, 2 * len(self._X), 1024)
+                padding = np.zeros((capacity - self._n, self._dim), dtype=np.float32)
+                self._X = np.concatenate([self._X[:self._n], padding])
+                self._valid = np.concatenate(
+                    [self._valid[:self._n], np.zeros(capacity - self._n, dtype=bool)])
+
+            self._X[self._n:end] = X
+            self._valid[self._n:end] = True
+            for row, image_id in enumerate(ids, start=self._n):
+                self._rows[image_id] = row
+            self._ids.extend(ids)
+            self._metadata.extend(metadata or [{}] * len(ids))
+            self._n = end
+
+        return ids
+
+    def remove(self, image_id: str) -> None:
+        self.bulk_remove([image_id])
+
+    def bulk_remove(self, image_ids: List[str]) -> None:
+        with self._lock:
+            for image_id in image_ids:
+                row = self._rows.pop(image_id, None)
+                if row is not None:
+                    self._valid[row] = False
+                    self._X[row] = 0
+
+    def _candidates(self, q: np.ndarray, k: int):
+        scores = self._X[:self._n] @ q
+        scores[~self._valid[:self._n]] = -np.inf
+        k = min(k, len(self._rows))
+
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+
+        return np.argpartition(-scores, k - 1)[:k]
+
+    def _filtered_candidates(self, q: np.ndarray, k: int, filters: dict):
+        # exact search of the rows matching the filters
+        rows = np.array([row for row in np.flatnonzero(self._valid[:self._n])
+                         if _matches(self._metadata[row], filters)], dtype=np.int64)
+        return rows[np.argsort(-(self._X[rows] @ q), kind="stable")[:k]]
+
+    def search(self, query_embedding: np.ndarray, k: int = 10, min_score: Optional[float] = None,
+               filters: Optional[dict] = None) -> List[EmbeddingsSearchResult]:
+        q = _normalize(query_embedding)
+
+        with self._lock:
+            rows = self._filtered_candidates(q, k, filters) if filters else self._candidates(q, k)
+            csim = self._X[rows] @ q
+            ids = [self._ids[row] for row in rows]
+
+        order = np.argsort(-csim, kind="stable")
+        scores = _cosine_score(csim)
+        if min_score is not None:
+            order = order[scores[order] >= min_score]
+
+        return [EmbeddingsSearchResult(id=ids[i], score=float(scores[i])) for i in order]
+
+    def count(self) -> int:
+        return len(self._rows)
+
+
+class AnnoyVectorStore(ExactVectorStore):
+    """Embeddings searched with an `annoy` index. Annoy indices are immutable,
+    so embeddings added since the index was built are searched exhaustively
+    until `rebuild_size` of them have accumulated, at which point the index is
+    rebuilt on the next search.
+    """
+
+    def __init__(self, dim: int, n_trees: int = 10, rebuild_size: int = 1000):
+        super().__init__(dim)
+        self._n_trees = n_trees
+        self._rebuild_size = rebuild_size
+        self._ann_index = None
+        self._n_indexed = 0
+
+    def _build_index(self):
+        # must be called with the lock held
+        ann_index = AnnoyIndex(self._dim, "angular")
+        for row in np.flatnonzero(self._valid[:self._n]):
+            ann_index.add_item(int(row), self._X[row])
+        ann_index.build(self._n_trees)
+        self._ann_index = ann_index
+        self._n_indexed = self._n
+        logger.info(f"Built annoy index of {len(self._rows)} embeddings")
+
+    def _candidates(self, q: np.ndarray, k: int):
+        if self._ann_index is None or self._n - self._n_indexed >= self._rebuild_size:
+            self._build_index()
+
+        # over-fetch to make up for removed rows still in the index
+        n_removed = self._n_indexed - int(np.count_nonzero(self._valid[:self._n_indexed]))
+        rows = np.array(self._ann_index.get_nns_by_vector(q, k + n_removed), dtype=np.int64)
+        rows = rows[self._valid[rows]]
+
+        # search the rows added since the index was built exhaustively
+        pending = np.arange(self._n_indexed, self._n)
+        pending = pending[self._valid[pending]]
+        if len(pending) > 0:
+            pending = pending[np.argsort(-(self._X[pending] @ q), kind="stable")[:k]]
+
+        return np.concatenate([rows, pending])
+
+
+def create_vector_store(
+        kind: str = VECTOR_STORE,
+        dim: int = 768,
+        endpoint: str = None,
+        index_name: str = None,
+) -> VectorStore:
+    """
+    Creates the vector store configured by `kind`.
+
+    Args:
+        kind (str, optional): One of "opensearch", "annoy", "exact" or "memory". Defaults to the
+            VECTOR_STORE environment variable, or "opensearch" if it is not set.
+        dim (int, optional): Dimensionality of the embeddings, used by the local stores.
+            Defaults to 768.
+        endpoint (str, optional): The OpenSearch endpoint, used by "opensearch".
+        index_name (str, optional): The OpenSearch index name, used by "opensearch" and "memory".
+
+    Returns:
+        VectorStore: The vector store.
+    """
+    if kind == "opensearch":
+        return OpenSearchVectorStore(endpoint, index_name)
+    if kind == "memory":
+        return OpenSearchVectorStore(index_name=index_name, client=InMemoryOpenSearchClient())
+    if kind == "annoy":
+        return AnnoyVectorStore(dim)
+    if kind == "exact":
+        return ExactVectorStore(dim)
+
+    raise ValueError(f"Unknown vector store '{kind}', expected one of 'opensearch', 'annoy', "
+                     f"'exact' or 'memory'")
+
+
+# One store per configuration, shared by every S3ImageLibrary of the process, so that the local
+# stores keep their embeddings across requests
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_vector_store(
+        kind: str = None,
+        dim: int = 768,
+        endpoint: str = None,
+        index_name: str = None,
+) -> VectorStore:
+    """
+    Returns the process-wide vector store configured by `kind`, creating it on first use. See
+    `create_vector_store`.
+
+    Args:
+        kind (str, optional): One of "opensearch", "annoy", "exact" or "memory". Defaults to the
+            VECTOR_STORE environment variable, or "opensearch" if it is not set.
+        dim (int, optional): Dimensionality of the embeddings, used by the local stores.
+            Defaults to 768.
+        endpoint (str, optional): The OpenSearch endpoint, used by "opensearch".
+        index_name (str, optional): The OpenSearch index name, used by "opensearch" and "memory".
+
+    Returns:
+        VectorStore: The shared vector store.
+    """
+    key = (kind or VECTOR_STORE, dim, endpoint, index_name)
+
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = create_vector_store(*key)
+
+        return _stores[key]
@@ -15,14 +15,28 @@ from dotenv import load_dotenv
 
 from app_secrets import get_secret_value
 from image_search import make_data_url, ImageLibrary, ImageChecker
+from claim_image import ClaimImage
 from pydantic import BaseModel
 from typing import List, Optional
 from schemas.schemas import ReverseImageSearchResult, ReverseImageSearchResults
 
 load_dotenv()
 bucket_name = os.environ.get("STORAGE_BUCKET")
-serp_api_key = get_secret_value(os.environ.get("SERP_API_KEY_SECRET"))
 temp_opensearch_endpoint = os.environ.get("TEMP_OPENSEARCH_ENDPOINT")
+_serp_api_key = None
+
+
+def get_serp_api_key():
+    """
+    Returns the SerpAPI key, read from Secrets Manager on first use so that importing this module
+    needs neither the secret nor AWS credentials.
+    """
+    global _serp_api_key
+
+    if _serp_api_key is None:
+        _serp_api_key = get_secret_value(os.environ.get("SERP_API_KEY_SECRET"))
+
+    return _serp_api_key
 
 
 def url_to_base64(url):
@@ -41,30 +55,33 @@ def url_to_base64(url):
 
 
 def sanitize_title(title):
-    return "".join([c for c in title if c.isalpha() or c.isdigit() or c == ' ']).rstrip().replace(" ", "_")
+    return "".join([c for c in title if c.isalpha() or c.isdigit() or c == ' ']).rstrip().replace(
+        " ", "_")
 
 
 
 
-def reverse_image_search(image: PIL.Image, filename: str, sim_thresh: float) -> ReverseImageSearchResults:
+def reverse_image_search(image: PIL.Image.Image | ClaimImage, filename: str,
+                         sim_thresh: float) -> ReverseImageSearchResults:
     """
     Perform reverse image search using Google Lens API.
 
     Args:
-        image (PIL.Image): The image to be searched.
+        image (PIL.Image | ClaimImage): The image to be searched.
         filename (str): The filename of the image.
         sim_thresh (float): The similarity threshold for image matching.
 
     Returns:
         ReverseImageSearchResults: A Pydantic model containing the search results.
     """
+    image = ClaimImage.wrap(image, filename)
     s3key = upload_image_to_s3(image, filename)
     presigned_url = generate_presigned_url(bucket_name, s3key)
 
     encoded_url = quote_plus(presigned_url)
 
     params = {
-        'api_key': serp_api_key,
+        'api_key': get_serp_api_key(),
         'engine': 'google_lens',
         'url': encoded_url,
         'hl': 'en',
@@ -102,27 +119,30 @@ def reverse_image_search(image: PIL.Image, filename: str, sim_thresh: float) ->
 
             df_results.at[idx, "uniquefilename"] = unique_filename
 
-            with open(os.path.join(f'./searches/{search_id}/data/class1', unique_filename), 'wb') as file:
+            with open(os.path.join(f'./searches/{search_id}/data/class1', unique_filename),
+                      'wb') as file:
                 for chunk in response.iter_content(chunk_size=8192):
                     file.write(chunk)
 
             print(f'Wrote file {unique_filename}')
 
-        IMAGE_LIBRARY = ImageLibrary(f'./searches/{search_id}/data', f'./searches/{search_id}/images.db',
-                                    f'./searches/{search_id}/images.ann', load_existing=False)
+        IMAGE_LIBRARY = ImageLibrary(f'./searches/{search_id}/data',
+                                     f'./searches/{search_id}/images.db',
+                                     f'./searches/{search_id}/images.ann', load_existing=False,
+                                     prebuild_thumbnails=False)
 
         imageChecker = ImageChecker(IMAGE_LIBRARY)
 
         similarity_results = imageChecker.find_similar(
-            image, ["class1"], sim_thresh)
+            image.rgb, ["class1"], sim_thresh)
 
         if not similarity_results.empty:
             df_results = pd.merge(df_results, similarity_results, how='left',
                       left_on='uniquefilename', right_on='filename')
             df_results = df_results.rename(columns={'data_url_x': 'data_url'})
             
-            df_results = df_results[['data_url', 'source', "csim", 'title', 'link']].sort_values(by="csim",
-                                                                                             ascending=False)
+            df_results = df_results[['data_url', 'source', "csim", 'title', 'link']].sort_values(
+                by="csim", ascending=False)
         
 
         shutil.rmtree(f'./searches/{search_id}')
@@ -130,38 +150,36 @@ def reverse_image_search(image: PIL.Image, filename: str, sim_thresh: float) ->
         df_results = pd.DataFrame()
 
     # Convert DataFrame to list of SearchResult objects
-    search_results = [ReverseImageSearchResult(**row) for row in df_results.to_dict(orient="records")]
+    search_results = [ReverseImageSearchResult(**row)
+                      for row in df_results.to_dict(orient="records")]
 
     return ReverseImageSearchResults(results=search_results)
 
 
-def upload_image_to_s3(image: PIL.Image, filename):
+def upload_image_to_s3(image: PIL.Image.Image | ClaimImage, filename):
     """
-    Upload a PIL image to Amazon S3.
+    Upload an image to Amazon S3 to be shared with the reverse image search through a presigned
+    URL. The image is re-encoded as JPEG without its EXIF data, so that the GPS location and camera
+    details of the claim photo never leave the account.
 
     Args:
-    - image (PIL.Image.Image): The PIL image to upload.
-    - bucket_name (str): The name of the bucket to upload to.
-    - object_name (str): The name of the object to create in the bucket.
+    - image (PIL.Image.Image | ClaimImage): The image to upload.
+    - filename (str): The filename of the image.
 
     Returns:
-    str: The S3 URL of the uploaded image.
+    str: The S3 key of the uploaded image.
     """
 
     # Initialize S3 client
     s3 = boto3.client('s3')
 
-    # Convert PIL image to bytes
-    buffer = BytesIO()
-    # You can change "JPEG" to whatever format your image is in, like "PNG".
-    image.save(buffer, format="PNG")
-    buffer.seek(0)
+    image = ClaimImage.wrap(image, filename)
     base_name, _ = os.path.splitext(filename)
-    s3key = f'{uuid.uuid4()}/{base_name}.png'
+    s3key = f'{uuid.uuid4()}/{base_name}.jpg'
 
     # Upload the image
     s3.put_object(Bucket=bucket_name, Key=s3key,
-                  Body=buffer, ContentType='image/png')
+                  Body=image.public_jpeg, ContentType='image/jpeg')
 
     return s3key
 